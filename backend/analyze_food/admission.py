@@ -0,0 +1,196 @@
+"""
+Admission control for analyze_food.
+
+Traffic spikes (e.g. right after the hourly notification push) used to turn
+into unbounded parallel Vertex calls, quota errors and slow 500s. Each request
+now passes two gates before any work is done:
+
+  1. A per-caller token bucket, keyed by the caller's identity: ANALYZE_USER_RATE
+     requests/sec with a burst of ANALYZE_USER_BURST for a verified user, and
+     the much looser ANALYZE_IP_RATE / ANALYZE_IP_BURST for a caller known only
+     by IP, since many users can share one address behind carrier-grade NAT.
+  2. A per-instance concurrency limit (ANALYZE_MAX_CONCURRENT) with a short,
+     bounded wait queue (ANALYZE_MAX_QUEUE waiters, ANALYZE_MAX_QUEUE_WAIT_SECONDS).
+
+A request that fails either gate is rejected right away with 429 and a
+Retry-After header instead of failing slowly. Queue depth and wait times are
+reported by `stats()` so instance concurrency can be sized from data.
+"""
+import math
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+from caller_auth import verified_claims
+
+# --- CONFIGURATION ---
+MAX_CONCURRENT = int(os.environ.get("ANALYZE_MAX_CONCURRENT", "8"))
+MAX_QUEUE = int(os.environ.get("ANALYZE_MAX_QUEUE", "16"))
+MAX_QUEUE_WAIT_SECONDS = float(os.environ.get("ANALYZE_MAX_QUEUE_WAIT_SECONDS", "2.0"))
+USER_RATE = float(os.environ.get("ANALYZE_USER_RATE", "0.5"))
+USER_BURST = float(os.environ.get("ANALYZE_USER_BURST", "10"))
+IP_RATE = float(os.environ.get("ANALYZE_IP_RATE", "10"))
+IP_BURST = float(os.environ.get("ANALYZE_IP_BURST", "200"))
+# Proxies of our own (e.g. an external load balancer) in front of the platform,
+# each appending one more X-Forwarded-For entry after the client's address.
+TRUSTED_PROXY_HOPS = int(os.environ.get("ANALYZE_TRUSTED_PROXY_HOPS", "0"))
+MAX_TRACKED_CALLERS = 10000
+WAIT_WINDOW_SIZE = 500
+
+
+class Rejected(Exception):
+    """The request was not admitted. `retry_after` is in whole seconds."""
+
+    def __init__(self, reason, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+
+
+def caller_identity(request):
+    """
+    Identifies the caller for rate limiting, from nothing the client can pick
+    freely: the uid of a verified Firebase ID token, else the client IP the
+    platform appended to X-Forwarded-For. Earlier entries in that header are
+    whatever the client sent, so they are ignored, as is any X-User-Id header.
+    """
+    claims = verified_claims(request)
+    if claims and claims.get('uid'):
+        return f"user:{claims['uid']}"
+    hops = [hop.strip() for hop in request.headers.get('X-Forwarded-For', '').split(',') if hop.strip()]
+    if len(hops) > TRUSTED_PROXY_HOPS:
+        return f"ip:{hops[-1 - TRUSTED_PROXY_HOPS]}"
+    return f"ip:{request.remote_addr or 'unknown'}"
+
+
+class TokenBuckets:
+    """One token bucket per caller; the least recently seen callers are forgotten."""
+
+    def __init__(self, rate=USER_RATE, burst=USER_BURST, max_callers=MAX_TRACKED_CALLERS):
+        self.rate = rate
+        self.burst = burst
+        self.max_callers = max_callers
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        """Takes one token for `key`, or raises Rejected."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self._buckets[key] = (tokens, now)
+                raise Rejected("rate_limited", (1 - tokens) / self.rate if self.rate else 60)
+            self._buckets[key] = (tokens - 1, now)
+            while len(self._buckets) > self.max_callers:
+                self._buckets.popitem(last=False)
+
+
+class ConcurrencyLimiter:
+    """A counting limiter with a bounded, time-limited wait queue."""
+
+    def __init__(self, max_concurrent=MAX_CONCURRENT, max_queue=MAX_QUEUE,
+                 max_wait_seconds=MAX_QUEUE_WAIT_SECONDS):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait_seconds = max_wait_seconds
+        self._condition = threading.Condition()
+        self.in_flight = 0
+        self.waiting = 0
+        self.peak_waiting = 0
+
+    def acquire(self):
+        """Takes a slot, waiting briefly if needed. Returns seconds waited."""
+        started = time.monotonic()
+        with self._condition:
+            if self.in_flight < self.max_concurrent:
+                self.in_flight += 1
+                return 0.0
+            if self.waiting >= self.max_queue:
+                raise Rejected("queue_full", self.max_wait_seconds)
+            self.waiting += 1
+            self.peak_waiting = max(self.peak_waiting, self.waiting)
+            try:
+                admitted = self._condition.wait_for(
+                    lambda: self.in_flight < self.max_concurrent, timeout=self.max_wait_seconds)
+                if not admitted:
+                    raise Rejected("queue_timeout", self.max_wait_seconds)
+                self.in_flight += 1
+            finally:
+                self.waiting -= 1
+        return time.monotonic() - started
+
+    def release(self):
+        with self._condition:
+            self.in_flight -= 1
+            self._condition.notify()
+
+
+class Ticket:
+    """Holds a concurrency slot for the duration of a `with` block."""
+
+    def __init__(self, controller, waited):
+        self.controller = controller
+        self.waited = waited
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.controller.limiter.release()
+        return False
+
+
+class AdmissionController:
+    def __init__(self, buckets=None, limiter=None, ip_buckets=None):
+        self.buckets = buckets or TokenBuckets()
+        self.limiter = limiter or ConcurrencyLimiter()
+        self.ip_buckets = ip_buckets or TokenBuckets(rate=IP_RATE, burst=IP_BURST)
+        self._lock = threading.Lock()
+        self._waits = deque(maxlen=WAIT_WINDOW_SIZE)
+        self.admitted = 0
+        self.rejected = {}
+
+    def admit(self, caller):
+        """Returns a Ticket to use as a context manager, or raises Rejected."""
+        buckets = self.ip_buckets if caller.startswith('ip:') else self.buckets
+        try:
+            buckets.take(caller)
+            waited = self.limiter.acquire()
+        except Rejected as e:
+            with self._lock:
+                self.rejected[e.reason] = self.rejected.get(e.reason, 0) + 1
+            raise
+        with self._lock:
+            self.admitted += 1
+            self._waits.append(waited)
+        return Ticket(self, waited)
+
+    def stats(self):
+        with self._lock:
+            waits = sorted(self._waits)
+            rejected = dict(self.rejected)
+            admitted = self.admitted
+
+        def pct(p):
+            return round(waits[min(len(waits) - 1, int(p / 100 * len(waits)))] * 1000, 1) if waits else 0.0
+
+        return {
+            "in_flight": self.limiter.in_flight,
+            "queue_depth": self.limiter.waiting,
+            "peak_queue_depth": self.limiter.peak_waiting,
+            "max_concurrent": self.limiter.max_concurrent,
+            "admitted": admitted,
+            "rejected": rejected,
+            "queue_wait_ms_p50": pct(50),
+            "queue_wait_ms_p95": pct(95),
+        }
+
+
+_controller = AdmissionController()
+
+
+def get_admission_controller():
+    return _controller
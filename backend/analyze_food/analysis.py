@@ -0,0 +1,261 @@
+"""
+Prompt selection, response schema and the model call shared by the
+single-image and batch analyze_food handlers.
+"""
+import json
+import os
+
+import instrumentation
+from fact_store import get_fact_store
+from gemini_client import get_client
+from model_router import get_router
+
+# --- PROMPTS ---
+STANDARD_PROMPT = """
+You are a food expert. Analyze the object in this image. Identify it and provide a fun fact about it.
+The fun fact should be a single, interesting sentence about the object's history, origin, or a mindful eating tip.
+If you cannot identify the object, set the `is_food` field to false, and the `name` and `fun_fact` fields to "???".
+"""
+
+SPECIAL_PROMPT = """
+You are a food expert and a whimsical genius. Analyze the object in this image and provide a creative, fun response based on ONE of the following ideas. Do not use more than one idea. Keep your response to 2-3 short sentences.
+
+1.  Anthropomorphize it: What is its greatest fear? Dream job? Spirit animal?
+2.  Surprising fact: A historical, cultural, or scientific tidbit.
+3.  Mindful eating nudge: Focus on its texture, taste, or color.
+4.  A funny or interesting quote from the food or obect's perspective.
+5.  Emoji story: 3-5 emojis that capture its essence (just the emojis).
+6.  Haiku: A 5-7-5 poem.
+7.  Theme song: A snippet of a real song that fits its vibe.
+8.  Surprising use: An unusual way to eat or use it.
+9.  Foreign name: Its name in another language, if interesting.
+
+If you cannot identify the object, set the `is_food` field to false, and the `name` field to "???", and set `fun_fact` field to express that you cannot identify the object, in a funny or cute or creative or sassy way.
+"""
+
+# The cheap first tier of the standard path: name the object, nothing else.
+IDENTIFY_PROMPT = """
+You are a food expert. Identify the object in this image.
+If you cannot identify the object, set the `is_food` field to false and the `name` field to "???".
+"""
+
+# The live fallback when no stored fact exists for an identified name.
+FACT_PROMPT = """
+You are a food expert. Provide a fun fact about "{name}".
+The fun fact should be a single, interesting sentence about the object's history, origin, or a mindful eating tip.
+"""
+
+# Define the response schema using standard Python tools.
+RESPONSE_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "is_food": {
+            "type": "boolean",
+            "description": "True if the object is food, otherwise False. If you cannot identify the object, set this to false."
+        },
+        "name": {
+            "type": "string",
+            "description": "The common name of the food or object, e.g. Avocado, Pepperoni Pizza, Oreos, AirPods 3. Put '???' if you cannot identify the object."
+        },
+        "fun_fact": {
+            "type": "string",
+            "description": "Something to tell the user about this food or object. Follow the instructions provided for fun_fact carefully."
+        }
+    },
+    "required": ["is_food", "name", "fun_fact"]
+}
+
+IDENTIFY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "is_food": RESPONSE_SCHEMA["properties"]["is_food"],
+        "name": RESPONSE_SCHEMA["properties"]["name"]
+    },
+    "required": ["is_food", "name"]
+}
+
+FACT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "fun_fact": {
+            "type": "string",
+            "description": "A single, interesting sentence about the food or object."
+        }
+    },
+    "required": ["fun_fact"]
+}
+
+# --- MODEL VARIANTS ---
+# Registered once per instance; the client builds each model and its
+# GenerationConfig on first use and reuses them for every later request.
+# A higher temperature for the special prompt encourages more creative and
+# varied responses. A lower temperature for the standard prompt keeps the
+# facts more consistent.
+STANDARD_VARIANT = "standard"
+SPECIAL_VARIANT = "special"
+
+get_client().register(STANDARD_VARIANT, "gemini-2.0-flash-lite-001", {
+    "temperature": 0.4,
+    "response_mime_type": "application/json",
+    "response_schema": RESPONSE_SCHEMA
+})
+get_client().register(SPECIAL_VARIANT, "gemini-2.5-flash", {
+    "temperature": 1.0,
+    "response_mime_type": "application/json",
+    "response_schema": RESPONSE_SCHEMA
+})
+
+# --- HEDGE ALTERNATES ---
+# When a primary model is slow, model_router sends a duplicate request to its
+# alternate and returns whichever valid response arrives first.
+STANDARD_ALT_VARIANT = "standard_alt"
+SPECIAL_ALT_VARIANT = "special_alt"
+
+get_client().register(STANDARD_ALT_VARIANT, "gemini-2.0-flash-001", {
+    "temperature": 0.4,
+    "response_mime_type": "application/json",
+    "response_schema": RESPONSE_SCHEMA
+})
+get_client().register(SPECIAL_ALT_VARIANT, "gemini-2.0-flash-001", {
+    "temperature": 1.0,
+    "response_mime_type": "application/json",
+    "response_schema": RESPONSE_SCHEMA
+})
+get_router().set_alternate(STANDARD_VARIANT, STANDARD_ALT_VARIANT)
+get_router().set_alternate(SPECIAL_VARIANT, SPECIAL_ALT_VARIANT)
+
+# --- TWO-TIER STANDARD PATH ---
+# For the standard prompt, identify the object with a short, low-temperature
+# call and serve the fun fact from the fact store. Only names missing from the
+# store pay for a (text-only) fact generation. Set ANALYZE_TWO_TIER=0 to go
+# back to a single full generation.
+TWO_TIER_ENABLED = os.environ.get("ANALYZE_TWO_TIER", "1") == "1"
+IDENTIFY_VARIANT = "identify"
+IDENTIFY_ALT_VARIANT = "identify_alt"
+FACT_VARIANT = "fact"
+
+get_client().register(IDENTIFY_VARIANT, "gemini-2.0-flash-lite-001", {
+    "temperature": 0.0,
+    "max_output_tokens": 64,
+    "response_mime_type": "application/json",
+    "response_schema": IDENTIFY_SCHEMA
+})
+get_client().register(IDENTIFY_ALT_VARIANT, "gemini-2.0-flash-001", {
+    "temperature": 0.0,
+    "max_output_tokens": 64,
+    "response_mime_type": "application/json",
+    "response_schema": IDENTIFY_SCHEMA
+})
+get_router().set_alternate(IDENTIFY_VARIANT, IDENTIFY_ALT_VARIANT)
+get_client().register(FACT_VARIANT, "gemini-2.0-flash-lite-001", {
+    "temperature": 0.4,
+    "response_mime_type": "application/json",
+    "response_schema": FACT_SCHEMA
+})
+
+
+def personalization_for(user_profile):
+    """Builds the concise, context-setting sentence for the model."""
+    if not user_profile or not isinstance(user_profile, dict):
+        return ""
+    name = user_profile.get('name', 'the user')
+    pronoun = user_profile.get('pronoun')
+    age = user_profile.get('age')
+
+    pronoun_text = f" (pronoun: {pronoun})" if pronoun else ""
+    age_text = f", age {age}" if age else ""
+
+    return f"This request is for {name}{pronoun_text}{age_text}. Keep this in mind for your response, but you don't have to use it."
+
+
+def select_prompt(is_special, user_profile):
+    """Returns (variant, prompt, personalization_intro) for a request."""
+    personalization_intro = personalization_for(user_profile)
+    base_prompt = SPECIAL_PROMPT if is_special else STANDARD_PROMPT
+    variant = SPECIAL_VARIANT if is_special else STANDARD_VARIANT
+    return variant, personalization_intro + base_prompt, personalization_intro
+
+
+def parse_response(response, schema):
+    """
+    Parses a model response and checks it against the schema's required keys,
+    so the router only accepts responses that honour the output contract.
+    """
+    parsed = json.loads(response.text)
+    missing = [key for key in schema["required"] if key not in parsed]
+    if missing:
+        raise ValueError(f"Model response is missing {missing}")
+    return parsed
+
+
+def generate_analysis(variant, prompt, image_part, hedge=True):
+    """Calls the model (through the hedging router) and returns the parsed response."""
+    return get_router().generate(variant, [image_part, prompt],
+                                 lambda response: parse_response(response, RESPONSE_SCHEMA), hedge=hedge)
+
+
+def generate_two_tier(image_part, hedge=True):
+    """
+    Identifies the object, then takes its fun fact from the fact store,
+    generating (and storing) one only when the store has none.
+
+    Stored facts rotate out to every user who snaps the same food, so they
+    are generated from the name alone, never from a user's profile. The
+    result does not depend on who asked.
+    """
+    identified = get_router().generate(IDENTIFY_VARIANT, [image_part, IDENTIFY_PROMPT],
+                                       lambda response: parse_response(response, IDENTIFY_SCHEMA), hedge=hedge)
+    name = identified.get("name") or "???"
+    is_food = bool(identified.get("is_food"))
+    instrumentation.debug("Identified object.", name=name, is_food=is_food)
+    if name.strip() == "???":
+        return {"is_food": False, "name": "???", "fun_fact": "???"}
+
+    try:
+        store = get_fact_store()
+        with instrumentation.span('fact_lookup'):
+            fun_fact = store.next_fact(name)
+    except Exception as e:
+        print(f"--- [FACTS] Fact store unavailable: {e}")
+        store, fun_fact = None, None
+
+    instrumentation.current().set(fact_source='store' if fun_fact is not None else 'generated')
+    if fun_fact is None:
+        with instrumentation.span('model_call'):
+            response = get_client().generate(FACT_VARIANT, [FACT_PROMPT.format(name=name)])
+        instrumentation.record_usage(response)
+        with instrumentation.span('json_parse'):
+            fun_fact = json.loads(response.text)["fun_fact"]
+        if store is not None:
+            try:
+                with instrumentation.span('fact_write'):
+                    store.add_facts(name, [fun_fact])
+            except Exception as e:
+                print(f"--- [FACTS] Could not store generated fact for '{name}': {e}")
+
+    return {"is_food": is_food, "name": name, "fun_fact": fun_fact}
+
+
+def uses_personalization(variant):
+    """Whether results for `variant` depend on the caller's profile."""
+    return not (variant == STANDARD_VARIANT and TWO_TIER_ENABLED)
+
+
+def analyze_image(variant, prompt, personalization_intro, image_part, hedge=True):
+    """
+    Runs the analysis for a request, using the two-tier path where it applies.
+    With hedge=False no duplicate calls are sent, so each call in flight is one
+    the caller accounted for (batch mode relies on this).
+    """
+    if not uses_personalization(variant):
+        # Facts come from the shared store, so the profile is not used here.
+        return generate_two_tier(image_part, hedge=hedge)
+    return generate_analysis(variant, prompt, image_part, hedge=hedge)
+
+
+def error_payload(e):
+    return {
+        "is_food": False,
+        "name": "???",
+        "fun_fact": f"(×_×;) An error occurred when analyzing this food: {e}"
+    }
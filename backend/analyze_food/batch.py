@@ -0,0 +1,197 @@
+"""
+Batch mode for analyze_food, used to re-analyze stored stickers in bulk
+(e.g. after a prompt or model change).
+
+Request body (JSON):
+    {
+      "items": [
+        {"id": "sticker-1", "image_data": "<base64>"},
+        {"id": "sticker-2", "gcs_uri": "gs://bucket/path/sticker.png"}
+      ],
+      "is_special": false,          # default for items that don't set it
+      "user_profile": {...},        # optional
+      "concurrency": 4              # optional, capped at BATCH_MAX_CONCURRENCY
+    }
+
+Model calls run on a bounded thread pool, and results are streamed back as
+NDJSON in completion order, one line per item:
+    {"index": 0, "id": "sticker-1", "result": {"is_food": ..., "name": ..., "fun_fact": ...}}
+    {"index": 1, "id": "sticker-2", "error": "..."}
+followed by a final {"summary": {...}} line.
+
+Items run on a pool of `concurrency` workers and are handed to it one at a
+time as workers free up. Each item makes its model calls one after another,
+and batch calls are never hedged. Every item also holds one of
+BATCH_MAX_CONCURRENCY slots shared by all batch requests on the instance, so
+parallel batches together never have more model calls in flight than that. If the client disconnects, items not yet started
+are cancelled; only those already running finish.
+
+Batches are admin-only (see BATCH_AUTH). Storage references are handed to the
+model as gs:// URIs, so the function never downloads them, and they must lie
+under BATCH_GCS_PREFIX. Batch runs skip the result cache: they exist to get
+fresh answers.
+"""
+import base64
+import json
+import mimetypes
+import os
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import instrumentation
+from analysis import analyze_image, select_prompt
+from caller_auth import verified_claims
+from gemini_client import get_client
+from image_preprocessing import normalize_image
+
+# --- CONFIGURATION ---
+# Keep this under the Vertex quota for the models in use.
+BATCH_MAX_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY", "8"))
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", "500"))
+# Who may run batches. "firebase": a Firebase ID token carrying the `admin`
+# custom claim or a uid listed in BATCH_ADMIN_UIDS. "iam": the function is
+# deployed with --no-allow-unauthenticated, so Cloud Functions has already
+# checked the caller's invoker role before the request gets here.
+BATCH_AUTH = os.environ.get("BATCH_AUTH", "firebase")
+BATCH_ADMIN_UIDS = {uid.strip() for uid in os.environ.get("BATCH_ADMIN_UIDS", "").split(",") if uid.strip()}
+# gcs_uri items must point at the app's own stickers.
+BATCH_GCS_PREFIX = os.environ.get("BATCH_GCS_PREFIX", "gs://foodjar-462805.firebasestorage.app/stickers/")
+
+
+# Shared by every batch request on this instance.
+_item_slots = threading.BoundedSemaphore(BATCH_MAX_CONCURRENCY)
+
+
+class BatchRequestError(Exception):
+    """A batch request that cannot run as a whole; carries the HTTP status to return."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+
+def authorize_batch(request):
+    """Raises BatchRequestError (401/403) unless the caller may run batches."""
+    if BATCH_AUTH == "iam":
+        return
+    claims = verified_claims(request)
+    if claims is None:
+        raise BatchRequestError("A valid Firebase ID token is required.", 401)
+    if not (claims.get('admin') is True or claims.get('uid') in BATCH_ADMIN_UIDS):
+        raise BatchRequestError("Batch analysis is limited to admins.", 403)
+
+
+def parse_batch_request(request_json):
+    """Validates the batch body. Returns (items, defaults, concurrency)."""
+    if not request_json or not isinstance(request_json.get('items'), list):
+        raise BatchRequestError("Invalid request. Missing 'items' list.")
+    items = request_json['items']
+    if not items:
+        raise BatchRequestError("Invalid request. 'items' is empty.")
+    if len(items) > BATCH_MAX_ITEMS:
+        raise BatchRequestError(f"Too many items: {len(items)} > {BATCH_MAX_ITEMS}.")
+
+    try:
+        requested = int(request_json.get('concurrency', BATCH_MAX_CONCURRENCY))
+    except (TypeError, ValueError):
+        requested = BATCH_MAX_CONCURRENCY
+    concurrency = max(1, min(requested, BATCH_MAX_CONCURRENCY, len(items)))
+
+    defaults = {
+        "is_special": bool(request_json.get('is_special', False)),
+        "user_profile": request_json.get('user_profile'),
+    }
+    return items, defaults, concurrency
+
+
+def _image_part_for(item):
+    gemini = get_client()
+    if item.get('gcs_uri'):
+        uri = item['gcs_uri']
+        if not uri.startswith(BATCH_GCS_PREFIX):
+            raise ValueError(f"'gcs_uri' must start with {BATCH_GCS_PREFIX}")
+        mime_type = item.get('mime_type') or mimetypes.guess_type(uri)[0] or "image/png"
+        return gemini.uri_part(uri, mime_type)
+    if item.get('image_data'):
+        normalized = normalize_image(base64.b64decode(item['image_data']))
+        return gemini.image_part(normalized.data, normalized.mime_type)
+    raise ValueError("Item needs 'image_data' or 'gcs_uri'.")
+
+
+def analyze_item(index, item, defaults):
+    """Analyzes one item. Never raises; errors become part of the result line."""
+    item_id = item.get('id', index) if isinstance(item, dict) else index
+    try:
+        if not isinstance(item, dict):
+            raise ValueError("Item must be an object.")
+        is_special = bool(item.get('is_special', defaults['is_special']))
+        variant, prompt, personalization_intro = select_prompt(is_special, defaults['user_profile'])
+        result = analyze_image(variant, prompt, personalization_intro, _image_part_for(item), hedge=False)
+        return {"index": index, "id": item_id, "result": result}
+    except Exception as e:
+        instrumentation.debug("Batch item failed.", item=item_id, error=str(e))
+        return {"index": index, "id": item_id, "error": str(e)}
+
+
+def _traced_item(trace, index, item, defaults):
+    with trace.activate():
+        with trace.span('slot_wait'):
+            _item_slots.acquire()
+        try:
+            with trace.span('item'):
+                return analyze_item(index, item, defaults)
+        finally:
+            _item_slots.release()
+
+
+def stream_batch(items, defaults, concurrency):
+    """
+    Yields one NDJSON line per item as it completes, then a summary line.
+    The batch's trace record is emitted when the stream ends.
+    """
+    trace = instrumentation.start_trace('analyze_food_batch')
+    started = time.perf_counter()
+    succeeded = failed = 0
+    queued = enumerate(items)
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+
+    def submit_next():
+        entry = next(queued, None)
+        if entry is None:
+            return set()
+        index, item = entry
+        return {executor.submit(_traced_item, trace, index, item, defaults)}
+
+    try:
+        pending = set()
+        for _ in range(concurrency):
+            pending |= submit_next()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                # Refill before yielding, so the worker is not idle while the client reads.
+                pending |= submit_next()
+                line = future.result()
+                if "error" in line:
+                    failed += 1
+                else:
+                    succeeded += 1
+                yield json.dumps(line) + "\n"
+
+        elapsed = time.perf_counter() - started
+        summary = {
+            "items": len(items),
+            "succeeded": succeeded,
+            "failed": failed,
+            "concurrency": concurrency,
+            "elapsed_seconds": round(elapsed, 3),
+        }
+        trace.set(**summary)
+        yield json.dumps({"summary": summary}) + "\n"
+    except GeneratorExit:
+        trace.set(client_disconnected=True, succeeded=succeeded, failed=failed)
+        raise
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        trace.finish(status=200)
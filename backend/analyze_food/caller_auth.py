@@ -0,0 +1,42 @@
+"""
+Caller authentication for analyze_food.
+
+`verified_claims` checks a Firebase ID token sent as `Authorization: Bearer
+<token>` and returns its decoded claims, or None when there is no token or it
+does not verify. Only claims from a verified token are trusted; headers such
+as X-User-Id are not.
+
+The Admin SDK caches Google's signing keys, so after the first request a
+check is a local signature verification, not a network call.
+"""
+import threading
+
+_init_lock = threading.Lock()
+
+
+def bearer_token(request):
+    header = request.headers.get('Authorization', '')
+    return header[len('Bearer '):].strip() if header.startswith('Bearer ') else None
+
+
+def _auth():
+    import firebase_admin
+    from firebase_admin import auth
+
+    with _init_lock:
+        try:
+            firebase_admin.get_app()
+        except ValueError:
+            firebase_admin.initialize_app()
+    return auth
+
+
+def verified_claims(request):
+    """Returns the claims of the request's Firebase ID token, or None."""
+    token = bearer_token(request)
+    if not token:
+        return None
+    try:
+        return _auth().verify_id_token(token)
+    except Exception:
+        return None
@@ -0,0 +1,173 @@
+"""
+Pre-generated fun facts, keyed by normalized food name.
+
+The standard prompt mostly sees the same foods over and over, so instead of
+generating a fact on every request we identify the food cheaply and serve one
+of several stored facts for it, rotating between them. Facts are written by
+the offline `fact_store_backfill.py` job (and by live generation on a miss).
+
+Stores:
+  - FACT_STORE=firestore  -> the `food_facts` collection, one document per name
+  - FACT_STORE=file       -> a local JSON file (FACT_STORE_FILE), for testing
+Reads go through a small in-process cache so a warm instance does not hit
+Firestore for every popular food.
+"""
+import itertools
+import json
+import os
+import re
+import threading
+import time
+
+# --- CONFIGURATION ---
+FACT_STORE = os.environ.get("FACT_STORE", "firestore")
+FACT_STORE_FILE = os.environ.get("FACT_STORE_FILE", "/tmp/food_facts.json")
+FIRESTORE_COLLECTION = "food_facts"
+LOCAL_TTL_SECONDS = int(os.environ.get("FACT_STORE_LOCAL_TTL_SECONDS", "3600"))
+MAX_FACTS_PER_FOOD = 10
+
+
+def normalize_name(name):
+    """'  Pepperoni   Pizza! ' -> 'pepperoni pizza'. Returns '' for unknowns."""
+    if not name or name.strip() == "???":
+        return ""
+    name = re.sub(r"[^\w\s&'-]", " ", name.casefold())
+    return re.sub(r"\s+", " ", name).strip()
+
+
+def _document_id(normalized):
+    # Firestore document IDs cannot contain '/'.
+    return normalized.replace("/", "-")
+
+
+class LocalFileFactStore:
+    """Fact store backed by a JSON file: {normalized_name: [fact, ...]}."""
+
+    def __init__(self, path=FACT_STORE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get_facts(self, normalized):
+        with self._lock:
+            return self._load().get(normalized, [])
+
+    def add_facts(self, normalized, display_name, facts):
+        with self._lock:
+            data = self._load()
+            existing = data.get(normalized, [])
+            data[normalized] = (existing + [f for f in facts if f not in existing])[:MAX_FACTS_PER_FOOD]
+            with open(self.path, "w") as f:
+                json.dump(data, f)
+
+
+class FirestoreFactStore:
+    """
+    Fact store backed by Firestore: food_facts/{normalized} = {name, facts}.
+    Facts are merged in a transaction and capped at MAX_FACTS_PER_FOOD, like
+    the file store, so live fallbacks cannot grow a document without bound.
+    """
+
+    def __init__(self, collection=FIRESTORE_COLLECTION):
+        from google.cloud import firestore
+        self._firestore = firestore
+        self._client = firestore.Client()
+        self.collection = self._client.collection(collection)
+
+    def get_facts(self, normalized):
+        snapshot = self.collection.document(_document_id(normalized)).get()
+        facts = (snapshot.to_dict() or {}).get("facts", []) if snapshot.exists else []
+        return facts[:MAX_FACTS_PER_FOOD]
+
+    def add_facts(self, normalized, display_name, facts):
+        ref = self.collection.document(_document_id(normalized))
+
+        @self._firestore.transactional
+        def merge(transaction):
+            snapshot = ref.get(transaction=transaction)
+            existing = (snapshot.to_dict() or {}).get("facts", []) if snapshot.exists else []
+            merged = (existing + [f for f in facts if f not in existing])[:MAX_FACTS_PER_FOOD]
+            if merged != existing or not snapshot.exists:
+                transaction.set(ref, {"name": display_name, "facts": merged}, merge=True)
+
+        merge(self._client.transaction())
+
+
+class FactStore:
+    """Read-through in-process cache plus round-robin rotation over a backing store."""
+
+    def __init__(self, backend, ttl_seconds=LOCAL_TTL_SECONDS):
+        self.backend = backend
+        self.ttl_seconds = ttl_seconds
+        self._local = {}
+        self._rotation = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _facts_for(self, normalized):
+        now = time.time()
+        with self._lock:
+            cached = self._local.get(normalized)
+            if cached and cached[0] > now:
+                return cached[1]
+        facts = self.backend.get_facts(normalized)
+        with self._lock:
+            self._local[normalized] = (now + self.ttl_seconds, facts)
+        return facts
+
+    def next_fact(self, name):
+        """Returns the next stored fact for `name`, or None if there is none."""
+        normalized = normalize_name(name)
+        if not normalized:
+            return None
+        try:
+            facts = self._facts_for(normalized)
+        except Exception as e:
+            print(f"--- [FACTS] Fact store lookup failed for '{normalized}': {e}")
+            facts = []
+        with self._lock:
+            if not facts:
+                self.misses += 1
+                return None
+            self.hits += 1
+            counter = self._rotation.setdefault(normalized, itertools.count())
+            return facts[next(counter) % len(facts)]
+
+    def add_facts(self, name, facts):
+        normalized = normalize_name(name)
+        if not normalized or not facts:
+            return
+        self.backend.add_facts(normalized, name, facts)
+        with self._lock:
+            self._local.pop(normalized, None)
+
+    def stats(self):
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses}
+
+
+def _build_backend():
+    if FACT_STORE == "file":
+        return LocalFileFactStore()
+    return FirestoreFactStore()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_fact_store():
+    """Returns the per-instance fact store, creating it on first call."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = FactStore(_build_backend())
+    return _store
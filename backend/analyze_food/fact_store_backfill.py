@@ -0,0 +1,115 @@
+"""
+Offline job that fills the fact store for the most frequently snapped foods.
+
+Counts normalized sticker names across every user's `stickers` subcollection
+and the stickers embedded in archived `jars`, then generates several facts for
+each of the top names that does not have enough yet. Run it as a one-off or
+scheduled job from this directory:
+
+    python fact_store_backfill.py --top 500 --facts-per-food 5 --concurrency 8
+
+Use --dry-run to print the top names without generating anything.
+"""
+import argparse
+import json
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from fact_store import get_fact_store, normalize_name
+from gemini_client import get_client
+
+BULK_FACTS_VARIANT = "facts_bulk"
+
+BULK_FACTS_PROMPT = """
+You are a food expert. Write {count} different fun facts about "{name}".
+Each fun fact should be a single, interesting sentence about its history, origin, or a mindful eating tip.
+"""
+
+BULK_FACTS_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "facts": {
+            "type": "array",
+            "items": {"type": "string"},
+            "description": "Distinct one-sentence fun facts."
+        }
+    },
+    "required": ["facts"]
+}
+
+get_client().register(BULK_FACTS_VARIANT, "gemini-2.0-flash-lite-001", {
+    "temperature": 0.9,
+    "response_mime_type": "application/json",
+    "response_schema": BULK_FACTS_SCHEMA
+})
+
+
+def count_food_names():
+    """Returns a Counter of normalized name -> times seen, and a display name per key."""
+    from google.cloud import firestore
+    db = firestore.Client()
+    counts = Counter()
+    display_names = {}
+
+    def add(name, is_food):
+        normalized = normalize_name(name)
+        if normalized and is_food:
+            counts[normalized] += 1
+            display_names.setdefault(normalized, name.strip())
+
+    for doc in db.collection_group('stickers').select(['name', 'isFood']).stream():
+        data = doc.to_dict()
+        add(data.get('name'), data.get('isFood'))
+
+    for doc in db.collection('jars').select(['stickers']).stream():
+        for sticker in doc.to_dict().get('stickers') or []:
+            add(sticker.get('name'), sticker.get('isFood'))
+
+    return counts, display_names
+
+
+def generate_facts(name, count):
+    prompt = BULK_FACTS_PROMPT.format(name=name, count=count)
+    response = get_client().generate(BULK_FACTS_VARIANT, [prompt])
+    facts = json.loads(response.text).get("facts", [])
+    return [fact.strip() for fact in facts if fact and fact.strip()]
+
+
+def backfill(top, facts_per_food, concurrency, dry_run=False):
+    counts, display_names = count_food_names()
+    store = get_fact_store()
+    targets = []
+    for normalized, seen in counts.most_common(top):
+        existing = store.backend.get_facts(normalized)
+        missing = facts_per_food - len(existing)
+        print(f"{seen:6d}  {normalized!r}: {len(existing)} stored facts")
+        if missing > 0:
+            targets.append((display_names[normalized], missing))
+
+    print(f"--- {len(targets)} of the top {top} names need facts.")
+    if dry_run or not targets:
+        return
+
+    written = 0
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(generate_facts, name, missing): name for name, missing in targets}
+        for future in as_completed(futures):
+            name = futures[future]
+            try:
+                facts = future.result()
+                store.add_facts(name, facts)
+                written += len(facts)
+                print(f"--- Stored {len(facts)} facts for '{name}'.")
+            except Exception as e:
+                print(f"!!! Could not generate facts for '{name}': {e}")
+    print(f"--- Backfill complete. {written} facts written.")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--top", type=int, default=500, help="How many of the most frequent names to cover.")
+    parser.add_argument("--facts-per-food", type=int, default=5, help="How many facts to keep per name.")
+    parser.add_argument("--concurrency", type=int, default=8, help="Concurrent model calls.")
+    parser.add_argument("--dry-run", action="store_true", help="Only print the top names.")
+    args = parser.parse_args()
+    backfill(args.top, args.facts_per_food, args.concurrency, args.dry_run)
@@ -0,0 +1,245 @@
+"""
+Warm-instance Gemini client.
+
+Cloud Functions reuses an instance across many requests, so anything built at
+module scope is paid for once per instance instead of once per request. This
+module initializes Vertex AI a single time and builds each model and its
+GenerationConfig a single time per registered variant, then hands the same
+objects to every request.
+
+Each function directory is deployed as its own source bundle, so this file is
+vendored into both `analyze_food/` and `generate_report/`. Keep the copies
+identical.
+
+The backend is pluggable. Set GEMINI_BACKEND=stub to swap Vertex for a local
+stub that answers in-process, e.g. when running the functions locally.
+"""
+import json
+import os
+import random
+import threading
+import time
+
+# --- CONFIGURATION ---
+PROJECT_ID = "foodjar-462805"
+LOCATION = "us-central1"
+
+
+class VertexBackend:
+    """Sends requests to Gemini through the Vertex AI SDK."""
+
+    name = "vertex"
+
+    def __init__(self, project=PROJECT_ID, location=LOCATION):
+        self.project = project
+        self.location = location
+
+    def initialize(self):
+        import vertexai
+        print(f"--- Initializing Vertex AI (project={self.project}, location={self.location}) ---")
+        vertexai.init(project=self.project, location=self.location)
+
+    def build_model(self, model_name):
+        from vertexai.generative_models import GenerativeModel
+        return GenerativeModel(model_name)
+
+    def build_config(self, config):
+        # When using preview models, it's safer to construct the config object
+        # explicitly rather than passing a raw dict to generate_content.
+        from vertexai.generative_models import GenerationConfig
+        return GenerationConfig.from_dict(config) if config else None
+
+    def image_part(self, data, mime_type):
+        from vertexai.generative_models import Part
+        return Part.from_data(data=data, mime_type=mime_type)
+
+    def uri_part(self, uri, mime_type):
+        from vertexai.generative_models import Part
+        return Part.from_uri(uri=uri, mime_type=mime_type)
+
+    def generate(self, model, contents, config, stream=False):
+        return model.generate_content(contents, generation_config=config, stream=stream)
+
+
+class StubResponse:
+    """Mimics the parts of a Vertex response the functions read."""
+
+    def __init__(self, text):
+        self.text = text
+        self.usage_metadata = None
+
+
+class StubQuotaError(Exception):
+    """What the stub raises for an injected error; handled like Vertex's ResourceExhausted."""
+
+    code = 429
+
+
+class StubBackend:
+    """
+    Local stand-in for Vertex. Answers every request in-process.
+
+    `responder(model_name, contents, config)` returns the response text. By
+    default, schema-constrained variants get a minimal JSON object that
+    satisfies the schema and free-text variants get a fixed sentence.
+
+    Each call takes `latency_seconds` (log-normally spread by `latency_jitter`,
+    so some calls land in the tail), plus the time to produce the response at
+    `output_chars_per_second` if set, and fails with StubQuotaError with
+    probability `error_rate`.
+    """
+
+    name = "stub"
+
+    def __init__(self, responder=None, latency_seconds=0.0, latency_jitter=0.0, output_chars_per_second=None,
+                 error_rate=0.0, seed=None):
+        self.responder = responder or _default_stub_response
+        self.latency_seconds = latency_seconds
+        self.latency_jitter = latency_jitter
+        self.output_chars_per_second = output_chars_per_second
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def initialize(self):
+        print("--- Using local Gemini stub backend ---")
+
+    def build_model(self, model_name):
+        return model_name
+
+    def build_config(self, config):
+        return dict(config or {})
+
+    def image_part(self, data, mime_type):
+        return {"mime_type": mime_type, "data": data}
+
+    def uri_part(self, uri, mime_type):
+        return {"mime_type": mime_type, "uri": uri}
+
+    def generate(self, model, contents, config, stream=False):
+        with self._lock:
+            latency = self.latency_seconds
+            if latency and self.latency_jitter:
+                latency *= self.random.lognormvariate(0, self.latency_jitter)
+            failed = self.random.random() < self.error_rate
+        if failed:
+            if latency:
+                time.sleep(latency)
+            raise StubQuotaError(f"Injected stub error from {model}.")
+        text = self.responder(model, contents, config)
+        if self.output_chars_per_second:
+            latency += len(text) / self.output_chars_per_second
+        if latency:
+            time.sleep(latency)
+        if stream:
+            return iter([StubResponse(text)])
+        return StubResponse(text)
+
+
+def _default_stub_response(model_name, contents, config):
+    schema = (config or {}).get("response_schema")
+    if not schema:
+        return f"This is a stub response from {model_name}."
+    payload = {}
+    for key, spec in schema.get("properties", {}).items():
+        if spec.get("type") == "boolean":
+            payload[key] = True
+        elif spec.get("type") == "array":
+            payload[key] = [f"Stub {key} {i}" for i in range(1, 4)]
+        else:
+            payload[key] = f"Stub {key}"
+    return json.dumps(payload)
+
+
+class GeminiClient:
+    """
+    Holds one backend plus the pre-built model and config for every variant.
+
+    Variants are registered cheaply at import time; the backend is initialized
+    and the objects are built on first use (or by `warm()`), then reused.
+    """
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._variants = {}
+        self._built = {}
+        self._initialized = False
+        self._lock = threading.Lock()
+
+    def register(self, variant, model_name, generation_config=None):
+        """Registers (or replaces) a named model/config pair."""
+        with self._lock:
+            self._variants[variant] = (model_name, generation_config)
+            self._built.pop(variant, None)
+
+    def model_name(self, variant):
+        return self._variants[variant][0]
+
+    def _ensure_initialized(self):
+        if not self._initialized:
+            self.backend.initialize()
+            self._initialized = True
+
+    def _get(self, variant):
+        built = self._built.get(variant)
+        if built is not None:
+            return built
+        with self._lock:
+            if variant not in self._built:
+                self._ensure_initialized()
+                model_name, config = self._variants[variant]
+                self._built[variant] = (
+                    self.backend.build_model(model_name),
+                    self.backend.build_config(config),
+                )
+            return self._built[variant]
+
+    def warm(self):
+        """Initializes the backend and builds every registered variant now."""
+        for variant in list(self._variants):
+            self._get(variant)
+
+    def image_part(self, data, mime_type):
+        with self._lock:
+            self._ensure_initialized()
+        return self.backend.image_part(data, mime_type)
+
+    def uri_part(self, uri, mime_type):
+        """A part the model reads straight from Cloud Storage (gs://...)."""
+        with self._lock:
+            self._ensure_initialized()
+        return self.backend.uri_part(uri, mime_type)
+
+    def generate(self, variant, contents, stream=False):
+        model, config = self._get(variant)
+        return self.backend.generate(model, contents, config, stream=stream)
+
+
+_BACKENDS = {
+    "vertex": VertexBackend,
+    "stub": StubBackend,
+}
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """Returns the per-instance client, creating it on first call."""
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                backend_name = os.environ.get("GEMINI_BACKEND", "vertex")
+                _client = GeminiClient(_BACKENDS[backend_name]())
+    return _client
+
+
+def set_backend(backend):
+    """Replaces the backend (e.g. with a configured StubBackend) for this instance."""
+    global _client
+    with _client_lock:
+        variants = dict(_client._variants) if _client else {}
+        _client = GeminiClient(backend)
+        _client._variants.update(variants)
+    return _client
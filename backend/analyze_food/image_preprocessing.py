@@ -0,0 +1,109 @@
+"""
+Server-side image normalization for analyze_food.
+
+The app uploads full-resolution PNG stickers with a transparent background.
+Before the Vertex call the image is decoded once, downsized so its longest
+edge is at most MAX_EDGE pixels, flattened onto a solid background and
+re-encoded as a compact JPEG (or WebP). The model sees a much smaller input,
+which cuts upload time, input-token cost and latency.
+
+If the bytes cannot be decoded they are passed through unchanged with the
+sniffed MIME type, so a bad image still reaches the model exactly as before.
+"""
+import io
+import os
+import time
+
+# --- CONFIGURATION ---
+MAX_EDGE = int(os.environ.get("ANALYZE_IMAGE_MAX_EDGE", "768"))
+OUTPUT_FORMAT = os.environ.get("ANALYZE_IMAGE_FORMAT", "JPEG").upper()
+QUALITY = int(os.environ.get("ANALYZE_IMAGE_QUALITY", "85"))
+BACKGROUND_COLOR = (255, 255, 255)
+
+_MIME_TYPES = {
+    "JPEG": "image/jpeg",
+    "WEBP": "image/webp",
+}
+
+
+def sniff_mime_type(data):
+    """Identifies the real image format from its magic bytes."""
+    if data.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image/png"
+    if data.startswith(b"\xff\xd8\xff"):
+        return "image/jpeg"
+    if data[:4] == b"RIFF" and data[8:12] == b"WEBP":
+        return "image/webp"
+    if data[:6] in (b"GIF87a", b"GIF89a"):
+        return "image/gif"
+    if data[4:8] == b"ftyp" and data[8:12] in (b"heic", b"heix", b"mif1", b"msf1"):
+        return "image/heic"
+    return None
+
+
+class NormalizedImage:
+    """The bytes to send to the model, plus the decoded image and size stats."""
+
+    def __init__(self, data, mime_type, image=None, stats=None):
+        self.data = data
+        self.mime_type = mime_type
+        self.image = image
+        self.stats = stats or {}
+
+
+def normalize_image(data, max_edge=MAX_EDGE, output_format=OUTPUT_FORMAT, quality=QUALITY):
+    """
+    Decodes, downsizes, flattens and re-encodes an image.
+    Returns a NormalizedImage; `image` is the decoded PIL image (or None).
+    """
+    started = time.perf_counter()
+    source_mime = sniff_mime_type(data) or "image/png"
+    stats = {
+        "source_mime_type": source_mime,
+        "bytes_in": len(data),
+        "bytes_out": len(data),
+    }
+
+    try:
+        from PIL import Image, ImageOps
+        image = Image.open(io.BytesIO(data))
+        image.load()
+    except Exception as e:
+        print(f"--- [IMAGE] Could not decode image, passing through as {source_mime}: {e}")
+        return NormalizedImage(data, source_mime, stats=stats)
+
+    stats["pixels_in"] = image.width * image.height
+
+    # Respect camera orientation before resizing.
+    image = ImageOps.exif_transpose(image)
+    image.thumbnail((max_edge, max_edge), Image.LANCZOS)
+
+    # Stickers have a transparent background; flatten it onto a solid color.
+    if image.mode in ("RGBA", "LA") or (image.mode == "P" and "transparency" in image.info):
+        rgba = image.convert("RGBA")
+        flattened = Image.new("RGB", rgba.size, BACKGROUND_COLOR)
+        flattened.paste(rgba, mask=rgba.getchannel("A"))
+        image = flattened
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+
+    buffer = io.BytesIO()
+    image.save(buffer, format=output_format, quality=quality)
+    encoded = buffer.getvalue()
+
+    pixels_out = image.width * image.height
+    mime_type = _MIME_TYPES.get(output_format, "image/jpeg")
+
+    # Never send something bigger than what we were given.
+    if len(encoded) >= len(data) and pixels_out >= stats["pixels_in"]:
+        encoded, mime_type = data, source_mime
+
+    stats.update({
+        "mime_type": mime_type,
+        "bytes_out": len(encoded),
+        "pixels_out": pixels_out,
+        "byte_reduction": round(1 - len(encoded) / len(data), 4) if data else 0.0,
+        "pixel_reduction": round(1 - pixels_out / stats["pixels_in"], 4),
+        "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+    })
+    return NormalizedImage(encoded, mime_type, image=image, stats=stats)
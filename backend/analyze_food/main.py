@@ -1,54 +1,51 @@
+# Imported first so the startup report times the whole module load.
+import startup
+
 import functions_framework
-import vertexai
-import base64
 import json
-import traceback
-from vertexai.generative_models import GenerativeModel, Part, GenerationConfig
-
-# --- CONFIGURATION ---
-PROJECT_ID = "foodjar-462805" 
-LOCATION = "us-central1"
-
-# --- PROMPTS ---
-STANDARD_PROMPT = """
-You are a food expert. Analyze the object in this image. Identify it and provide a fun fact about it.
-The fun fact should be a single, interesting sentence about the object's history, origin, or a mindful eating tip.
-If you cannot identify the object, set the `is_food` field to false, and the `name` and `fun_fact` fields to "???".
-"""
-
-SPECIAL_PROMPT = """
-You are a food expert and a whimsical genius. Analyze the object in this image and provide a creative, fun response based on ONE of the following ideas. Do not use more than one idea. Keep your response to 2-3 short sentences.
-
-1.  Anthropomorphize it: What is its greatest fear? Dream job? Spirit animal?
-2.  Surprising fact: A historical, cultural, or scientific tidbit.
-3.  Mindful eating nudge: Focus on its texture, taste, or color.
-4.  A funny or interesting quote from the food or obect's perspective.
-5.  Emoji story: 3-5 emojis that capture its essence (just the emojis).
-6.  Haiku: A 5-7-5 poem.
-7.  Theme song: A snippet of a real song that fits its vibe.
-8.  Surprising use: An unusual way to eat or use it.
-9.  Foreign name: Its name in another language, if interesting.
-
-If you cannot identify the object, set the `is_food` field to false, and the `name` field to "???", and set `fun_fact` field to express that you cannot identify the object, in a funny or cute or creative or sassy way.
-"""
+import logging
+import os
+
+from flask import Response, stream_with_context
+
+from admission import Rejected, caller_identity, get_admission_controller
+from analysis import analyze_image, error_payload, select_prompt, uses_personalization
+from batch import BatchRequestError, authorize_batch, parse_batch_request, stream_batch
+from fact_store import get_fact_store
+from gemini_client import get_client
+from image_preprocessing import normalize_image
+import instrumentation
+from model_router import get_router
+from request_parsing import OPTION_HEADERS, UploadError, parse_analyze_request
+import result_cache
+
+# --- RESULT CACHE ---
+# Standard-prompt results are served from the cache when the same (or a nearly
+# identical) image is seen again. Special-prompt results are meant to be random,
+# so they bypass the cache unless ANALYZE_CACHE_SPECIAL=1.
+CACHE_SPECIAL = os.environ.get("ANALYZE_CACHE_SPECIAL", "0") == "1"
+
+# Sent as Retry-After when Vertex reports exhausted quota.
+QUOTA_RETRY_AFTER_SECONDS = 5
 
 @functions_framework.http
+@instrumentation.traced('analyze_food')
 def analyze_food(request):
     """
     HTTP Cloud Function to analyze a food image using Gemini Pro Vision.
     Expects a JSON payload with an "image_data" key (base64-encoded image)
-    and an optional "is_special" boolean flag.
+    and an optional "is_special" boolean flag, or the raw image as an
+    application/octet-stream or multipart/form-data body (see request_parsing).
+    Each request emits one structured trace record (see instrumentation.py).
     """
-    print("--- analyze_food function execution started ---")
-    # --- FIX: Initialize Vertex AI on first request ---
+    trace = instrumentation.current()
+    # The client initializes Vertex AI once per instance; later requests reuse it.
+    gemini = get_client()
     try:
-        print("Initializing Vertex AI...")
-        print(f"--- Explicitly using LOCATION: {LOCATION} ---")
-        vertexai.init(project=PROJECT_ID, location=LOCATION)
-        print("Vertex AI initialized successfully.")
+        gemini.warm()
     except Exception as e:
         # If initialization fails, it's likely a config/permissions issue.
-        print(f"!!! Vertex AI initialization failed: {e}")
+        trace.set(error=f"Vertex AI initialization failed: {e}")
         return (json.dumps({"error": f"Vertex AI initialization failed: {e}"}), 500, {'Access-Control-Allow-Origin': '*'})
 
     # Set CORS headers to allow requests from any origin.
@@ -57,109 +54,165 @@ def analyze_food(request):
         headers = {
             'Access-Control-Allow-Origin': '*',
             'Access-Control-Allow-Methods': 'POST',
-            'Access-Control-Allow-Headers': 'Content-Type',
+            'Access-Control-Allow-Headers': ', '.join(['Content-Type', 'Authorization'] + OPTION_HEADERS),
             'Access-Control-Max-Age': '3600'
         }
         return ('', 204, headers)
 
     headers = { 'Access-Control-Allow-Origin': '*' }
 
-    # --- 1. Parse and Validate the Request ---
-    request_json = request.get_json(silent=True)
-    print(f"DEBUG: Received request payload: {request_json is not None}")
-    if not request_json or 'image_data' not in request_json:
-        print("ERROR: Invalid request, 'image_data' missing or payload is null.")
-        return (json.dumps({"error": "Invalid request. Missing 'image_data' key."}), 400, headers)
-
+    # A plain GET exposes this instance's cache, fact store, routing and admission counters.
+    if request.method == 'GET':
+        return (json.dumps({
+            "cache": result_cache.get_cache().stats(),
+            "facts": get_fact_store().stats(),
+            "routing": get_router().stats(),
+            "admission": get_admission_controller().stats(),
+        }), 200, headers)
+
+    # --- 0. Admission Control ---
+    # Under a spike, reject fast with 429 + Retry-After rather than piling
+    # more concurrent calls onto Vertex.
+    admission = get_admission_controller()
     try:
-        image_content = base64.b64decode(request_json['image_data'])
-    except (TypeError, ValueError) as e:
-        print(f"ERROR: Invalid base64 data: {e}")
-        return (json.dumps({"error": f"Invalid base64 data: {e}"}), 400, headers)
-
-    # --- 2. Personalize the Prompt ---
-    user_profile = request_json.get('user_profile')
-    personalization_intro = ""
-    if user_profile and isinstance(user_profile, dict):
-        # Construct a concise, context-setting sentence for the model.
-        name = user_profile.get('name', 'the user')
-        pronoun = user_profile.get('pronoun')
-        age = user_profile.get('age')
-        
-        pronoun_text = f" (pronoun: {pronoun})" if pronoun else ""
-        age_text = f", age {age}" if age else ""
-        
-        personalization_intro = f"This request is for {name}{pronoun_text}{age_text}. Keep this in mind for your response, but you don't have to use it."
-
-    # --- 3. Select Prompt and Call Gemini ---
-    is_special = request_json.get('is_special', False)
-    base_prompt = SPECIAL_PROMPT if is_special else STANDARD_PROMPT
-    prompt = personalization_intro + base_prompt
-    print(f"DEBUG: Using {'SPECIAL' if is_special else 'STANDARD'} prompt.")
-    print(f"DEBUG: using prompt: {prompt}")
-
-    # Set a higher temperature for the special prompt to encourage more creative and varied responses.
-    # A lower temperature for the standard prompt keeps the facts more consistent.
-    temperature = 1.0 if is_special else 0.4
-
-    # Define the response schema using standard Python tools.
-    response_schema={
-        "type": "object",
-        "properties": {
-            "is_food": {
-                "type": "boolean",
-                "description": "True if the object is food, otherwise False. If you cannot identify the object, set this to false."
-            },
-            "name": {
-                "type": "string",
-                "description": "The common name of the food or object, e.g. Avocado, Pepperoni Pizza, Oreos, AirPods 3. Put '???' if you cannot identify the object."
-            },
-            "fun_fact": {
-                "type": "string",
-                "description": "Something to tell the user about this food or object. Follow the instructions provided for fun_fact carefully."
-            }
-        },
-        "required": ["is_food", "name", "fun_fact"]
-    }
-    
-    # --- FIX: Manually construct GenerationConfig ---
-    # When using preview models, it's safer to construct the config object
-    # explicitly rather than relying on the dictionary conversion, which might
-    # have compatibility issues with newer, rapidly changing models.
-    generation_config_obj = GenerationConfig.from_dict({
-        "temperature": temperature,
-        "response_mime_type": "application/json",
-        "response_schema": response_schema
-    })
-    print(f"DEBUG: Using generation config: {generation_config_obj}")
-    
-    model = GenerativeModel("gemini-2.5-flash") if is_special else GenerativeModel("gemini-2.0-flash-lite-001")
+        ticket = admission.admit(caller_identity(request))
+    except Rejected as e:
+        trace.set(rejected=e.reason, admission=admission.stats())
+        return (json.dumps({"error": "Too many requests. Please retry shortly.", "reason": e.reason}),
+                429, {**headers, 'Retry-After': str(e.retry_after)})
+    headers['X-Queue-Wait-Ms'] = str(round(ticket.waited * 1000))
+    trace.add_span('admission_wait', ticket.waited * 1000)
+
+    with ticket:
+        return _analyze(request, gemini, headers)
+
+
+def is_quota_error(e):
+    """Vertex signals exhausted quota with ResourceExhausted (HTTP 429)."""
+    return type(e).__name__ in ("ResourceExhausted", "TooManyRequests") or getattr(e, "code", None) == 429
+
 
-    image_part = Part.from_data(data=image_content, mime_type="image/png")
+def _normalize(image_content, trace):
+    """Normalizes the image: real format, bounded size, no transparency."""
+    with trace.span('normalize'):
+        normalized = normalize_image(image_content)
+    trace.set(image=normalized.stats)
+    return normalized
+
+
+def _analyze(request, gemini, headers):
+    """Parses, checks the cache, normalizes and calls the model for one admitted request."""
+    trace = instrumentation.current()
+    # --- 1. Parse and Validate the Request ---
+    try:
+        with trace.span('parse'):
+            image_content, options = parse_analyze_request(request)
+    except UploadError as e:
+        trace.set(error=e.message)
+        return (json.dumps({"error": e.message}), e.status, headers)
+
+    # --- 2. Personalize and Select the Prompt ---
+    is_special = options['is_special']
+    variant, prompt, personalization_intro = select_prompt(is_special, options['user_profile'])
+    trace.set(variant=variant, image_bytes=len(image_content))
+    trace.debug("Selected prompt.", variant=variant, prompt=prompt)
+
+    # --- Check the result cache before calling the model ---
+    # An exact hit needs only the digest of the bytes as uploaded, so the image
+    # is decoded and normalized (for the perceptual hash and the model) only
+    # after that misses.
+    cache = result_cache.get_cache()
+    use_cache = (CACHE_SPECIAL or not is_special) and options['use_cache']
+    normalized = None
+    if use_cache:
+        digest = result_cache.exact_digest(image_content)
+        cache_context = result_cache.context_key(
+            variant, personalization_intro if uses_personalization(variant) else "")
+        with trace.span('cache_lookup'):
+            cached, hit_kind = cache.lookup_exact(digest, cache_context)
+        if cached is None:
+            normalized = _normalize(image_content, trace)
+            phash = color = None
+            if normalized.image is not None:
+                phash = result_cache.perceptual_hash(normalized.image)
+                color = result_cache.color_signature(normalized.image)
+            with trace.span('cache_lookup'):
+                cached, hit_kind = cache.lookup_near(phash, cache_context, color)
+        if cached is not None:
+            trace.set(cache=hit_kind)
+            return (json.dumps(cached), 200, {**headers, 'X-Cache': hit_kind.upper()})
+        headers['X-Cache'] = 'MISS'
+    else:
+        headers['X-Cache'] = 'BYPASS'
+    trace.set(cache=headers['X-Cache'].lower())
+
+    if normalized is None:
+        normalized = _normalize(image_content, trace)
+    image_part = gemini.image_part(normalized.data, normalized.mime_type)
     
     try:
-        print("DEBUG: Calling model.generate_content...")
-        response = model.generate_content(
-            [image_part, prompt],
-            generation_config=generation_config_obj
-        )
-        print(f"DEBUG: Received response from model. Text length: {len(response.text)}")
-        
-        # --- 3. Parse and Return the Response ---
-        # With a response schema, we can trust the response is valid JSON that matches our structure.
-        parsed_json = json.loads(response.text)
-        print(f"DEBUG: Successfully parsed JSON response: {parsed_json}")
-        
+        # --- 3. Call Gemini, Parse and Return the Response ---
+        # model_call and json_parse spans are recorded by the router.
+        parsed_json = analyze_image(variant, prompt, personalization_intro, image_part)
+        trace.debug("Parsed model response.", response=parsed_json)
+
+        if use_cache:
+            with trace.span('cache_put'):
+                cache.put(digest, phash, cache_context, parsed_json, color)
+
         return (json.dumps(parsed_json), 200, headers)
 
     except Exception as e:
+        if is_quota_error(e):
+            # Vertex is out of quota: tell the client to back off instead of a 500.
+            trace.set(error=f"Vertex quota exhausted: {e}")
+            return (json.dumps({"error": "The analysis service is busy. Please retry shortly."}),
+                    429, {**headers, 'Retry-After': str(QUOTA_RETRY_AFTER_SECONDS)})
         # If anything goes wrong, return a structured error.
-        print(f"!!! AN ERROR OCCURRED DURING ANALYSIS: {e}")
-        print(f"    Exception Type: {type(e)}")
-        print(f"    Traceback: {traceback.format_exc()}")
-        error_payload = {
-            "is_food": False,
-            "name": "???",
-            "fun_fact": f"(×_×;) An error occurred when analyzing this food: {e}"
-        }
-        return (json.dumps(error_payload), 500, headers) 
\ No newline at end of file
+        trace.set(error=f"{type(e).__name__}: {e}")
+        return (json.dumps(error_payload(e)), 500, headers)
+
+
+@functions_framework.http
+def analyze_food_batch(request):
+    """
+    HTTP Cloud Function to re-analyze many images in one call.
+    Model calls run concurrently (bounded by BATCH_MAX_CONCURRENCY) and
+    per-item results stream back as NDJSON. Only admins may call it. See
+    batch.py for the format and BATCH_AUTH.
+    """
+    headers = { 'Access-Control-Allow-Origin': '*' }
+    try:
+        authorize_batch(request)
+    except BatchRequestError as e:
+        return (json.dumps({"error": str(e)}), e.status, headers)
+
+    try:
+        get_client().warm()
+    except Exception as e:
+        logging.error(f"Vertex AI initialization failed: {e}")
+        return (json.dumps({"error": f"Vertex AI initialization failed: {e}"}), 500, headers)
+
+    try:
+        items, defaults, concurrency = parse_batch_request(request.get_json(silent=True))
+    except BatchRequestError as e:
+        return (json.dumps({"error": str(e)}), e.status, headers)
+
+    return Response(
+        stream_with_context(stream_batch(items, defaults, concurrency)),
+        status=200,
+        headers=headers,
+        mimetype='application/x-ndjson'
+    )
+
+
+def _warm_up():
+    """Builds what the first request would otherwise build: models, stores, the image decoder."""
+    get_client().warm()
+    get_fact_store()
+    result_cache.get_cache()
+    from PIL import Image  # noqa: F401  (normalize_image imports it on first use)
+
+
+startup.start_warmup(_warm_up)
+startup.mark_imported()
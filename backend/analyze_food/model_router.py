@@ -0,0 +1,241 @@
+"""
+Latency-aware model routing with hedged requests.
+
+Every successful model call is timed per model into a rolling window, and
+samples older than SAMPLE_MAX_AGE_SECONDS are dropped. When a call has not
+answered by its deadline (the primary model's observed p95 by default), a
+duplicate request is sent to the variant's alternate model, and whichever
+valid, schema-conforming response arrives first wins. If the primary has been
+consistently slower than its alternate, the two swap roles for new requests.
+While swapped, the primary only gets the odd hedge, so its samples age out;
+once it has too few to compare, requests go back to it, which re-measures it
+and either keeps it or swaps again.
+
+The loser cannot be interrupted once its HTTP call is in flight. If it has not
+started yet it is cancelled. Otherwise its result is discarded, and the tokens
+it used are counted as hedging overhead. A running loser keeps its pool thread
+until it answers, which is exactly when the primary is slow. A 3 s primary
+hedged to a 0.3 s alternate leaves about ten losers per admitted request
+running at once, so the pool defaults to 16 x ANALYZE_MAX_CONCURRENT threads
+(created only as needed) rather than queueing new calls behind the losers. The hedge deadline is counted from when the
+primary call starts, not from when it was queued for a thread.
+
+Vertex AI is initialized for a single location per instance, so alternates
+are other models in the same region rather than the same model elsewhere.
+"""
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import instrumentation
+from admission import MAX_CONCURRENT
+from gemini_client import get_client
+
+# --- CONFIGURATION ---
+HEDGE_ENABLED = os.environ.get("ANALYZE_HEDGE", "1") == "1"
+HEDGE_PERCENTILE = float(os.environ.get("ANALYZE_HEDGE_PERCENTILE", "95"))
+# Used until a model has enough samples for a meaningful percentile.
+HEDGE_DEFAULT_DEADLINE_SECONDS = float(os.environ.get("ANALYZE_HEDGE_DEFAULT_DEADLINE_SECONDS", "4.0"))
+HEDGE_MIN_DEADLINE_SECONDS = float(os.environ.get("ANALYZE_HEDGE_MIN_DEADLINE_SECONDS", "1.0"))
+HEDGE_MAX_DEADLINE_SECONDS = float(os.environ.get("ANALYZE_HEDGE_MAX_DEADLINE_SECONDS", "10.0"))
+MIN_SAMPLES = 20
+WINDOW_SIZE = 200
+SAMPLE_MAX_AGE_SECONDS = float(os.environ.get("ANALYZE_ROUTE_SAMPLE_MAX_AGE_SECONDS", "300"))
+# Route to the alternate first when the primary's p50 is this many times slower.
+SWAP_FACTOR = float(os.environ.get("ANALYZE_ROUTE_SWAP_FACTOR", "2.0"))
+POOL_SIZE = int(os.environ.get("ANALYZE_HEDGE_POOL_SIZE", str(16 * MAX_CONCURRENT)))
+
+
+class LatencyTracker:
+    """Rolling per-model latency samples, in seconds, that expire after max_age_seconds."""
+
+    def __init__(self, window_size=WINDOW_SIZE, max_age_seconds=SAMPLE_MAX_AGE_SECONDS):
+        self.window_size = window_size
+        self.max_age_seconds = max_age_seconds
+        self._samples = {}
+        self._lock = threading.Lock()
+
+    def record(self, model_name, seconds):
+        with self._lock:
+            self._samples.setdefault(model_name, deque(maxlen=self.window_size)).append((time.monotonic(), seconds))
+
+    def _fresh(self, model_name):
+        """The model's unexpired samples. Call with the lock held."""
+        samples = self._samples.get(model_name)
+        if not samples:
+            return ()
+        cutoff = time.monotonic() - self.max_age_seconds
+        while samples and samples[0][0] < cutoff:
+            samples.popleft()
+        return [seconds for _, seconds in samples]
+
+    def count(self, model_name):
+        with self._lock:
+            return len(self._fresh(model_name))
+
+    def percentile(self, model_name, pct):
+        with self._lock:
+            samples = sorted(self._fresh(model_name))
+        if not samples:
+            return None
+        index = min(len(samples) - 1, max(0, int(round(pct / 100 * len(samples))) - 1))
+        return samples[index]
+
+    def snapshot(self):
+        with self._lock:
+            names = list(self._samples)
+        return {
+            name: {
+                "samples": self.count(name),
+                "p50": self.percentile(name, 50),
+                "p95": self.percentile(name, 95),
+                "p99": self.percentile(name, 99),
+            }
+            for name in names
+        }
+
+
+class ModelRouter:
+    """Picks the model for a variant and hedges slow calls to its alternate."""
+
+    def __init__(self, client=None, tracker=None):
+        self._client = client
+        self.tracker = tracker or LatencyTracker()
+        self._alternates = {}
+        self._executor = ThreadPoolExecutor(max_workers=POOL_SIZE, thread_name_prefix="hedge")
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.overhead_calls = 0
+        self.overhead_tokens = 0
+
+    @property
+    def client(self):
+        return self._client or get_client()
+
+    def set_alternate(self, variant, alternate_variant):
+        self._alternates[variant] = alternate_variant
+
+    def deadline_for(self, model_name):
+        if self.tracker.count(model_name) < MIN_SAMPLES:
+            return HEDGE_DEFAULT_DEADLINE_SECONDS
+        observed = self.tracker.percentile(model_name, HEDGE_PERCENTILE)
+        return min(HEDGE_MAX_DEADLINE_SECONDS, max(HEDGE_MIN_DEADLINE_SECONDS, observed))
+
+    def route(self, variant):
+        """Returns (primary, alternate) variants; alternate may be None."""
+        alternate = self._alternates.get(variant)
+        if alternate is None:
+            return variant, None
+        primary_model = self.client.model_name(variant)
+        alternate_model = self.client.model_name(alternate)
+        if min(self.tracker.count(primary_model), self.tracker.count(alternate_model)) >= MIN_SAMPLES:
+            primary_p50 = self.tracker.percentile(primary_model, 50)
+            alternate_p50 = self.tracker.percentile(alternate_model, 50)
+            if primary_p50 > alternate_p50 * SWAP_FACTOR:
+                return alternate, variant
+        return variant, alternate
+
+    def _timed_generate(self, variant, contents, validate, trace, on_start=None):
+        if on_start is not None:
+            on_start.set()
+        model_name = self.client.model_name(variant)
+        started = time.perf_counter()
+        try:
+            response = self.client.generate(variant, contents)
+        finally:
+            elapsed = time.perf_counter() - started
+            trace.add_span('model_call', elapsed * 1000)
+        with trace.span('json_parse'):
+            parsed = validate(response)
+        # Only successful calls count: a fast error would flatter the model.
+        self.tracker.record(model_name, elapsed)
+        return parsed, response
+
+    def _count_overhead(self, future):
+        """Done-callback for a discarded call: its tokens are hedging overhead."""
+        if future.cancelled() or future.exception() is not None:
+            return
+        usage = getattr(future.result()[1], "usage_metadata", None)
+        with self._lock:
+            self.overhead_tokens += getattr(usage, "total_token_count", 0) or 0
+
+    def generate(self, variant, contents, validate, hedge=True):
+        """
+        Calls the model for `variant` and returns `validate(response)`.
+        `validate` must raise if the response does not conform to the schema.
+        With hedge=False the routed model is called once, on the caller's thread.
+        """
+        # Calls run on pool threads, which do not inherit the request's trace.
+        trace = instrumentation.current()
+        primary, alternate = self.route(variant)
+        with self._lock:
+            self.calls += 1
+        if not (HEDGE_ENABLED and hedge) or alternate is None:
+            parsed, response = self._timed_generate(primary, contents, validate, trace)
+            trace.record_usage(response)
+            return parsed
+
+        primary_started = threading.Event()
+        queued = time.perf_counter()
+        primary_future = self._executor.submit(self._timed_generate, primary, contents, validate, trace,
+                                               primary_started)
+        # Time spent waiting for a pool thread does not count against the deadline.
+        primary_started.wait()
+        trace.add_span('hedge_pool_wait', (time.perf_counter() - queued) * 1000)
+        done, _ = wait([primary_future], timeout=self.deadline_for(self.client.model_name(primary)))
+        if done:
+            parsed, response = primary_future.result()
+            trace.record_usage(response)
+            return parsed
+
+        trace.set(hedged_from=primary, hedged_to=alternate)
+        hedge_future = self._executor.submit(self._timed_generate, alternate, contents, validate, trace)
+        with self._lock:
+            self.hedges += 1
+            self.overhead_calls += 1
+
+        pending = {primary_future, hedge_future}
+        first_error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            winner = next((f for f in done if f.exception() is None), None)
+            if winner is None:
+                first_error = first_error or next(iter(done)).exception()
+                continue
+            for loser in {primary_future, hedge_future} - {winner}:
+                if not loser.cancel():
+                    loser.add_done_callback(self._count_overhead)
+            if winner is hedge_future:
+                with self._lock:
+                    self.hedge_wins += 1
+            parsed, response = winner.result()
+            trace.record_usage(response)
+            trace.set(hedge_won=winner is hedge_future)
+            return parsed
+        raise first_error
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                "pool_size": POOL_SIZE,
+                "calls": self.calls,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "hedge_rate": round(self.hedges / self.calls, 4) if self.calls else 0.0,
+                "hedge_win_rate": round(self.hedge_wins / self.hedges, 4) if self.hedges else 0.0,
+                "overhead_calls": self.overhead_calls,
+                "overhead_tokens": self.overhead_tokens,
+            }
+        stats["latency"] = self.tracker.snapshot()
+        return stats
+
+
+_router = ModelRouter()
+
+
+def get_router():
+    return _router
@@ -0,0 +1,144 @@
+"""
+Request parsing for analyze_food.
+
+Three body formats are accepted:
+  - application/json            {"image_data": <base64>, "is_special": ..., "user_profile": {...}}
+                                (the format older app builds send)
+  - application/octet-stream    raw image bytes (image/* also accepted); options
+                                come from the X-Is-Special, X-User-Profile and
+                                X-Use-Cache headers
+  - multipart/form-data         an "image" file part; options come from the
+                                is_special, user_profile and use_cache fields
+
+Raw uploads skip the ~33% base64 overhead and the extra decoded copy. Every
+format is size-limited, and requests that declare a too-large Content-Length
+are rejected before any of the body is read.
+"""
+import base64
+import json
+import os
+
+import instrumentation
+
+# --- CONFIGURATION ---
+MAX_UPLOAD_BYTES = int(os.environ.get("ANALYZE_MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+# base64 inflates the image by 4/3; leave some room for the rest of the JSON.
+MAX_JSON_BYTES = MAX_UPLOAD_BYTES * 4 // 3 + 64 * 1024
+READ_CHUNK_BYTES = 64 * 1024
+
+OPTION_HEADERS = ['X-Is-Special', 'X-User-Profile', 'X-Use-Cache']
+
+
+class UploadError(Exception):
+    """A request that cannot be analyzed; carries the HTTP status to return."""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.message = message
+        self.status = status
+
+
+def _parse_bool(value, default=False):
+    if value is None or value == "":
+        return default
+    if isinstance(value, bool):
+        return value
+    return str(value).strip().lower() in ("1", "true", "yes")
+
+
+def _parse_profile(value):
+    """Profiles arrive as JSON, or as base64-encoded JSON when sent in a header."""
+    if not value:
+        return None
+    if isinstance(value, dict):
+        return value
+    for candidate in (value, _safe_b64decode(value)):
+        if candidate is None:
+            continue
+        try:
+            profile = json.loads(candidate)
+        except ValueError:
+            continue
+        if isinstance(profile, dict):
+            return profile
+    return None
+
+
+def _safe_b64decode(value):
+    try:
+        return base64.b64decode(value, validate=False).decode("utf-8")
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def _read_bounded(stream, limit):
+    """Reads the body in chunks and stops as soon as it exceeds `limit`."""
+    body = bytearray()
+    while True:
+        chunk = stream.read(READ_CHUNK_BYTES)
+        if not chunk:
+            return bytes(body)
+        body.extend(chunk)
+        if len(body) > limit:
+            raise UploadError(f"Image exceeds the {limit} byte limit.", 413)
+
+
+def parse_analyze_request(request):
+    """
+    Returns (image_content, options) where options holds "is_special",
+    "user_profile" and "use_cache". Raises UploadError on bad input.
+    """
+    content_type = (request.mimetype or "").lower()
+    limit = MAX_JSON_BYTES if content_type == "application/json" else MAX_UPLOAD_BYTES
+
+    # Reject oversized bodies before reading any of them.
+    if request.content_length is not None and request.content_length > limit:
+        raise UploadError(f"Request body exceeds the {limit} byte limit.", 413)
+
+    if content_type == "application/octet-stream" or content_type.startswith("image/"):
+        image_content = _read_bounded(request.stream, MAX_UPLOAD_BYTES)
+        if not image_content:
+            raise UploadError("Invalid request. Empty image body.")
+        headers = request.headers
+        return image_content, {
+            "is_special": _parse_bool(headers.get('X-Is-Special')),
+            "user_profile": _parse_profile(headers.get('X-User-Profile')),
+            "use_cache": _parse_bool(headers.get('X-Use-Cache'), default=True),
+        }
+
+    if content_type == "multipart/form-data":
+        # Bounds chunked uploads that carry no Content-Length. Setting it per
+        # request needs Flask 3.1 (pinned in requirements.txt); older versions
+        # silently ignore it.
+        request.max_content_length = MAX_UPLOAD_BYTES
+        image_file = request.files.get('image') or request.files.get('image_data')
+        if image_file is None:
+            raise UploadError("Invalid request. Missing 'image' file part.")
+        image_content = _read_bounded(image_file.stream, MAX_UPLOAD_BYTES)
+        if not image_content:
+            raise UploadError("Invalid request. Empty image file.")
+        form = request.form
+        return image_content, {
+            "is_special": _parse_bool(form.get('is_special')),
+            "user_profile": _parse_profile(form.get('user_profile')),
+            "use_cache": _parse_bool(form.get('use_cache'), default=True),
+        }
+
+    # Legacy JSON body with a base64-encoded image.
+    request_json = request.get_json(silent=True)
+    if not request_json or 'image_data' not in request_json:
+        raise UploadError("Invalid request. Missing 'image_data' key.")
+    try:
+        with instrumentation.span('base64_decode'):
+            image_content = base64.b64decode(request_json['image_data'])
+    except (TypeError, ValueError) as e:
+        raise UploadError(f"Invalid base64 data: {e}")
+    if len(image_content) > MAX_UPLOAD_BYTES:
+        raise UploadError(f"Image exceeds the {MAX_UPLOAD_BYTES} byte limit.", 413)
+
+    user_profile = request_json.get('user_profile')
+    return image_content, {
+        "is_special": _parse_bool(request_json.get('is_special', False)),
+        "user_profile": user_profile if isinstance(user_profile, dict) else None,
+        "use_cache": request_json.get('use_cache', True) is not False,
+    }
@@ -0,0 +1,295 @@
+"""
+Content-addressed cache for analyze_food results.
+
+Users often re-snap the same item, so results are cached in front of the model
+call. Entries are keyed by the exact SHA-256 digest of the decoded image plus a
+context key (prompt variant + personalization). If the exact digest misses, a
+64-bit perceptual hash (dHash) is compared against cached entries with the
+same context. The dHash of a sticker flattened onto white mostly captures its
+outline, so an apple and an orange hash a few bits apart; a near-duplicate hit
+therefore also needs the mean color of the sticker's pixels to match within
+COLOR_TOLERANCE on every channel, besides the hash being within PHASH_RADIUS
+bits.
+
+The in-process LRU can be backed by a shared store so a result computed on one
+instance is reused by the others:
+  - ANALYZE_CACHE_STORE=firestore  -> the `analysis_cache` collection
+  - ANALYZE_CACHE_STORE=file       -> a local JSON file (ANALYZE_CACHE_FILE)
+The shared store is only looked up by exact digest; near-duplicate matching
+happens against the entries this instance has seen. Callers check the exact
+digest first (`lookup_exact`) and only decode the image for a perceptual hash
+when that misses (`lookup_near`).
+
+Firestore documents carry `expires_at` as a timestamp so that a TTL policy can
+delete them once they expire; expired entries are otherwise never removed.
+Enable it once per project:
+    gcloud firestore fields ttls update expires_at \
+        --collection-group=analysis_cache --enable-ttl --project=foodjar-462805
+"""
+import hashlib
+import io
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+# --- CONFIGURATION ---
+MAX_ENTRIES = int(os.environ.get("ANALYZE_CACHE_MAX_ENTRIES", "1024"))
+TTL_SECONDS = int(os.environ.get("ANALYZE_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+PHASH_RADIUS = int(os.environ.get("ANALYZE_CACHE_PHASH_RADIUS", "2"))
+COLOR_TOLERANCE = int(os.environ.get("ANALYZE_CACHE_COLOR_TOLERANCE", "24"))
+# Pixels at least this light on every channel count as the white background.
+BACKGROUND_THRESHOLD = 245
+STORE = os.environ.get("ANALYZE_CACHE_STORE", "memory")
+STORE_FILE = os.environ.get("ANALYZE_CACHE_FILE", "/tmp/analysis_cache.json")
+FIRESTORE_COLLECTION = "analysis_cache"
+
+
+def exact_digest(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()
+
+
+def perceptual_hash(image):
+    """
+    Returns a 64-bit difference hash for a PIL image or raw image bytes, or
+    None if the image cannot be decoded.
+    """
+    try:
+        from PIL import Image
+        if isinstance(image, (bytes, bytearray)):
+            image = Image.open(io.BytesIO(image))
+        pixels = list(image.convert("L").resize((9, 8)).getdata())
+    except Exception as e:
+        print(f"--- [CACHE] Could not compute perceptual hash: {e}")
+        return None
+    value = 0
+    for row in range(8):
+        for col in range(8):
+            left = pixels[row * 9 + col]
+            right = pixels[row * 9 + col + 1]
+            value = (value << 1) | (1 if left > right else 0)
+    return value
+
+
+def color_signature(image):
+    """
+    Returns the mean (r, g, b) of a PIL image's non-background pixels, or None
+    if the image cannot be read. Background is the near-white the sticker was
+    flattened onto; an all-background image averages every pixel.
+    """
+    try:
+        from PIL import Image
+        # Nearest-neighbour sampling, so edge pixels are not blended with the background.
+        pixels = list(image.convert("RGB").resize((32, 32), Image.NEAREST).getdata())
+    except Exception as e:
+        print(f"--- [CACHE] Could not compute color signature: {e}")
+        return None
+    opaque = [p for p in pixels if min(p) < BACKGROUND_THRESHOLD] or pixels
+    return tuple(round(sum(p[channel] for p in opaque) / len(opaque)) for channel in range(3))
+
+
+def colors_match(a, b, tolerance=COLOR_TOLERANCE):
+    return a is not None and b is not None and all(abs(x - y) <= tolerance for x, y in zip(a, b))
+
+
+def hamming_distance(a, b):
+    return bin(a ^ b).count("1")
+
+
+def context_key(variant, personalization=""):
+    """Results depend on the prompt variant and the personalization line."""
+    return hashlib.sha256(f"{variant}\0{personalization}".encode("utf-8")).hexdigest()[:16]
+
+
+class LocalFileStore:
+    """Shared-store stand-in backed by a JSON file, for local testing."""
+
+    def __init__(self, path=STORE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def get(self, key):
+        with self._lock:
+            return self._load().get(key)
+
+    def set(self, key, entry):
+        with self._lock:
+            data = self._load()
+            data[key] = entry
+            with open(self.path, "w") as f:
+                json.dump(data, f)
+
+
+class FirestoreStore:
+    """
+    Shared store backed by a Firestore collection (one document per key).
+    `expires_at` is stored as a timestamp for the collection's TTL policy and
+    handed back to the cache as epoch seconds.
+    """
+
+    def __init__(self, collection=FIRESTORE_COLLECTION):
+        from google.cloud import firestore
+        self.collection = firestore.Client().collection(collection)
+
+    def get(self, key):
+        snapshot = self.collection.document(key).get()
+        if not snapshot.exists:
+            return None
+        entry = snapshot.to_dict()
+        if isinstance(entry.get("expires_at"), datetime):
+            entry["expires_at"] = entry["expires_at"].timestamp()
+        return entry
+
+    def set(self, key, entry):
+        self.collection.document(key).set(
+            {**entry, "expires_at": datetime.fromtimestamp(entry["expires_at"], tz=timezone.utc)})
+
+
+class AnalysisCache:
+    """In-process LRU with TTL, optionally backed by a shared store."""
+
+    def __init__(self, max_entries=MAX_ENTRIES, ttl_seconds=TTL_SECONDS,
+                 phash_radius=PHASH_RADIUS, color_tolerance=COLOR_TOLERANCE, store=None):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.phash_radius = phash_radius
+        self.color_tolerance = color_tolerance
+        self.store = store
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.near_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+
+    def lookup(self, digest, phash, context, color=None):
+        """
+        Returns (result, kind) where kind is "exact", "near", "store" or None
+        on a miss.
+        """
+        result, kind = self.lookup_exact(digest, context)
+        if kind is not None:
+            return result, kind
+        return self.lookup_near(phash, context, color)
+
+    def lookup_exact(self, digest, context):
+        """
+        Looks up the exact digest here, then in the shared store. Returns
+        (result, "exact" | "store"), or (None, None) without counting a miss:
+        follow up with `lookup_near`.
+        """
+        key = f"{context}:{digest}"
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry and entry["expires_at"] > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry["result"], "exact"
+
+        if self.store is not None:
+            try:
+                stored = self.store.get(key)
+            except Exception as e:
+                print(f"--- [CACHE] Shared store lookup failed: {e}")
+                stored = None
+            if stored and stored.get("expires_at", 0) > now:
+                stored_phash, stored_color = stored.get("phash"), stored.get("color")
+                self._remember(key, context, stored["result"],
+                               int(stored_phash, 16) if stored_phash else None,
+                               stored["expires_at"], tuple(stored_color) if stored_color else None)
+                with self._lock:
+                    self.store_hits += 1
+                return stored["result"], "store"
+        return None, None
+
+    def lookup_near(self, phash, context, color=None):
+        """
+        Returns (result, "near") for an entry whose hash is within the radius
+        of `phash` and whose color matches `color`, or (None, None) on a miss.
+        Without a color there are no near-duplicate hits.
+        """
+        now = time.time()
+        with self._lock:
+            if phash is not None and color is not None:
+                for other_key, other in reversed(self._entries.items()):
+                    if (other["context"] == context and other["phash"] is not None
+                            and other["expires_at"] > now
+                            and hamming_distance(phash, other["phash"]) <= self.phash_radius
+                            and colors_match(color, other["color"], self.color_tolerance)):
+                        self._entries.move_to_end(other_key)
+                        self.near_hits += 1
+                        return other["result"], "near"
+            self.misses += 1
+        return None, None
+
+    def put(self, digest, phash, context, result, color=None):
+        key = f"{context}:{digest}"
+        expires_at = time.time() + self.ttl_seconds
+        self._remember(key, context, result, phash, expires_at, color)
+        if self.store is not None:
+            try:
+                self.store.set(key, {
+                    "result": result,
+                    "phash": format(phash, "016x") if phash is not None else None,
+                    "color": list(color) if color is not None else None,
+                    "expires_at": expires_at,
+                })
+            except Exception as e:
+                print(f"--- [CACHE] Shared store write failed: {e}")
+
+    def _remember(self, key, context, result, phash, expires_at, color=None):
+        with self._lock:
+            self._entries[key] = {
+                "context": context,
+                "result": result,
+                "phash": phash,
+                "color": color,
+                "expires_at": expires_at,
+            }
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.near_hits + self.store_hits + self.misses
+            return {
+                "hits": self.hits,
+                "near_hits": self.near_hits,
+                "store_hits": self.store_hits,
+                "misses": self.misses,
+                "hit_rate": round((total - self.misses) / total, 4) if total else 0.0,
+                "size": len(self._entries),
+            }
+
+
+def _build_store():
+    if STORE == "firestore":
+        return FirestoreStore()
+    if STORE == "file":
+        return LocalFileStore()
+    return None
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Returns the per-instance cache, creating it (and its store) on first call."""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = AnalysisCache(store=_build_store())
+    return _cache
@@ -0,0 +1,10 @@
+"""
+Tests run from this function's directory: `python -m pytest -q`. The modules
+under test are top-level modules of the deployed source, and Gemini is the
+in-process stub.
+"""
+import os
+import sys
+
+os.environ.setdefault("GEMINI_BACKEND", "stub")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,156 @@
+import threading
+import time
+
+import flask
+import pytest
+
+import admission
+from admission import AdmissionController, ConcurrencyLimiter, Rejected, TokenBuckets
+
+app = flask.Flask(__name__)
+
+
+class FakeMonotonic:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    fake = FakeMonotonic()
+    monkeypatch.setattr(admission.time, 'monotonic', fake)
+    return fake
+
+
+def test_bucket_allows_a_burst_then_rejects_with_retry_after(clock):
+    buckets = TokenBuckets(rate=0.5, burst=3)
+    for _ in range(3):
+        buckets.take('alice')
+    with pytest.raises(Rejected) as rejected:
+        buckets.take('alice')
+    assert rejected.value.reason == 'rate_limited'
+    assert rejected.value.retry_after == 2  # One token at 0.5/s.
+
+
+def test_bucket_refills_over_time_up_to_the_burst(clock):
+    buckets = TokenBuckets(rate=1.0, burst=2)
+    buckets.take('alice')
+    buckets.take('alice')
+    clock.now += 1.0
+    buckets.take('alice')
+    with pytest.raises(Rejected):
+        buckets.take('alice')
+    clock.now += 60
+    buckets.take('alice')
+    buckets.take('alice')
+    with pytest.raises(Rejected):
+        buckets.take('alice')
+
+
+def test_buckets_are_per_caller_and_bounded(clock):
+    buckets = TokenBuckets(rate=0.0, burst=1, max_callers=2)
+    buckets.take('alice')
+    buckets.take('bob')
+    with pytest.raises(Rejected):
+        buckets.take('bob')
+    buckets.take('carol')  # Evicts alice, the least recently seen.
+    buckets.take('alice')  # A fresh bucket.
+    with pytest.raises(Rejected):
+        buckets.take('carol')
+
+
+def test_limiter_admits_up_to_the_limit_and_rejects_when_the_queue_is_full():
+    limiter = ConcurrencyLimiter(max_concurrent=2, max_queue=0, max_wait_seconds=0.01)
+    assert limiter.acquire() == 0.0
+    assert limiter.acquire() == 0.0
+    with pytest.raises(Rejected) as rejected:
+        limiter.acquire()
+    assert rejected.value.reason == 'queue_full'
+    limiter.release()
+    assert limiter.acquire() == 0.0
+
+
+def test_limiter_times_out_queued_requests():
+    limiter = ConcurrencyLimiter(max_concurrent=1, max_queue=1, max_wait_seconds=0.05)
+    limiter.acquire()
+    with pytest.raises(Rejected) as rejected:
+        limiter.acquire()
+    assert rejected.value.reason == 'queue_timeout'
+    assert limiter.waiting == 0 and limiter.in_flight == 1
+
+
+def test_limiter_hands_a_released_slot_to_a_waiter():
+    limiter = ConcurrencyLimiter(max_concurrent=1, max_queue=1, max_wait_seconds=5)
+    limiter.acquire()
+    waited = []
+    waiter = threading.Thread(target=lambda: waited.append(limiter.acquire()))
+    waiter.start()
+    while limiter.waiting == 0:
+        time.sleep(0.001)
+    limiter.release()
+    waiter.join(timeout=5)
+    assert len(waited) == 1 and waited[0] > 0
+    assert limiter.in_flight == 1 and limiter.peak_waiting == 1
+
+
+def test_controller_counts_admissions_and_rejections():
+    controller = AdmissionController(TokenBuckets(rate=0.0, burst=1), ConcurrencyLimiter(max_concurrent=1))
+    with controller.admit('alice'):
+        assert controller.limiter.in_flight == 1
+    assert controller.limiter.in_flight == 0
+    with pytest.raises(Rejected):
+        controller.admit('alice')
+    stats = controller.stats()
+    assert stats['admitted'] == 1 and stats['rejected'] == {'rate_limited': 1}
+
+
+def _identity(headers, remote_addr='10.0.0.1'):
+    with app.test_request_context('/', headers=headers, environ_base={'REMOTE_ADDR': remote_addr}):
+        return admission.caller_identity(flask.request)
+
+
+def test_identity_ignores_client_chosen_headers(monkeypatch):
+    monkeypatch.setattr(admission, 'verified_claims', lambda request: None)
+    assert _identity({'X-User-Id': 'someone-else', 'X-Forwarded-For': '6.6.6.6, 203.0.113.9'}) == 'ip:203.0.113.9'
+    assert _identity({'X-Forwarded-For': '7.7.7.7, 203.0.113.9'}) == 'ip:203.0.113.9'
+    assert _identity({'X-User-Id': 'someone-else'}) == 'ip:10.0.0.1'
+
+
+def test_identity_skips_trusted_proxy_hops(monkeypatch):
+    monkeypatch.setattr(admission, 'verified_claims', lambda request: None)
+    monkeypatch.setattr(admission, 'TRUSTED_PROXY_HOPS', 1)
+    assert _identity({'X-Forwarded-For': '6.6.6.6, 203.0.113.9, 35.191.0.1'}) == 'ip:203.0.113.9'
+    assert _identity({'X-Forwarded-For': '35.191.0.1'}) == 'ip:10.0.0.1'
+
+
+def test_identity_prefers_a_verified_token(monkeypatch):
+    monkeypatch.setattr(admission, 'verified_claims', lambda request: {'uid': 'alice'})
+    assert _identity({'X-Forwarded-For': '203.0.113.9'}) == 'user:alice'
+
+
+def test_callers_known_only_by_ip_get_the_looser_ip_bucket():
+    controller = AdmissionController(TokenBuckets(rate=0.0, burst=1), ConcurrencyLimiter(max_concurrent=1),
+                                     TokenBuckets(rate=0.0, burst=5))
+    # Five users behind one carrier-grade NAT address, none signed in.
+    for _ in range(5):
+        with controller.admit('ip:203.0.113.9'):
+            pass
+    with pytest.raises(Rejected):
+        controller.admit('ip:203.0.113.9')
+    with controller.admit('user:alice'):
+        pass
+    with pytest.raises(Rejected):
+        controller.admit('user:alice')
+
+
+def test_unauthenticated_requests_are_limited_at_the_ip_rate(monkeypatch):
+    monkeypatch.setattr(admission, 'verified_claims', lambda request: None)
+    controller = AdmissionController(limiter=ConcurrencyLimiter(max_concurrent=1))
+    caller = _identity({'X-Forwarded-For': '203.0.113.9'})
+    for _ in range(int(admission.USER_BURST) + 1):
+        with controller.admit(caller):
+            pass
+    assert controller.ip_buckets.burst == admission.IP_BURST > admission.USER_BURST
@@ -0,0 +1,12 @@
+import analysis
+
+
+def test_two_tier_standard_results_do_not_depend_on_the_profile(monkeypatch):
+    monkeypatch.setattr(analysis, 'TWO_TIER_ENABLED', True)
+    assert not analysis.uses_personalization(analysis.STANDARD_VARIANT)
+    assert analysis.uses_personalization(analysis.SPECIAL_VARIANT)
+
+
+def test_single_generation_standard_results_are_personalized(monkeypatch):
+    monkeypatch.setattr(analysis, 'TWO_TIER_ENABLED', False)
+    assert analysis.uses_personalization(analysis.STANDARD_VARIANT)
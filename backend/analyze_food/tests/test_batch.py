@@ -0,0 +1,84 @@
+import json
+import threading
+import time
+
+import flask
+import pytest
+
+import batch
+
+app = flask.Flask(__name__)
+
+
+class CountingAnalyzer:
+    """Stands in for analyze_item and records how many items run at once."""
+
+    def __init__(self, seconds=0.02):
+        self.seconds = seconds
+        self.running = self.peak = self.calls = 0
+        self._lock = threading.Lock()
+
+    def __call__(self, index, item, defaults):
+        with self._lock:
+            self.running += 1
+            self.calls += 1
+            self.peak = max(self.peak, self.running)
+        time.sleep(self.seconds)
+        with self._lock:
+            self.running -= 1
+        return {"index": index, "id": index, "result": {}}
+
+
+@pytest.fixture
+def analyzer(monkeypatch):
+    fake = CountingAnalyzer()
+    monkeypatch.setattr(batch, 'analyze_item', fake)
+    return fake
+
+
+def _drain(items, concurrency):
+    return [json.loads(line) for line in batch.stream_batch(items, {}, concurrency)]
+
+
+def test_parallel_batches_share_the_instance_ceiling(monkeypatch, analyzer):
+    monkeypatch.setattr(batch, '_item_slots', threading.BoundedSemaphore(2))
+    runs = [threading.Thread(target=_drain, args=([{}] * 6, 4)) for _ in range(3)]
+    for run in runs:
+        run.start()
+    for run in runs:
+        run.join()
+    assert analyzer.calls == 18
+    assert analyzer.peak == 2
+
+
+def test_every_item_gets_a_line_and_a_summary(analyzer):
+    lines = _drain([{}] * 5, 3)
+    assert sorted(line['index'] for line in lines[:-1]) == [0, 1, 2, 3, 4]
+    assert lines[-1]['summary']['succeeded'] == 5
+
+
+def test_a_disconnect_cancels_items_not_yet_started(analyzer):
+    stream = batch.stream_batch([{}] * 50, {}, 2)
+    next(stream)
+    stream.close()
+    time.sleep(0.1)
+    assert analyzer.calls <= 4
+
+
+def test_gcs_uris_must_point_at_the_sticker_prefix():
+    line = batch.analyze_item(0, {'gcs_uri': 'gs://someone-elses-bucket/x.png'}, {'is_special': False, 'user_profile': None})
+    assert batch.BATCH_GCS_PREFIX in line['error']
+
+
+@pytest.mark.parametrize('claims, status', [(None, 401), ({'uid': 'bob'}, 403)])
+def test_batches_need_an_admin(monkeypatch, claims, status):
+    monkeypatch.setattr(batch, 'verified_claims', lambda request: claims)
+    with app.test_request_context('/'), pytest.raises(batch.BatchRequestError) as error:
+        batch.authorize_batch(flask.request)
+    assert error.value.status == status
+
+
+def test_admins_may_run_batches(monkeypatch):
+    monkeypatch.setattr(batch, 'verified_claims', lambda request: {'uid': 'root', 'admin': True})
+    with app.test_request_context('/'):
+        batch.authorize_batch(flask.request)
@@ -0,0 +1,156 @@
+import json
+import threading
+import time
+
+import pytest
+
+import model_router
+from model_router import LatencyTracker, ModelRouter
+
+MODELS = {'primary': 'model-a', 'alternate': 'model-b'}
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+        self.usage_metadata = None
+
+
+class FakeClient:
+    """Answers per variant after the given delay, or raises what it is told to."""
+
+    def __init__(self, delays=None, errors=None):
+        self.delays = delays or {}
+        self.errors = errors or {}
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def model_name(self, variant):
+        return MODELS[variant]
+
+    def generate(self, variant, contents):
+        with self._lock:
+            self.calls.append(variant)
+        time.sleep(self.delays.get(variant, 0))
+        if variant in self.errors:
+            raise self.errors[variant]
+        return FakeResponse(json.dumps({'from': variant}))
+
+
+def validate(response):
+    parsed = json.loads(response.text)
+    if 'from' not in parsed:
+        raise ValueError("missing 'from'")
+    return parsed
+
+
+@pytest.fixture(autouse=True)
+def short_deadline(monkeypatch):
+    monkeypatch.setattr(model_router, 'HEDGE_ENABLED', True)
+    monkeypatch.setattr(model_router, 'HEDGE_DEFAULT_DEADLINE_SECONDS', 0.05)
+
+
+def make_router(client):
+    router = ModelRouter(client=client)
+    router.set_alternate('primary', 'alternate')
+    return router
+
+
+def test_fast_primary_is_not_hedged():
+    client = FakeClient()
+    router = make_router(client)
+    assert router.generate('primary', [], validate) == {'from': 'primary'}
+    assert client.calls == ['primary']
+    assert router.stats()['hedges'] == 0
+
+
+def test_slow_primary_is_hedged_and_the_alternate_wins():
+    client = FakeClient(delays={'primary': 0.5})
+    router = make_router(client)
+    assert router.generate('primary', [], validate) == {'from': 'alternate'}
+    stats = router.stats()
+    assert (stats['hedges'], stats['hedge_wins'], stats['overhead_calls']) == (1, 1, 1)
+    assert sorted(client.calls) == ['alternate', 'primary']
+
+
+def test_slow_primary_still_wins_when_it_answers_first():
+    client = FakeClient(delays={'primary': 0.1, 'alternate': 0.5})
+    router = make_router(client)
+    assert router.generate('primary', [], validate) == {'from': 'primary'}
+    assert router.stats()['hedge_wins'] == 0
+
+
+def test_a_failed_hedge_leg_falls_back_to_the_other():
+    client = FakeClient(delays={'primary': 0.2}, errors={'alternate': RuntimeError("quota")})
+    router = make_router(client)
+    assert router.generate('primary', [], validate) == {'from': 'primary'}
+
+
+def test_both_legs_failing_raises_the_first_error():
+    client = FakeClient(delays={'primary': 0.1}, errors={'primary': RuntimeError("a"), 'alternate': RuntimeError("b")})
+    with pytest.raises(RuntimeError, match='b'):
+        make_router(client).generate('primary', [], validate)
+
+
+def test_hedge_false_calls_the_routed_model_once():
+    client = FakeClient(delays={'primary': 0.1})
+    router = make_router(client)
+    assert router.generate('primary', [], validate, hedge=False) == {'from': 'primary'}
+    assert client.calls == ['primary']
+    assert router.stats()['hedges'] == 0
+
+
+def test_failed_calls_are_not_latency_samples():
+    client = FakeClient(errors={'primary': RuntimeError("boom")})
+    router = make_router(client)
+    with pytest.raises(RuntimeError):
+        router.generate('primary', [], validate)
+    assert router.tracker.count('model-a') == 0
+
+
+def test_a_consistently_slow_primary_swaps_roles():
+    router = make_router(FakeClient())
+    for _ in range(model_router.MIN_SAMPLES):
+        router.tracker.record('model-a', 3.0)
+        router.tracker.record('model-b', 1.0)
+    assert router.route('primary') == ('alternate', 'primary')
+
+
+def test_a_demoted_primary_is_tried_again_once_its_samples_expire():
+    router = make_router(FakeClient())
+    router.tracker = LatencyTracker(max_age_seconds=0.05)
+    for _ in range(model_router.MIN_SAMPLES):
+        router.tracker.record('model-a', 3.0)
+    time.sleep(0.1)
+    for _ in range(model_router.MIN_SAMPLES):
+        router.tracker.record('model-b', 1.0)
+    assert router.tracker.count('model-a') == 0
+    assert router.route('primary') == ('primary', 'alternate')
+
+
+def test_deadline_follows_the_observed_percentile_within_bounds(monkeypatch):
+    monkeypatch.setattr(model_router, 'HEDGE_MIN_DEADLINE_SECONDS', 1.0)
+    monkeypatch.setattr(model_router, 'HEDGE_MAX_DEADLINE_SECONDS', 10.0)
+    router = make_router(FakeClient())
+    assert router.deadline_for('model-a') == 0.05
+    for seconds in [2.0] * 19 + [4.0] * 1:
+        router.tracker.record('model-a', seconds)
+    assert router.deadline_for('model-a') == 2.0
+    for _ in range(200):
+        router.tracker.record('model-a', 30.0)
+    assert router.deadline_for('model-a') == 10.0
+
+
+def test_the_deadline_starts_when_the_primary_call_starts(monkeypatch):
+    monkeypatch.setattr(model_router, 'POOL_SIZE', 1)
+    monkeypatch.setattr(model_router, 'HEDGE_DEFAULT_DEADLINE_SECONDS', 0.15)
+    client = FakeClient(delays={'primary': 0.05})
+    router = make_router(client)
+    router._executor.submit(time.sleep, 0.3)  # A loser still holding the only thread.
+    assert router.generate('primary', [], validate) == {'from': 'primary'}
+    assert router.stats()['hedges'] == 0
+
+
+def test_the_pool_leaves_room_for_losers_of_every_admitted_request():
+    from admission import MAX_CONCURRENT
+    assert model_router.POOL_SIZE >= 4 * MAX_CONCURRENT
@@ -0,0 +1,72 @@
+import io
+
+import pytest
+from PIL import Image, ImageDraw
+
+import result_cache
+from image_preprocessing import normalize_image
+from result_cache import AnalysisCache, color_signature, context_key, hamming_distance, perceptual_hash
+
+CONTEXT = context_key('standard')
+COLORS = {'apple': (200, 30, 40), 'orange': (245, 150, 20), 'lime': (90, 190, 60), 'cookie': (140, 90, 50)}
+
+
+def sticker(fill, edge=600, inset=60):
+    """A round sticker on a transparent background, as the app uploads them."""
+    image = Image.new('RGBA', (edge, edge), (0, 0, 0, 0))
+    ImageDraw.Draw(image).ellipse((inset, inset, edge - inset, edge - inset), fill=fill + (255,))
+    out = io.BytesIO()
+    image.save(out, format='PNG')
+    return out.getvalue()
+
+
+def fingerprint(data):
+    image = normalize_image(data).image
+    return perceptual_hash(image), color_signature(image)
+
+
+def test_same_shape_stickers_hash_close_together():
+    # Why the hash alone is not enough: outlines dominate the dHash, so these
+    # are well within any useful radius of each other.
+    hashes = [fingerprint(sticker(fill))[0] for fill in COLORS.values()]
+    assert max(hamming_distance(a, b) for a in hashes for b in hashes) <= result_cache.PHASH_RADIUS
+
+
+def test_differently_colored_stickers_of_the_same_shape_miss():
+    cache = AnalysisCache()
+    phash, color = fingerprint(sticker(COLORS['apple']))
+    cache.put('apple-digest', phash, CONTEXT, {'name': 'Apple'}, color)
+
+    for name in ('orange', 'lime', 'cookie'):
+        phash, color = fingerprint(sticker(COLORS[name]))
+        assert cache.lookup(f'{name}-digest', phash, CONTEXT, color) == (None, None), name
+
+
+def test_a_re_encoded_snap_of_the_same_sticker_is_a_near_hit():
+    cache = AnalysisCache()
+    phash, color = fingerprint(sticker(COLORS['apple']))
+    cache.put('apple-digest', phash, CONTEXT, {'name': 'Apple'}, color)
+
+    phash, color = fingerprint(sticker((205, 35, 40), edge=900, inset=92))
+    assert cache.lookup('other-digest', phash, CONTEXT, color) == ({'name': 'Apple'}, 'near')
+
+
+def test_near_hits_need_a_color_on_both_sides():
+    cache = AnalysisCache()
+    cache.put('a', 0b1011, CONTEXT, {'name': 'Apple'})
+    assert cache.lookup_near(0b1011, CONTEXT, (1, 2, 3)) == (None, None)
+    cache.put('b', 0b1011, CONTEXT, {'name': 'Apple'}, (1, 2, 3))
+    assert cache.lookup_near(0b1011, CONTEXT, None) == (None, None)
+    assert cache.lookup_near(0b1011, CONTEXT, (1, 2, 3)) == ({'name': 'Apple'}, 'near')
+
+
+@pytest.mark.parametrize('other_context', [context_key('special'), context_key('standard', 'For Sam.')])
+def test_entries_only_match_their_own_context(other_context):
+    cache = AnalysisCache()
+    cache.put('a', 5, CONTEXT, {'name': 'Apple'}, (1, 2, 3))
+    assert cache.lookup('a', 5, other_context, (1, 2, 3)) == (None, None)
+
+
+def test_color_signature_ignores_the_white_background():
+    image = normalize_image(sticker(COLORS['lime'], inset=250)).image
+    assert color_signature(image) == COLORS['lime']
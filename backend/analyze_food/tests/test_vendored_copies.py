@@ -0,0 +1,32 @@
+"""
+Each function directory is deployed as its own source bundle, so shared
+modules are vendored into several of them. The copies must not drift apart.
+"""
+import os
+
+import pytest
+
+BACKEND = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+ALL_FUNCTIONS = ['analyze_food', 'generate_report', 'send_notifications', 'test_send_notification']
+NOTIFICATIONS = ['send_notifications', 'test_send_notification']
+
+VENDORED = {
+    'instrumentation.py': ALL_FUNCTIONS,
+    'startup.py': ALL_FUNCTIONS,
+    'gemini_client.py': ['analyze_food', 'generate_report'],
+    'fcm_fanout.py': NOTIFICATIONS,
+    'token_pruning.py': NOTIFICATIONS,
+    'token_stream.py': NOTIFICATIONS,
+}
+
+
+@pytest.mark.parametrize('name', sorted(VENDORED))
+def test_vendored_copies_are_identical(name):
+    directories = VENDORED[name]
+    copies = {}
+    for directory in directories:
+        with open(os.path.join(BACKEND, directory, name), 'rb') as f:
+            copies[directory] = f.read()
+    reference = copies[directories[0]]
+    differing = [directory for directory, data in copies.items() if data != reference]
+    assert not differing, f"{name} in {differing} differs from the copy in {directories[0]}"
@@ -0,0 +1,361 @@
+"""
+In-memory stand-in for the Firestore client, covering what the functions use:
+collections and subcollections, get/set(merge)/update/create, write batches,
+transactions, DELETE_FIELD and ArrayUnion, and queries with FieldFilter ('==', 'in',
+'array_contains', and '<', '<=', '>', '>=' on '__name__'), select, limit,
+order_by('__name__') and start_after.
+
+Documents are kept ordered by id, and writes replace a document's dict
+rather than mutating it, so snapshots share it without copying. Equality,
+'in' and 'array_contains' filters are answered from a per-field index built
+on first use and kept up to date on writes, so paging through a million
+seeded users stays cheap enough not to dominate what is being measured.
+
+`install(db)` makes both firebase_admin.firestore.client() and
+google.cloud.firestore.Client() return `db`.
+"""
+import bisect
+import threading
+
+from google.api_core.exceptions import AlreadyExists, NotFound
+from google.cloud.firestore_v1.transforms import DELETE_FIELD, ArrayUnion
+
+_INDEXED_OPS = ('==', 'in', 'array_contains')
+_RANGE_OPS = {
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+}
+
+
+def _id_of(value):
+    return value.id if hasattr(value, 'id') else str(value).rsplit('/', 1)[-1]
+
+
+def _apply(data, updates):
+    for field, value in updates.items():
+        if value is DELETE_FIELD:
+            data.pop(field, None)
+        elif isinstance(value, ArrayUnion):
+            existing = list(data.get(field) or [])
+            data[field] = existing + [v for v in value.values if v not in existing]
+        else:
+            data[field] = value
+
+
+def _matches(data, field, op, value):
+    if field not in data:
+        return False
+    actual = data[field]
+    if op == '==':
+        return actual == value
+    if op == 'in':
+        return actual in value
+    if op == 'array_contains':
+        return isinstance(actual, list) and value in actual
+    if op in _RANGE_OPS:
+        return _RANGE_OPS[op](actual, value)
+    raise NotImplementedError(f"FakeFirestore does not support '{op}' filters.")
+
+
+class _Collection:
+    def __init__(self):
+        self.docs = {}
+        self.ids = []  # sorted
+        self.indexes = {}  # field -> {value: sorted ids}
+
+    def _index_values(self, data, field):
+        value = data.get(field)
+        if value is None:
+            return ()
+        return value if isinstance(value, list) else (value,)
+
+    def _unindex(self, doc_id, data, fields):
+        for field in fields:
+            index = self.indexes[field]
+            for value in self._index_values(data, field):
+                ids = index.get(value)
+                if ids:
+                    position = bisect.bisect_left(ids, doc_id)
+                    if position < len(ids) and ids[position] == doc_id:
+                        del ids[position]
+
+    def _reindex(self, doc_id, data, fields):
+        for field in fields:
+            index = self.indexes[field]
+            for value in self._index_values(data, field):
+                bisect.insort(index.setdefault(value, []), doc_id)
+
+    def write(self, doc_id, data):
+        existing = self.docs.get(doc_id)
+        if existing is None:
+            bisect.insort(self.ids, doc_id)
+            changed = list(self.indexes)
+        else:
+            changed = [field for field in self.indexes if existing.get(field) != data.get(field)]
+            self._unindex(doc_id, existing, changed)
+        self.docs[doc_id] = data
+        self._reindex(doc_id, data, changed)
+
+    def delete(self, doc_id):
+        existing = self.docs.pop(doc_id, None)
+        if existing is not None:
+            self._unindex(doc_id, existing, list(self.indexes))
+            del self.ids[bisect.bisect_left(self.ids, doc_id)]
+
+    def index(self, field):
+        index = self.indexes.get(field)
+        if index is None:
+            index = {}
+            for doc_id in self.ids:
+                for value in self._index_values(self.docs[doc_id], field):
+                    index.setdefault(value, []).append(doc_id)
+            self.indexes[field] = index
+        return index
+
+    def candidates(self, field, op, value):
+        index = self.index(field)
+        if op == 'in':
+            return sorted({doc_id for v in value for doc_id in index.get(v, ())})
+        return index.get(value, [])
+
+
+class DocumentSnapshot:
+    def __init__(self, reference, data):
+        self.reference = reference
+        self.id = reference.id
+        self.exists = data is not None
+        self._data = data
+
+    def to_dict(self):
+        return dict(self._data) if self._data is not None else None
+
+    def get(self, field):
+        return (self._data or {}).get(field)
+
+
+class DocumentReference:
+    def __init__(self, db, path):
+        self._db = db
+        self.path = path
+        self.id = path.rsplit('/', 1)[-1]
+        self._collection_path = path.rsplit('/', 1)[0]
+
+    def collection(self, name):
+        return CollectionReference(self._db, f"{self.path}/{name}")
+
+    def get(self, field_paths=None, transaction=None):
+        with self._db._lock:
+            data = self._db._collection(self._collection_path).docs.get(self.id)
+            return DocumentSnapshot(self, data)
+
+    def set(self, data, merge=False):
+        with self._db._lock:
+            collection = self._db._collection(self._collection_path)
+            current = dict(collection.docs.get(self.id) or {}) if merge else {}
+            _apply(current, data)
+            collection.write(self.id, current)
+
+    def update(self, data):
+        with self._db._lock:
+            collection = self._db._collection(self._collection_path)
+            if self.id not in collection.docs:
+                raise NotFound(f"No document to update: {self.path}")
+            current = dict(collection.docs[self.id])
+            _apply(current, data)
+            collection.write(self.id, current)
+
+    def create(self, data):
+        with self._db._lock:
+            collection = self._db._collection(self._collection_path)
+            if self.id in collection.docs:
+                raise AlreadyExists(f"Document already exists: {self.path}")
+            current = {}
+            _apply(current, data)
+            collection.write(self.id, current)
+
+    def delete(self):
+        with self._db._lock:
+            self._db._collection(self._collection_path).delete(self.id)
+
+
+class Query:
+    def __init__(self, db, path, filters=(), fields=None, limit=None, after=None):
+        self._db = db
+        self._path = path
+        self._filters = tuple(filters)
+        self._fields = fields
+        self._limit = limit
+        self._after = after
+
+    def _copy(self, **changes):
+        state = {'filters': self._filters, 'fields': self._fields, 'limit': self._limit, 'after': self._after}
+        state.update(changes)
+        return Query(self._db, self._path, **state)
+
+    def where(self, field_path=None, op_string=None, value=None, filter=None):
+        if filter is not None:
+            field_path, op_string, value = filter.field_path, filter.op_string, filter.value
+        return self._copy(filters=self._filters + ((field_path, op_string, value),))
+
+    def order_by(self, field_path, direction=None):
+        if field_path != '__name__':
+            raise NotImplementedError("FakeFirestore only orders by '__name__'.")
+        return self
+
+    def select(self, field_paths):
+        return self._copy(fields=list(field_paths))
+
+    def limit(self, count):
+        return self._copy(limit=count)
+
+    def start_after(self, document):
+        return self._copy(after=_id_of(document))
+
+    def stream(self):
+        with self._db._lock:
+            return iter(self._run())
+
+    def get(self):
+        return list(self.stream())
+
+    def _run(self):
+        collection = self._db._collection(self._path)
+        ids = collection.ids
+        remaining = []
+        lower, lower_inclusive, upper, upper_inclusive = self._after, False, None, False
+        for field, op, value in self._filters:
+            if field == '__name__':
+                doc_id = _id_of(value)
+                if op in ('>', '>=') and (lower is None or doc_id > lower):
+                    lower, lower_inclusive = doc_id, op == '>='
+                elif op in ('<', '<=') and (upper is None or doc_id < upper):
+                    upper, upper_inclusive = doc_id, op == '<='
+                elif op not in _RANGE_OPS:
+                    raise NotImplementedError(f"FakeFirestore does not support '{op}' on '__name__'.")
+            elif op in _INDEXED_OPS and ids is collection.ids:
+                ids = collection.candidates(field, op, value)
+            else:
+                remaining.append((field, op, value))
+
+        start = 0
+        if lower is not None:
+            start = (bisect.bisect_left if lower_inclusive else bisect.bisect_right)(ids, lower)
+        results = []
+        for position in range(start, len(ids)):
+            doc_id = ids[position]
+            if upper is not None and (doc_id > upper or (doc_id == upper and not upper_inclusive)):
+                break
+            data = collection.docs[doc_id]
+            if all(_matches(data, field, op, value) for field, op, value in remaining):
+                if self._fields is not None:
+                    data = {field: data[field] for field in self._fields if field in data}
+                reference = DocumentReference(self._db, f"{self._path}/{doc_id}")
+                results.append(DocumentSnapshot(reference, data))
+                if self._limit is not None and len(results) >= self._limit:
+                    break
+        return results
+
+
+class CollectionReference(Query):
+    def __init__(self, db, path):
+        super().__init__(db, path)
+        self.id = path.rsplit('/', 1)[-1]
+
+    def document(self, document_id):
+        return DocumentReference(self._db, f"{self._path}/{document_id}")
+
+
+class WriteBatch:
+    def __init__(self):
+        self._writes = []
+
+    def set(self, reference, data, merge=False):
+        self._writes.append(lambda: reference.set(data, merge=merge))
+
+    def update(self, reference, data):
+        self._writes.append(lambda: reference.update(data))
+
+    def create(self, reference, data):
+        self._writes.append(lambda: reference.create(data))
+
+    def delete(self, reference):
+        self._writes.append(reference.delete)
+
+    def commit(self):
+        writes, self._writes = self._writes, []
+        for write in writes:
+            write()
+        return writes
+
+
+class Transaction(WriteBatch):
+    """Writes are buffered and applied on commit; `transactional` holds the lock throughout."""
+
+    def __init__(self, db):
+        super().__init__()
+        self._db = db
+
+
+def transactional(function):
+    """Stand-in for firestore.transactional: runs `function` and commits, serialized on the db lock."""
+    def run(transaction, *args, **kwargs):
+        with transaction._db._lock:
+            result = function(transaction, *args, **kwargs)
+            transaction.commit()
+            return result
+    return run
+
+
+class FakeFirestore:
+    def __init__(self):
+        self._collections = {}
+        self._lock = threading.RLock()
+
+    def _collection(self, path):
+        collection = self._collections.get(path)
+        if collection is None:
+            collection = self._collections[path] = _Collection()
+        return collection
+
+    def collection(self, name):
+        return CollectionReference(self, name)
+
+    def batch(self):
+        return WriteBatch()
+
+    def transaction(self):
+        return Transaction(self)
+
+    def load(self, collection_path, documents):
+        """Bulk-seeds `collection_path` from (id, data) pairs, replacing what is there."""
+        with self._lock:
+            collection = self._collections[collection_path] = _Collection()
+            collection.docs = dict(documents)
+            collection.ids = sorted(collection.docs)
+
+    def ensure_index(self, collection_path, field):
+        """Builds the index for `field` now rather than in the first query that filters on it."""
+        with self._lock:
+            self._collection(collection_path).index(field)
+
+    def clear(self, collection_path):
+        with self._lock:
+            prefix = collection_path + '/'
+            for path in [p for p in self._collections if p == collection_path or p.startswith(prefix)]:
+                del self._collections[path]
+
+    def count(self, collection_path):
+        with self._lock:
+            return len(self._collection(collection_path).docs)
+
+
+def install(db):
+    """Routes the Admin SDK and google.cloud.firestore clients to `db`."""
+    import firebase_admin.firestore
+    import google.cloud.firestore
+
+    firebase_admin.firestore.client = lambda app=None, *args, **kwargs: db
+    google.cloud.firestore.Client = lambda *args, **kwargs: db
+    google.cloud.firestore.transactional = transactional
@@ -0,0 +1,219 @@
+"""
+Local load tests for the backend functions.
+
+Runs analyze_food, generate_report, send_daily_notification and
+test_send_notification in-process against local stand-ins for Vertex,
+Firestore and FCM (see scenarios.py), and reports per scenario: throughput,
+p50/p95/p99 latency, peak memory, import time and first-request time, and
+the mean time per traced stage. Nothing talks to foodjar-462805.
+
+Install the functions' requirements (requirements.txt here pulls them all
+in), then from backend/:
+
+    python benchmarks/run.py --label before            # full suite
+    python benchmarks/run.py --only analyze_food --vertex-latency-ms 800
+    python benchmarks/run.py --only send_daily --users 1000000
+    python benchmarks/run.py --compare benchmarks/results/before.json benchmarks/results/after.json
+
+Results are written to benchmarks/results/<label>.json. Numbers are only
+comparable between runs on the same machine with the same flags; both are
+recorded in the file.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+
+import scenarios
+
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+# What --compare shows, and whether a higher value is better.
+COMPARED_METRICS = [
+    ('throughput_rps', ('throughput_rps',), True),
+    ('p50_ms', ('latency_ms', 'p50'), False),
+    ('p95_ms', ('latency_ms', 'p95'), False),
+    ('p99_ms', ('latency_ms', 'p99'), False),
+    ('peak_rss_mb', ('memory_mb', 'peak_rss'), False),
+    ('import_ms', ('startup', 'import_ms'), False),
+    ('first_request_ms', ('startup', 'first_request_ms'), False),
+]
+
+
+def _lookup(metrics, path):
+    for key in path:
+        if not isinstance(metrics, dict) or key not in metrics:
+            return None
+        metrics = metrics[key]
+    return metrics
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=scenarios.BACKEND_DIR, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def select_scenarios(only, users=None, requests=None):
+    selected = [dict(s) for s in scenarios.SUITE if not only or any(term in s['name'] for term in only)]
+    for scenario in selected:
+        if users and 'users' in scenario:
+            scenario['users'] = users
+        if requests:
+            scenario['requests'] = requests
+    return selected
+
+
+def run_in_subprocess(scenario, settings, timeout):
+    """Runs one scenario in a fresh interpreter and returns its metrics."""
+    with tempfile.TemporaryDirectory() as scratch:
+        spec_path, result_path = os.path.join(scratch, 'spec.json'), os.path.join(scratch, 'result.json')
+        with open(spec_path, 'w') as f:
+            json.dump({'scenario': scenario, 'settings': settings}, f)
+        env = {**os.environ, **scenarios.scenario_env(scenario)}
+        completed = subprocess.run([sys.executable, os.path.abspath(__file__), '--worker', spec_path, result_path],
+                                   env=env, capture_output=True, text=True, timeout=timeout)
+        if completed.returncode != 0 or not os.path.exists(result_path):
+            return {'error': (completed.stderr or '').strip().splitlines()[-20:]}
+        with open(result_path) as f:
+            return json.load(f)
+
+
+def format_row(name, metrics):
+    if 'error' in metrics:
+        return f"{name:<40} FAILED: {metrics['error'][-1] if metrics['error'] else 'no output'}"
+    latency, memory = metrics['latency_ms'], metrics['memory_mb']
+    cells = [metrics['throughput_rps'], latency['p50'], latency['p95'], latency['p99'],
+             memory['peak_rss'], metrics['startup']['first_request_ms']]
+    return (f"{name:<40} {metrics['ok']:>4}/{metrics['requests']:<4} "
+            + ' '.join(f"{cell:>9.1f}" if cell is not None else f"{'-':>9}" for cell in cells))
+
+
+HEADER = (f"{'scenario':<40} {'ok/req':>9} {'req/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9} "
+          f"{'rss MB':>9} {'first ms':>9}")
+
+
+def run_suite(args):
+    settings = {
+        'vertex_latency_ms': args.vertex_latency_ms,
+        'vertex_jitter': args.vertex_jitter,
+        'vertex_output_chars_per_second': args.vertex_output_chars_per_second,
+        'vertex_error_rate': args.vertex_error_rate,
+        'fcm_latency_ms': args.fcm_latency_ms,
+        'fcm_transient_rate': args.fcm_transient_rate,
+        'seed': args.seed,
+        'tracemalloc': args.tracemalloc,
+    }
+    selected = select_scenarios(args.only, args.users, args.requests)
+    if not selected:
+        sys.exit(f"No scenario matches {args.only}. Use --list to see them.")
+
+    results = {
+        'label': args.label,
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'git_commit': _git_commit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpu_count': os.cpu_count(),
+        'settings': settings,
+        'scenarios': {},
+    }
+    print(HEADER)
+    for scenario in selected:
+        started = time.perf_counter()
+        try:
+            metrics = run_in_subprocess(scenario, settings, args.timeout)
+        except subprocess.TimeoutExpired:
+            metrics = {'error': [f"Timed out after {args.timeout}s."]}
+        metrics['elapsed_seconds'] = round(time.perf_counter() - started, 1)
+        results['scenarios'][scenario['name']] = {'scenario': scenario, 'metrics': metrics}
+        print(format_row(scenario['name'], metrics), flush=True)
+
+    os.makedirs(args.out, exist_ok=True)
+    path = os.path.join(args.out, f"{args.label}.json")
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, default=str)
+    print(f"\nResults written to {path}")
+    return results
+
+
+def compare(before_path, after_path):
+    """Prints each shared scenario's metrics before and after, with the relative change."""
+    with open(before_path) as f:
+        before = json.load(f)
+    with open(after_path) as f:
+        after = json.load(f)
+    for label, run in (('before', before), ('after', after)):
+        print(f"{label}: {run.get('label')} at {run.get('git_commit')} ({run.get('created_at')})")
+    if before.get('settings') != after.get('settings'):
+        print("warning: the runs used different settings; differences may not come from the change.")
+
+    print(f"\n{'scenario':<40} {'metric':<18} {'before':>10} {'after':>10} {'change':>9}")
+    for name, entry in after['scenarios'].items():
+        if name not in before['scenarios']:
+            continue
+        old_metrics, new_metrics = before['scenarios'][name]['metrics'], entry['metrics']
+        if 'error' in old_metrics or 'error' in new_metrics:
+            print(f"{name:<40} {'(failed in one run)':<18}")
+            continue
+        for metric, path, higher_is_better in COMPARED_METRICS:
+            old, new = _lookup(old_metrics, path), _lookup(new_metrics, path)
+            if old is None or new is None:
+                continue
+            if not old:
+                print(f"{name:<40} {metric:<18} {old:>10.1f} {new:>10.1f} {'-':>9}")
+                continue
+            change = (new - old) / old * 100
+            better = change > 0 if higher_is_better else change < 0
+            marker = '' if abs(change) < 5 else (' +' if better else ' -')
+            print(f"{name:<40} {metric:<18} {old:>10.1f} {new:>10.1f} {change:>+8.1f}%{marker}")
+    print("\n+/- marks changes of 5% or more for the better/worse.")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--only', nargs='*', help="Run scenarios whose name contains any of these terms.")
+    parser.add_argument('--list', action='store_true', help="List the scenarios and exit.")
+    parser.add_argument('--label', default=datetime.now().strftime('%Y%m%d-%H%M%S'),
+                        help="Name of the results file (default: a timestamp).")
+    parser.add_argument('--out', default=RESULTS_DIR, help="Directory for results files.")
+    parser.add_argument('--users', type=int, help="Seeded users for the notification scenarios (10k-1M).")
+    parser.add_argument('--requests', type=int, help="Timed calls per scenario, overriding the suite.")
+    parser.add_argument('--vertex-latency-ms', type=float, default=scenarios.DEFAULT_SETTINGS['vertex_latency_ms'])
+    parser.add_argument('--vertex-jitter', type=float, default=scenarios.DEFAULT_SETTINGS['vertex_jitter'],
+                        help="Log-normal sigma of the stub's latency.")
+    parser.add_argument('--vertex-output-chars-per-second', type=float,
+                        default=scenarios.DEFAULT_SETTINGS['vertex_output_chars_per_second'],
+                        help="Generation speed; longer responses take longer.")
+    parser.add_argument('--vertex-error-rate', type=float, default=scenarios.DEFAULT_SETTINGS['vertex_error_rate'])
+    parser.add_argument('--fcm-latency-ms', type=float, default=scenarios.DEFAULT_SETTINGS['fcm_latency_ms'],
+                        help="Latency of each 500-token FCM batch.")
+    parser.add_argument('--fcm-transient-rate', type=float, default=scenarios.DEFAULT_SETTINGS['fcm_transient_rate'])
+    parser.add_argument('--seed', type=int, default=scenarios.DEFAULT_SETTINGS['seed'])
+    parser.add_argument('--tracemalloc', action='store_true',
+                        help="Also report peak Python allocations during the timed calls (slows them down).")
+    parser.add_argument('--timeout', type=int, default=1800, help="Seconds allowed per scenario.")
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help="Compare two results files.")
+    parser.add_argument('--worker', nargs=2, help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.worker:
+        scenarios.worker_main(*args.worker)
+    elif args.compare:
+        compare(*args.compare)
+    elif args.list:
+        for scenario in select_scenarios(args.only):
+            print(scenario['name'])
+    else:
+        run_suite(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,359 @@
+"""
+Benchmark scenarios and the worker that runs one of them.
+
+Each scenario runs in its own process (see run.py): the function's directory
+goes first on sys.path, so its main.py and vendored modules load exactly as
+they do when deployed, and every scenario starts cold with its own memory
+high-water mark. Vertex is the stub backend from gemini_client.py with
+injected latency and errors, FCM is fcm_fanout.FakeMessaging, and Firestore
+is fake_firestore.FakeFirestore.
+
+A scenario makes one untimed warm-up call, whose latency is reported as
+first_request_ms, then `requests` timed calls issued by `concurrency` threads.
+Latency percentiles cover the successful calls; rejections and errors are
+counted in `statuses` (a 429 from admission control returns in microseconds
+and would otherwise pull p50 down).
+"""
+import json
+import os
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Defaults for the stand-ins; run.py overrides them from its flags.
+DEFAULT_SETTINGS = {
+    'vertex_latency_ms': 300,
+    'vertex_jitter': 0.3,
+    'vertex_output_chars_per_second': 800,  # Roughly 200 output tokens/s.
+    'vertex_error_rate': 0.0,
+    'fcm_latency_ms': 50,
+    'fcm_transient_rate': 0.0,
+    'seed': 0,
+    'tracemalloc': False,
+}
+
+SUITE = [
+    # analyze_food: image size and concurrency. Admission control (8 running,
+    # 16 queued) applies, so 429s at high concurrency are part of the result.
+    {'name': 'analyze_food/img512-c1', 'function': 'analyze_food', 'edge': 512, 'concurrency': 1, 'requests': 24},
+    {'name': 'analyze_food/img512-c8', 'function': 'analyze_food', 'edge': 512, 'concurrency': 8, 'requests': 48},
+    {'name': 'analyze_food/img1536-c8', 'function': 'analyze_food', 'edge': 1536, 'concurrency': 8, 'requests': 48},
+    {'name': 'analyze_food/img3024-c8', 'function': 'analyze_food', 'edge': 3024, 'concurrency': 8, 'requests': 48},
+    {'name': 'analyze_food/img1536-c32', 'function': 'analyze_food', 'edge': 1536, 'concurrency': 32, 'requests': 96},
+    {'name': 'analyze_food/img1536-json-c8', 'function': 'analyze_food', 'edge': 1536, 'concurrency': 8,
+     'requests': 48, 'format': 'json'},
+    # generate_report: input list length and report length (the stub takes
+    # longer to "generate" longer reports, see vertex_output_chars_per_second).
+    {'name': 'generate_report/short-c1', 'function': 'generate_report', 'titles': 10, 'words': 150,
+     'concurrency': 1, 'requests': 10},
+    {'name': 'generate_report/short-c8', 'function': 'generate_report', 'titles': 10, 'words': 150,
+     'concurrency': 8, 'requests': 32},
+    {'name': 'generate_report/week-c8', 'function': 'generate_report', 'titles': 60, 'words': 400,
+     'concurrency': 8, 'requests': 32},
+    {'name': 'generate_report/long-c8', 'function': 'generate_report', 'titles': 250, 'words': 1000,
+     'concurrency': 8, 'requests': 32},
+    {'name': 'generate_report/week-c8-repeat', 'function': 'generate_report', 'titles': 60, 'words': 400,
+     'concurrency': 8, 'requests': 32, 'repeat_rate': 0.5},
+    # Notifications: one call is a whole run over the seeded users.
+    {'name': 'send_daily_notification/10k', 'function': 'send_daily_notification', 'users': 10_000, 'requests': 3},
+    {'name': 'send_daily_notification/100k', 'function': 'send_daily_notification', 'users': 100_000, 'requests': 3},
+    {'name': 'send_daily_notification/100k-4shards', 'function': 'send_daily_notification', 'users': 100_000,
+     'requests': 3, 'shards': 4},
+    {'name': 'test_send_notification/10k', 'function': 'test_send_notification', 'users': 10_000, 'requests': 3},
+]
+
+FUNCTION_DIRS = {
+    'analyze_food': 'analyze_food',
+    'generate_report': 'generate_report',
+    'send_daily_notification': 'send_notifications',
+    'test_send_notification': 'test_send_notification',
+}
+
+
+def scenario_env(scenario):
+    """Environment for the scenario's process, set before the function is imported."""
+    env = {
+        'GEMINI_BACKEND': 'stub',
+        'FCM_BACKEND': 'fake',
+        'TRACE_DEBUG_SAMPLE_RATE': '0',
+        'ANALYZE_CACHE_STORE': 'memory',
+        'NOTIFY_STAGGER_MINUTES': '0',
+        'NOTIFY_SHARDS': str(scenario.get('shards', 1)),
+    }
+    env.update({key: str(value) for key, value in scenario.get('env', {}).items()})
+    return env
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(1, -(-len(sorted_values) * pct // 100))
+    return sorted_values[int(rank) - 1]
+
+
+def _round(value, digits=1):
+    return round(value, digits) if value is not None else None
+
+
+def _rss_mb():
+    try:
+        with open('/proc/self/statm') as f:
+            return round(int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') / 2**20, 1)
+    except OSError:
+        return None
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports KiB, macOS bytes.
+    return round(peak / (2**20 if sys.platform == 'darwin' else 2**10), 1)
+
+
+# --- Drivers: prepare(main, scenario, settings, db) -> (calls, extras) ---
+# Each call returns an HTTP-like status; extras(trace_records) adds driver-specific metrics.
+
+def _install_fake_vertex(settings, responder=None):
+    from gemini_client import StubBackend, set_backend
+
+    set_backend(StubBackend(responder=responder,
+                            latency_seconds=settings['vertex_latency_ms'] / 1000,
+                            latency_jitter=settings['vertex_jitter'],
+                            output_chars_per_second=settings['vertex_output_chars_per_second'],
+                            error_rate=settings['vertex_error_rate'],
+                            seed=settings['seed']))
+
+
+def _install_fake_fcm(settings):
+    import fcm_fanout
+
+    fake = fcm_fanout.FakeMessaging(latency_seconds=settings['fcm_latency_ms'] / 1000,
+                                    transient_rate=settings['fcm_transient_rate'],
+                                    seed=settings['seed'])
+    fcm_fanout.default_backend = lambda: fake
+    return fake
+
+
+def _flask_request(**kwargs):
+    from flask import Request
+    from werkzeug.test import EnvironBuilder
+
+    builder = EnvironBuilder(**kwargs)
+    try:
+        return Request(builder.get_environ())
+    finally:
+        builder.close()
+
+
+def prepare_analyze_food(main, scenario, settings, db):
+    import base64
+    import workloads
+
+    _install_fake_vertex(settings)
+    edge, fmt = scenario.get('edge', 1024), scenario.get('format', 'raw')
+    count = scenario['requests'] + 1
+    # Distinct images, so every request misses the result cache.
+    images = [workloads.image_bytes(edge, seed=settings['seed'] * 100_003 + i) for i in range(count)]
+
+    def build(index):
+        # One client address each (the platform-appended, right-most hop), so
+        # per-caller rate limits stay out of it.
+        headers = {'X-Forwarded-For': f"203.0.113.9, 10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}"}
+        if fmt == 'json':
+            body = json.dumps({'image_data': base64.b64encode(images[index]).decode('ascii')})
+            return _flask_request(method='POST', data=body, content_type='application/json', headers=headers)
+        return _flask_request(method='POST', data=images[index], content_type='image/jpeg', headers=headers)
+
+    # Requests are built ahead of time; only the handler is timed.
+    requests = [build(i) for i in range(count)]
+    calls = [lambda request=request: main.analyze_food(request)[1] for request in requests]
+    extras = lambda records: {'image_bytes': len(images[0]), 'edge': edge, 'format': fmt}
+    return calls, extras
+
+
+def prepare_generate_report(main, scenario, settings, db):
+    import random
+    import firebase_admin.auth
+    import flask
+    import workloads
+
+    words = scenario.get('words', 400)
+    report = workloads.report_text(words, seed=settings['seed'])
+    _install_fake_vertex(settings, responder=lambda model, contents, config: report)
+    # Calls go through the callable protocol (JSON envelope, ID-token check);
+    # the "ID token" is just the uid.
+    firebase_admin.auth.verify_id_token = lambda token, *args, **kwargs: {'uid': token}
+    app = flask.Flask('benchmarks')
+
+    rng = random.Random(settings['seed'])
+    count = scenario['requests'] + 1
+    payloads = []
+    for index in range(count):
+        if payloads and rng.random() < scenario.get('repeat_rate', 0.0):
+            payloads.append(rng.choice(payloads))  # Same foods again: cache or stored report.
+        else:
+            # A unique item makes each new list its own report key.
+            titles = workloads.food_titles(scenario.get('titles', 30), seed=index) + [f"snack {index}"]
+            payloads.append({'food_names': titles})
+    contexts = [app.test_request_context(method='POST', json={'data': payload},
+                                         headers={'Authorization': f"Bearer bench-{index % 50}"})
+                for index, payload in enumerate(payloads)]
+
+    def call(context):
+        with context:
+            return main.generate_report(flask.request).status_code
+
+    calls = [lambda context=context: call(context) for context in contexts]
+    extras = lambda records: {'titles': scenario.get('titles', 30), 'report_words': words,
+                              'report_cache': main.get_report_cache().stats()}
+    return calls, extras
+
+
+def _prepare_notification_run(main, scenario, settings, db, handler, build_request):
+    import workloads
+
+    fake_fcm = _install_fake_fcm(settings)
+    users = scenario.get('users', 10_000)
+    workloads.seed_users(db, users, seed=settings['seed'], buckets=scenario['function'] == 'send_daily_notification')
+
+    def call():
+        db.clear('notification_runs')  # Sharded runs would otherwise replay the first run's result.
+        return handler(build_request())[1]
+
+    def extras(records):
+        # The coordinator's or the single run's record (shard workers emit their own).
+        runs = [r for r in records if r.get('trace') in ('send_daily_notification', 'test_send_notification')]
+        sent = sum(r.get('success', r.get('fanout', {}).get('success', 0))
+                   + r.get('failure', r.get('fanout', {}).get('failure', 0)) for r in runs)
+        seconds = sum(r['duration_ms'] for r in runs) / 1000
+        return {'users': users, 'tokens_per_run': round(sum(r.get('tokens') or 0 for r in runs) / max(1, len(runs))),
+                'messages_per_second': round(sent / seconds) if seconds else None,
+                'fcm_calls': fake_fcm.calls, 'fcm_delivered': fake_fcm.delivered}
+    return [call] * (scenario['requests'] + 1), extras
+
+
+def prepare_send_daily_notification(main, scenario, settings, db):
+    return _prepare_notification_run(main, scenario, settings, db, main.send_daily_notification,
+                                     lambda: _flask_request(method='GET'))
+
+
+def prepare_test_send_notification(main, scenario, settings, db):
+    return _prepare_notification_run(main, scenario, settings, db, main.test_send_notification,
+                                     lambda: _flask_request(method='POST', json={}))
+
+
+DRIVERS = {
+    'analyze_food': prepare_analyze_food,
+    'generate_report': prepare_generate_report,
+    'send_daily_notification': prepare_send_daily_notification,
+    'test_send_notification': prepare_test_send_notification,
+}
+
+
+def _timed(call):
+    started = time.perf_counter()
+    try:
+        status = call()
+    except Exception as e:
+        status = type(e).__name__
+    return (time.perf_counter() - started) * 1000, status
+
+
+def _span_means(records, requests):
+    totals = Counter()
+    for record in records:
+        for name, stats in record.get('spans', {}).items():
+            totals[name] += stats['total_ms']
+    return {name: round(total / requests, 2) for name, total in sorted(totals.items())}
+
+
+def run_scenario(scenario, settings):
+    """Runs `scenario` in this process and returns its metrics."""
+    function_dir = os.path.join(BACKEND_DIR, FUNCTION_DIRS[scenario['function']])
+    sys.path.insert(0, function_dir)
+    sys.path.insert(1, os.path.dirname(os.path.abspath(__file__)))
+
+    started = time.perf_counter()
+    import main
+    import_ms = (time.perf_counter() - started) * 1000
+
+    # Installed after the import, which must not pay for the fake's own imports.
+    # Every function creates its Firestore client on first use, so none has one yet.
+    import fake_firestore
+    db = fake_firestore.FakeFirestore()
+    fake_firestore.install(db)
+
+    # Trace records are collected instead of printed; span timings come from them.
+    import instrumentation
+    records = []
+    instrumentation._emit = records.append
+
+    calls, extras = DRIVERS[scenario['function']](main, scenario, settings, db)
+    first_request_ms, first_status = _timed(calls[0])
+    calls = calls[1:]
+    del records[:]
+
+    if settings['tracemalloc']:
+        tracemalloc.start()
+    rss_before = _rss_mb()
+    latencies, statuses = [], Counter()
+    lock = threading.Lock()
+
+    def timed(call):
+        elapsed_ms, status = _timed(call)
+        with lock:
+            if isinstance(status, int) and status < 400:
+                latencies.append(elapsed_ms)
+            statuses[str(status)] += 1
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=scenario.get('concurrency', 1)) as executor:
+        list(executor.map(timed, calls))
+    wall_seconds = time.perf_counter() - started
+    traced_peak = tracemalloc.get_traced_memory()[1] if settings['tracemalloc'] else None
+    if settings['tracemalloc']:
+        tracemalloc.stop()
+
+    latencies.sort()
+    ok = len(latencies)
+    return {
+        'requests': len(calls),
+        'concurrency': scenario.get('concurrency', 1),
+        'ok': ok,
+        'statuses': dict(statuses),
+        'wall_seconds': round(wall_seconds, 3),
+        'throughput_rps': round(len(calls) / wall_seconds, 2) if wall_seconds else None,
+        'latency_ms': {
+            'p50': _round(percentile(latencies, 50)),
+            'p95': _round(percentile(latencies, 95)),
+            'p99': _round(percentile(latencies, 99)),
+            'max': _round(latencies[-1] if latencies else None),
+            'mean': _round(sum(latencies) / ok if ok else None),
+        },
+        'memory_mb': {
+            'rss_before_run': rss_before,
+            'peak_rss': _peak_rss_mb(),
+            'peak_traced': round(traced_peak / 2**20, 1) if traced_peak is not None else None,
+        },
+        'startup': {'import_ms': round(import_ms, 1), 'first_request_ms': round(first_request_ms, 1),
+                    'first_status': str(first_status)},
+        'span_mean_ms': _span_means(records, len(calls)),
+        **extras(records),
+    }
+
+
+def worker_main(spec_path, result_path):
+    """Entry point of a scenario's process: reads the spec, writes the metrics."""
+    with open(spec_path) as f:
+        spec = json.load(f)
+    # The functions log to stdout; keep it out of the runner's output.
+    sys.stdout = open(os.devnull, 'w')
+    metrics = run_scenario(spec['scenario'], {**DEFAULT_SETTINGS, **spec['settings']})
+    with open(result_path, 'w') as f:
+        json.dump(metrics, f, default=str)
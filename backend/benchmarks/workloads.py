@@ -0,0 +1,100 @@
+"""
+Synthetic inputs for the benchmark scenarios: seeded users for the fake
+Firestore, food images of a given size and food-title lists for reports.
+Everything is generated from a seed, so two runs of the same scenario see
+the same data.
+"""
+import io
+import random
+import string
+
+# Firebase Auth ids: 28 alphanumeric characters.
+_ID_ALPHABET = string.digits + string.ascii_uppercase + string.ascii_lowercase
+_ID_LENGTH = 28
+
+# Where the app's users are, roughly: (timezone, weight).
+USER_TIMEZONES = [
+    ('America/Los_Angeles', 14), ('America/Denver', 4), ('America/Chicago', 10),
+    ('America/New_York', 18), ('America/Sao_Paulo', 4), ('America/Mexico_City', 3),
+    ('Europe/London', 8), ('Europe/Berlin', 7), ('Europe/Paris', 5), ('Europe/Madrid', 3),
+    ('Africa/Lagos', 2), ('Asia/Dubai', 2), ('Asia/Kolkata', 5), ('Asia/Singapore', 3),
+    ('Asia/Shanghai', 3), ('Asia/Tokyo', 4), ('Australia/Adelaide', 1), ('Australia/Sydney', 3),
+    ('Pacific/Auckland', 1),
+]
+
+FOODS = [
+    'apple', 'banana', 'oatmeal', 'greek yogurt', 'scrambled eggs', 'avocado toast', 'caesar salad',
+    'chicken burrito', 'pepperoni pizza', 'salmon', 'brown rice', 'broccoli', 'ramen', 'sushi roll',
+    'cheeseburger', 'french fries', 'lentil soup', 'tofu stir fry', 'blueberries', 'almonds',
+    'dark chocolate', 'croissant', 'pad thai', 'hummus', 'carrot sticks', 'steak', 'quinoa bowl',
+    'pancakes', 'ice cream', 'green smoothie', 'bagel with cream cheese', 'chickpea curry',
+]
+
+
+def user_id(rng):
+    return ''.join(rng.choices(_ID_ALPHABET, k=_ID_LENGTH))
+
+
+def seed_users(db, count, seed=0, token_rate=0.9, dead_token_rate=0.02, buckets=True):
+    """
+    Loads `count` users into db's `users` collection, spread over
+    USER_TIMEZONES, with their notification buckets filled in when `buckets`
+    is set (it needs send_notifications' notification_buckets on the path).
+    A `token_rate` share of them have an FCM token, and `dead_token_rate` of
+    those tokens fail as unregistered (FakeMessaging's "dead-" prefix).
+    Returns {timezone: users}.
+    """
+    rng = random.Random(seed)
+    zones = [tz for tz, _ in USER_TIMEZONES]
+    weights = [weight for _, weight in USER_TIMEZONES]
+    indexed = ['fcmToken']  # Token pruning looks users up by token.
+    if buckets:
+        from notification_buckets import HOURS_FIELD, bucket_fields
+        buckets = {tz: bucket_fields(tz) for tz in zones}
+        indexed.append(HOURS_FIELD)
+    else:
+        buckets = dict.fromkeys(zones, {})
+    per_zone = dict.fromkeys(zones, 0)
+
+    def users():
+        for index, tz in enumerate(rng.choices(zones, weights=weights, k=count)):
+            per_zone[tz] += 1
+            data = {'timezone': tz, **buckets[tz]}
+            if rng.random() < token_rate:
+                prefix = 'dead-' if rng.random() < dead_token_rate else 'tok-'
+                data['fcmToken'] = f"{prefix}{index:08d}-{rng.getrandbits(64):016x}"
+            yield user_id(rng), data
+
+    db.load('users', users())
+    for field in indexed:
+        db.ensure_index('users', field)
+    return per_zone
+
+
+def image_bytes(edge, seed=0, fmt='JPEG'):
+    """An edge x edge photo-like image: smooth gradients plus noise, so it compresses like a photo."""
+    from PIL import Image
+
+    rng = random.Random(seed)
+    small = Image.frombytes('RGB', (16, 16), bytes(rng.getrandbits(8) for _ in range(16 * 16 * 3)))
+    detail = max(16, edge // 4)
+    image = small.resize((detail, detail), Image.BICUBIC)
+    noise = Image.frombytes('L', (detail, detail), rng.randbytes(detail * detail)).convert('RGB')
+    image = Image.blend(image, noise, 0.12).resize((edge, edge), Image.BICUBIC)
+    out = io.BytesIO()
+    image.save(out, format=fmt, quality=90)
+    return out.getvalue()
+
+
+def food_titles(count, seed=0):
+    """`count` titles drawn from FOODS, with repeats like a real week's jar."""
+    rng = random.Random(seed)
+    return [rng.choice(FOODS) for _ in range(count)]
+
+
+def report_text(words, seed=0):
+    """A stub report of about `words` words."""
+    rng = random.Random(seed)
+    vocabulary = ['protein', 'fiber', 'balanced', 'vegetables', 'week', 'energy', 'hydration', 'great',
+                  'snacks', 'variety', 'whole', 'grains', 'sugar', 'healthy', 'fats', 'keep', 'going']
+    return ' '.join(rng.choice(vocabulary) for _ in range(words))
@@ -0,0 +1,208 @@
+"""
+Lightweight request instrumentation.
+
+Each request runs under a Trace (`traced` decorator or `start_trace`). Code
+anywhere below it records stage timings with `span(...)` and Gemini token
+usage with `record_usage(response)`. When the request finishes, the trace
+emits ONE structured JSON record on stdout, which Cloud Logging parses into
+jsonPayload and severity. The record holds the status, the total duration,
+per-stage count/total/max milliseconds, token counts and any fields set on
+the way.
+
+Per-item detail (prompts, payloads, per-batch lines) goes through `debug`.
+It is only written for a sampled fraction of requests
+(TRACE_DEBUG_SAMPLE_RATE), so production does not pay per-item log I/O.
+
+The active trace lives in a context variable. Work handed to other threads
+does not inherit it, so components that use thread pools capture `current()`
+and pass it along (or `activate()` it in the worker). Outside a trace,
+`current()` returns a no-op trace.
+
+Each function directory is deployed as its own source bundle, so this file is
+vendored into all four function directories. Keep the copies identical.
+"""
+import contextvars
+import functools
+import json
+import os
+import random
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+import startup
+
+# --- CONFIGURATION ---
+DEBUG_SAMPLE_RATE = float(os.environ.get("TRACE_DEBUG_SAMPLE_RATE", "0.01"))
+
+_USAGE_FIELDS = ('prompt_token_count', 'candidates_token_count', 'total_token_count', 'cached_content_token_count')
+_current = contextvars.ContextVar('trace', default=None)
+
+
+def _emit(record):
+    print(json.dumps(record, default=str), flush=True)
+
+
+class Trace:
+    def __init__(self, name, sampled=None, **fields):
+        self.name = name
+        self.fields = dict(fields)
+        self.sampled = random.random() < DEBUG_SAMPLE_RATE if sampled is None else sampled
+        self.spans = {}
+        self.usage = Counter()
+        self.model_calls = 0
+        self.started = time.perf_counter()
+        self._lock = threading.Lock()
+        self._token = None
+        startup.mark_request_started()
+
+    @contextmanager
+    def span(self, name):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_span(name, (time.perf_counter() - started) * 1000)
+
+    def add_span(self, name, elapsed_ms):
+        with self._lock:
+            stats = self.spans.setdefault(name, {'count': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+            stats['count'] += 1
+            stats['total_ms'] += elapsed_ms
+            stats['max_ms'] = max(stats['max_ms'], elapsed_ms)
+
+    def record_usage(self, response):
+        """Adds a Gemini response's usage_metadata token counts, if it has any."""
+        usage = getattr(response, 'usage_metadata', None)
+        if usage is None:
+            return
+        with self._lock:
+            self.model_calls += 1
+            for field in _USAGE_FIELDS:
+                self.usage[field] += getattr(usage, field, 0) or 0
+
+    def set(self, **fields):
+        with self._lock:
+            self.fields.update(fields)
+
+    def debug(self, message, **fields):
+        if self.sampled:
+            _emit({'severity': 'DEBUG', 'trace': self.name, 'message': message, **fields})
+
+    def record(self, status=None, error=None):
+        with self._lock:
+            record = {
+                'severity': 'ERROR' if error else 'INFO',
+                'message': f"{self.name} {status if status is not None else 'ok'}",
+                'trace': self.name,
+                'status': status,
+                'duration_ms': round((time.perf_counter() - self.started) * 1000, 1),
+                'spans': {name: {'count': stats['count'],
+                                 'total_ms': round(stats['total_ms'], 1),
+                                 'max_ms': round(stats['max_ms'], 1)}
+                          for name, stats in self.spans.items()},
+                **self.fields,
+            }
+            if self.model_calls:
+                record['tokens'] = {'model_calls': self.model_calls, **self.usage}
+        if error is not None:
+            record['error'] = f"{type(error).__name__}: {error}"
+        return record
+
+    @contextmanager
+    def activate(self):
+        """Makes this the current trace for the block, e.g. in a worker thread."""
+        token = _current.set(self)
+        try:
+            yield self
+        finally:
+            _current.reset(token)
+
+    def finish(self, status=None, error=None):
+        """Emits the request record; an instance's first one also carries its startup report."""
+        with self._lock:
+            status = self.fields.pop('status', status)
+        record = self.record(status=status, error=error)
+        report = startup.take_report()
+        if report:
+            record['startup'] = report
+        _emit(record)
+
+    def __enter__(self):
+        self._token = _current.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        _current.reset(self._token)
+        self.finish(error=exc)
+        return False
+
+
+class _NullTrace:
+    sampled = False
+
+    @contextmanager
+    def span(self, name):
+        yield
+
+    def add_span(self, name, elapsed_ms):
+        pass
+
+    def record_usage(self, response):
+        pass
+
+    def set(self, **fields):
+        pass
+
+    def debug(self, message, **fields):
+        pass
+
+    @contextmanager
+    def activate(self):
+        yield self
+
+    def finish(self, status=None, error=None):
+        pass
+
+
+_NULL = _NullTrace()
+
+
+def current():
+    return _current.get() or _NULL
+
+
+def start_trace(name, **fields):
+    return Trace(name, **fields)
+
+
+def span(name):
+    return current().span(name)
+
+
+def record_usage(response):
+    current().record_usage(response)
+
+
+def debug(message, **fields):
+    current().debug(message, **fields)
+
+
+def _status_of(result):
+    if isinstance(result, tuple) and len(result) > 1 and isinstance(result[1], int):
+        return result[1]
+    return getattr(result, 'status_code', 200)
+
+
+def traced(name):
+    """Runs the decorated handler under a trace and records its response status."""
+    def decorate(handler):
+        @functools.wraps(handler)
+        def wrapper(*args, **kwargs):
+            with start_trace(name) as trace:
+                result = handler(*args, **kwargs)
+                trace.set(status=_status_of(result))
+                return result
+        return wrapper
+    return decorate
@@ -1,17 +1,36 @@
 # Welcome to Cloud Functions for Firebase for Python!
 # To get started, simply uncomment the below code or create your own.
 
+# Imported first so the startup report times the whole module load.
+import startup
+
 # The Cloud Functions for Firebase SDK to create Cloud Functions and set up triggers.
-from firebase_functions import https_fn, options
+from firebase_functions import https_fn, options, scheduler_fn
 
-# The Firebase Admin SDK to access Cloud Firestore.
-from firebase_admin import initialize_app
-import vertexai
-from vertexai.generative_models import GenerativeModel
+# The Firebase Admin SDK. Cloud Firestore is imported on first use (see get_db).
+from firebase_admin import initialize_app, auth
+from datetime import timezone
+import json
 import logging
 
+from gemini_client import get_client
+import instrumentation
+from report import generate_report_text, report_key, stream_report_text, titles_from_payload
+from report_cache import get_report_cache
+import weekly_reports
+
 initialize_app()
 
+
+def get_db():
+    """
+    The Firestore client. The Admin SDK creates it once per instance; importing
+    google.cloud.firestore here keeps it off the load path of requests that
+    never touch Firestore (report cache hits).
+    """
+    from firebase_admin import firestore
+    return firestore.client()
+
 # Configure logging
 logging.basicConfig(level=logging.INFO)
 
@@ -19,14 +38,15 @@ logging.basicConfig(level=logging.INFO)
     region=options.SupportedRegion.US_CENTRAL1,
     memory=options.MemoryOption.MB_512
 )
+@instrumentation.traced('generate_report')
 def generate_report(req: https_fn.Request) -> https_fn.Response:
     """
     Takes a list of food items and generates a nutritional report using the Gemini API.
+    Each call emits one structured trace record (see instrumentation.py).
     """
-    logging.info("generate_report function triggered.")
+    trace = instrumentation.current()
     # 1. Check for authentication
     if req.auth is None:
-        logging.error("Function called without authentication.")
         raise https_fn.HttpsError(
             code=https_fn.FunctionsErrorCode.UNAUTHENTICATED,
             message="The function must be called while authenticated.",
@@ -35,71 +55,55 @@ def generate_report(req: https_fn.Request) -> https_fn.Response:
     try:
         # 2. Extract data from the request.
         payload = req.data
-        logging.info(f"Received payload: {payload}")
-
-        food_titles = []
-        if isinstance(payload, list):
-            food_titles = payload
-        elif isinstance(payload, dict):
-            # If the payload is a dict, assume the values are the food titles.
-            # This can happen depending on how the client SDK serializes an array.
-            food_titles = list(payload.values())
-        else:
-            logging.error(f"Invalid payload type: {type(payload)}. Expected a list or dict.")
+        trace.debug("Received payload.", payload=payload)
+
+        try:
+            with trace.span('parse'):
+                flattened_titles = titles_from_payload(payload)
+        except ValueError as e:
+            trace.set(error=str(e))
             raise https_fn.HttpsError(
                 code=https_fn.FunctionsErrorCode.INVALID_ARGUMENT,
                 message="Payload must be a list of food name strings.",
             )
 
-        logging.info(f"Successfully parsed {len(food_titles)} food titles.")
-
-        
-        # Flatten the list in case it's a list of lists (e.g., [['apple'], ['banana']])
-        flattened_titles = []
-        for item in food_titles:
-            if isinstance(item, str):
-                flattened_titles.append(item)
-            elif isinstance(item, list):
-                flattened_titles.extend(item)  # Add all items from the sublist
-
         if not flattened_titles:
-            logging.warning("List was empty after flattening.")
             raise https_fn.HttpsError(
                 code=https_fn.FunctionsErrorCode.INVALID_ARGUMENT,
                 message="Food name list cannot be empty.",
             )
 
-        logging.info(f"Final flattened list before join: {flattened_titles}")
-        # 3. Initialize the Vertex AI client
-        vertexai.init(project="foodjar-462805", location="us-central1")
-        model = GenerativeModel(model_name="gemini-2.0-flash")
-
-        # 4. Construct the prompt for Gemini
-        prompt = f"""
-        You are a friendly, encouraging nutritionist. Based on the following list of foods a user has consumed this week, please provide a brief, positive, and insightful weekly report.
-
-        The user ate: {', '.join(flattened_titles)}.
-
-        Please structure the report with the following sections, using markdown for formatting:
-
-        **Macros Overview:** Briefly summarize the estimated intake of protein, fats, and carbohydrates. Provide a general calorie estimate.
-        **Vitamin & Mineral Spotlight:** Highlight one or two key vitamins or minerals consumed this week and explain their benefits.
-        **The Rainbow Check:** Comment on the variety and color of the foods eaten. Encourage eating a "rainbow" of foods for a wider range of nutrients.
-        **Fiber Facts:** Briefly touch on the importance of fiber and estimate if the user had good sources of it this week.
-        **A Positive Tip for Next Week:** Provide one simple, actionable, and encouraging tip for the user for the following week.
-
-        Keep the tone light, positive, and non-judgmental. Start the report with a friendly greeting like "Here's your weekly food recap!".
-        """
-        logging.info("Prompt constructed successfully. Sending to Gemini API.")
-        
-        # 5. Generate content using the Gemini API
-        response = model.generate_content(prompt)
-        logging.info(f"Received response from Gemini API: {response}")
-        
-        report_text = response.text
-        logging.info("Successfully extracted text from Gemini response.")
-
-        # 6. Return the generated report
+        # 3. Serve a cached, precomputed or previously generated report if there is one.
+        key = report_key(flattened_titles)
+        cache = get_report_cache()
+        cached_report = cache.get(key)
+        if cached_report is not None:
+            trace.set(source='cache', report_cache=cache.stats())
+            return cached_report
+
+        db = get_db()
+        try:
+            with trace.span('firestore_get'):
+                stored_report = weekly_reports.get_stored_report(db, req.auth.uid, key)
+        except Exception as e:
+            logging.warning(f"Could not read stored report: {e}")
+            stored_report = None
+        if stored_report is not None:
+            cache.put(key, stored_report)
+            trace.set(source='stored', report_cache=cache.stats())
+            return stored_report
+
+        # 4. Otherwise generate it live, and store it so the next read is instant.
+        report_text = generate_report_text(flattened_titles)
+        cache.put(key, report_text)
+        trace.set(source='live', report_cache=cache.stats())
+        try:
+            with trace.span('firestore_set'):
+                weekly_reports.store_report(db, req.auth.uid, key, report_text, flattened_titles, source='live')
+        except Exception as e:
+            logging.warning(f"Could not store generated report: {e}")
+
+        # 5. Return the generated report
         return report_text
 
     except Exception as e:
@@ -107,4 +111,139 @@ def generate_report(req: https_fn.Request) -> https_fn.Response:
         raise https_fn.HttpsError(
             code=https_fn.FunctionsErrorCode.INTERNAL,
             message="An unexpected error occurred while generating the report.",
-        ) 
\ No newline at end of file
+        )
+
+
+def _sse(event, data):
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+@https_fn.on_request(
+    region=options.SupportedRegion.US_CENTRAL1,
+    memory=options.MemoryOption.MB_512,
+    cors=options.CorsOptions(cors_origins="*", cors_methods=["post"])
+)
+def generate_report_stream(req: https_fn.Request) -> https_fn.Response:
+    """
+    Streaming variant of generate_report. Takes the same payload (optionally
+    wrapped in {"data": ...}) with a Firebase ID token in the Authorization
+    header, and answers with Server-Sent Events:
+        event: chunk  data: {"text": "..."}   (repeated as the model streams)
+        event: done   data: {"source": "live" | "cache" | "stored"}
+        event: error  data: {"message": "..."}
+    The finished text is cached and stored, so later reads are instant. The
+    trace record is emitted when the stream ends.
+    """
+    header = req.headers.get('Authorization', '')
+    if not header.startswith('Bearer '):
+        return https_fn.Response(json.dumps({"error": "Missing bearer token."}), status=401, mimetype='application/json')
+    try:
+        user_id = auth.verify_id_token(header[len('Bearer '):])['uid']
+    except Exception as e:
+        logging.error(f"Invalid ID token: {e}")
+        return https_fn.Response(json.dumps({"error": "Invalid ID token."}), status=401, mimetype='application/json')
+
+    body = req.get_json(silent=True)
+    payload = body.get('data', body) if isinstance(body, dict) else body
+    try:
+        flattened_titles = titles_from_payload(payload)
+    except ValueError as e:
+        logging.error(str(e))
+        flattened_titles = []
+    if not flattened_titles:
+        return https_fn.Response(json.dumps({"error": "Food name list cannot be empty."}), status=400, mimetype='application/json')
+
+    key = report_key(flattened_titles)
+    cache = get_report_cache()
+    db = get_db()
+
+    def events():
+        # The body runs after the handler has returned, so the trace is passed
+        # explicitly rather than taken from the context.
+        trace = instrumentation.start_trace('generate_report_stream')
+        try:
+            yield from _report_events(trace)
+        finally:
+            trace.finish(status=200)
+
+    def _report_events(trace):
+        cached_report = cache.get(key)
+        if cached_report is not None:
+            trace.set(source='cache')
+            yield _sse("chunk", {"text": cached_report})
+            yield _sse("done", {"source": "cache"})
+            return
+        try:
+            with trace.span('firestore_get'):
+                stored_report = weekly_reports.get_stored_report(db, user_id, key)
+        except Exception as e:
+            logging.warning(f"Could not read stored report: {e}")
+            stored_report = None
+        if stored_report is not None:
+            cache.put(key, stored_report)
+            trace.set(source='stored')
+            yield _sse("chunk", {"text": stored_report})
+            yield _sse("done", {"source": "stored"})
+            return
+
+        trace.set(source='live')
+        parts = []
+        try:
+            for text in stream_report_text(flattened_titles, trace):
+                parts.append(text)
+                yield _sse("chunk", {"text": text})
+        except Exception as e:
+            logging.error(f"Streaming generation failed: {e}", exc_info=True)
+            trace.set(error=f"{type(e).__name__}: {e}")
+            yield _sse("error", {"message": "An unexpected error occurred while generating the report."})
+            return
+
+        report_text = "".join(parts)
+        cache.put(key, report_text)
+        trace.set(report_cache=cache.stats())
+        try:
+            with trace.span('firestore_set'):
+                weekly_reports.store_report(db, user_id, key, report_text, flattened_titles, source='live')
+        except Exception as e:
+            logging.warning(f"Could not store generated report: {e}")
+        yield _sse("done", {"source": "live"})
+
+    return https_fn.Response(events(), status=200, mimetype='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@scheduler_fn.on_schedule(
+    schedule="every 1 hours",
+    region=options.SupportedRegion.US_CENTRAL1,
+    memory=options.MemoryOption.MB_512,
+    timeout_sec=540,
+    retry_count=3,
+    min_backoff_seconds=60,
+    max_backoff_seconds=600
+)
+def precompute_weekly_reports(event: scheduler_fn.ScheduledEvent) -> None:
+    """
+    Hourly job: generates reports in advance for users whose week ends now
+    (early Sunday, local time). Checkpointed per run, so a retry of the same
+    hour resumes where the previous attempt stopped. Earlier runs that never
+    finished are resumed first.
+    """
+    utc_now = event.schedule_time
+    if utc_now.tzinfo is None:
+        utc_now = utc_now.replace(tzinfo=timezone.utc)
+    utc_now = utc_now.astimezone(timezone.utc)
+    run_id = utc_now.strftime(weekly_reports.RUN_ID_FORMAT)
+    with instrumentation.start_trace('precompute_weekly_reports', run_id=run_id):
+        db = get_db()
+        weekly_reports.resume_unfinished(db, run_id)
+        weekly_reports.run_precompute(db, run_id, utc_now)
+
+
+def _warm_up():
+    """Builds the report model and the Firestore client before the first call needs them."""
+    get_client().warm()
+    get_db()
+
+
+startup.start_warmup(_warm_up)
+startup.mark_imported()
@@ -0,0 +1,149 @@
+"""
+Report prompt and generation, shared by the generate_report callable and the
+weekly precompute job.
+"""
+import hashlib
+from collections import Counter
+
+import instrumentation
+from gemini_client import get_client
+from report_cache import get_report_cache
+
+# Bump whenever the prompt changes so stored reports from an older prompt are
+# not served for the new one.
+PROMPT_VERSION = "2"
+
+# The report model is registered once per instance and built on first use, so
+# Vertex AI initialization and model construction are not repeated per call.
+REPORT_VARIANT = "report"
+get_client().register(REPORT_VARIANT, "gemini-2.0-flash")
+
+
+def titles_from_payload(payload):
+    """
+    Extracts the food titles from a request payload. The app sends
+    {"food_names": [...], "user_profile": {...}}; a bare list also works.
+    Raises ValueError for any other shape.
+    """
+    if isinstance(payload, list):
+        food_titles = payload
+    elif isinstance(payload, dict):
+        # If the payload is a dict, assume the values are the food titles.
+        # This can happen depending on how the client SDK serializes an array.
+        food_titles = list(payload.values())
+    else:
+        raise ValueError(f"Invalid payload type: {type(payload)}. Expected a list or dict.")
+    return flatten_titles(food_titles)
+
+
+def flatten_titles(food_titles):
+    """Flattens the list in case it's a list of lists (e.g., [['apple'], ['banana']])."""
+    flattened_titles = []
+    for item in food_titles:
+        if isinstance(item, str):
+            flattened_titles.append(item)
+        elif isinstance(item, list):
+            flattened_titles.extend(title for title in item if isinstance(title, str))
+    return flattened_titles
+
+
+def normalize_titles(titles):
+    """
+    Case-folds, deduplicates and counts titles. Returns [(display_name, count)],
+    most frequent first; the display name is the first spelling seen.
+    """
+    counts = Counter()
+    display_names = {}
+    for title in titles:
+        title = " ".join(title.split())
+        if not title:
+            continue
+        folded = title.casefold()
+        counts[folded] += 1
+        display_names.setdefault(folded, title)
+    ordered = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+    return [(display_names[folded], count) for folded, count in ordered]
+
+
+def format_titles(normalized):
+    """[('Coffee', 7), ('Avocado', 1)] -> 'Coffee ×7, Avocado'"""
+    return ", ".join(f"{name} ×{count}" if count > 1 else name for name, count in normalized)
+
+
+def report_key(titles):
+    """A stable key for a food multiset: same foods, same prompt -> same report."""
+    lines = [f"{name.casefold()}\t{count}" for name, count in normalize_titles(titles)]
+    digest = hashlib.sha256("\n".join([PROMPT_VERSION] + sorted(lines)).encode("utf-8"))
+    return digest.hexdigest()[:32]
+
+
+def estimate_tokens(text):
+    """Rough token estimate (~4 characters per token), good enough for savings stats."""
+    return max(1, len(text) // 4)
+
+
+def build_prompt(titles):
+    return f"""
+        You are a friendly, encouraging nutritionist. Based on the following list of foods a user has consumed this week, please provide a brief, positive, and insightful weekly report.
+
+        The user ate (×N means N times): {format_titles(normalize_titles(titles))}.
+
+        Please structure the report with the following sections, using markdown for formatting:
+
+        **Macros Overview:** Briefly summarize the estimated intake of protein, fats, and carbohydrates. Provide a general calorie estimate.
+        **Vitamin & Mineral Spotlight:** Highlight one or two key vitamins or minerals consumed this week and explain their benefits.
+        **The Rainbow Check:** Comment on the variety and color of the foods eaten. Encourage eating a "rainbow" of foods for a wider range of nutrients.
+        **Fiber Facts:** Briefly touch on the importance of fiber and estimate if the user had good sources of it this week.
+        **A Positive Tip for Next Week:** Provide one simple, actionable, and encouraging tip for the user for the following week.
+
+        Keep the tone light, positive, and non-judgmental. Start the report with a friendly greeting like "Here's your weekly food recap!".
+        """
+
+
+def _prepare_prompt(titles, trace):
+    prompt = build_prompt(titles)
+    tokens_saved = max(0, estimate_tokens(", ".join(titles)) - estimate_tokens(format_titles(normalize_titles(titles))))
+    get_report_cache().record_prompt_savings(tokens_saved)
+    trace.set(titles=len(titles), prompt_tokens_saved=tokens_saved)
+    trace.debug("Built report prompt.", prompt=prompt)
+    return prompt
+
+
+def generate_report_text(titles):
+    """Runs the model for a list of titles and returns the report text."""
+    trace = instrumentation.current()
+    prompt = _prepare_prompt(titles, trace)
+    with trace.span('model_call'):
+        response = get_client().generate(REPORT_VARIANT, prompt)
+    trace.record_usage(response)
+    return response.text
+
+
+def _chunk_text(chunk):
+    """
+    A chunk's text, or "" for chunks without text parts (e.g. a final
+    usage-only chunk), where `chunk.text` raises ValueError.
+    """
+    candidates = getattr(chunk, 'candidates', None)
+    if candidates is not None and not (candidates and candidates[0].content.parts):
+        return ""
+    try:
+        return chunk.text
+    except ValueError:
+        return ""
+
+
+def stream_report_text(titles, trace=None):
+    """
+    Runs the model with streamed generation and yields text chunks as they
+    arrive. The final chunk carries the usage metadata for the whole call.
+    """
+    trace = trace or instrumentation.current()
+    last_chunk = None
+    with trace.span('model_call'):
+        for chunk in get_client().generate(REPORT_VARIANT, _prepare_prompt(titles, trace), stream=True):
+            last_chunk = chunk
+            text = _chunk_text(chunk)
+            if text:
+                yield text
+    trace.record_usage(last_chunk)
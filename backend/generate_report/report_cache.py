@@ -0,0 +1,72 @@
+"""
+In-process cache for generated reports.
+
+Reports depend only on the normalized food multiset and the prompt version
+(see report.report_key), so identical requests, from the same user reopening
+the report screen or from different users with the same foods, can be served
+from memory. Entries expire after REPORT_CACHE_TTL_SECONDS and the least
+recently used entries are evicted beyond REPORT_CACHE_MAX_ENTRIES.
+
+The per-user stored reports in Firestore (weekly_reports.py) remain the
+durable tier behind this cache.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# --- CONFIGURATION ---
+MAX_ENTRIES = int(os.environ.get("REPORT_CACHE_MAX_ENTRIES", "512"))
+TTL_SECONDS = int(os.environ.get("REPORT_CACHE_TTL_SECONDS", str(24 * 3600)))
+
+
+class ReportCache:
+    def __init__(self, max_entries=MAX_ENTRIES, ttl_seconds=TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.prompt_tokens_saved = 0
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] <= now:
+                self._entries.pop(key, None)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key, report_text):
+        with self._lock:
+            self._entries[key] = (time.time() + self.ttl_seconds, report_text)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def record_prompt_savings(self, tokens):
+        with self._lock:
+            self.prompt_tokens_saved += tokens
+
+    def stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / total, 4) if total else 0.0,
+                "size": len(self._entries),
+                "prompt_tokens_saved": self.prompt_tokens_saved,
+            }
+
+
+_cache = ReportCache()
+
+
+def get_report_cache():
+    return _cache
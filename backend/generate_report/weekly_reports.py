@@ -0,0 +1,203 @@
+"""
+Precomputed weekly reports.
+
+The app archives a jar (and asks for its report) on Sunday, in the user's
+local time. An hourly job finds users for whom it is currently early Sunday
+morning, reads the food stickers in their jar, and generates their report in
+advance on a bounded worker pool. Reports are stored under the user at
+users/{uid}/weekly_reports/{report_key}. The key is derived from the titles
+and the prompt version, so the callable can serve a stored report only when
+the user's foods are exactly what it was generated from.
+
+Each run is checkpointed in report_runs/{run_id} after every page of users.
+A retried or re-triggered run for the same hour resumes from the last
+checkpoint. Users whose report already exists are skipped, so replaying a
+page is harmless. Each run first resumes earlier runs from the last
+RESUME_WINDOW_HOURS that never reached 'done', so a run whose retries ran out
+is finished by the next hour's job.
+"""
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from zoneinfo import ZoneInfo, available_timezones
+
+import instrumentation
+from report import generate_report_text, report_key
+
+# --- CONFIGURATION ---
+REPORTS_SUBCOLLECTION = "weekly_reports"
+RUNS_COLLECTION = "report_runs"
+# Local time at which a user's report is precomputed (Sunday, 3am).
+PRECOMPUTE_WEEKDAY = 6  # Monday is 0
+PRECOMPUTE_LOCAL_HOUR = int(os.environ.get("REPORT_PRECOMPUTE_LOCAL_HOUR", "3"))
+REPORT_WORKERS = int(os.environ.get("REPORT_WORKERS", "8"))
+PAGE_SIZE = int(os.environ.get("REPORT_PAGE_SIZE", "100"))
+TIMEZONE_CHUNK_SIZE = 30  # Firestore 'in' queries accept at most 30 values.
+RESUME_WINDOW_HOURS = int(os.environ.get("REPORT_RESUME_WINDOW_HOURS", "24"))
+RUN_ID_FORMAT = "%Y-%m-%dT%H"
+
+# The same filter the app applies before calling generate_report.
+_UNKNOWN_NAMES = {"???", "N/A"}
+
+
+def get_stored_report(db, user_id, key):
+    snapshot = db.collection('users').document(user_id).collection(REPORTS_SUBCOLLECTION).document(key).get()
+    if not snapshot.exists:
+        return None
+    return (snapshot.to_dict() or {}).get('report')
+
+
+def store_report(db, user_id, key, report_text, titles, source):
+    db.collection('users').document(user_id).collection(REPORTS_SUBCOLLECTION).document(key).set({
+        'report': report_text,
+        'food_titles': titles,
+        'source': source,
+        'created_at': datetime.now(timezone.utc),
+    })
+
+
+def load_jar_titles(db, user_id):
+    """Names of the confirmed food stickers currently in the user's jar."""
+    titles = []
+    stickers = db.collection('users').document(user_id).collection('stickers').select(['name', 'isFood'])
+    for doc in stickers.stream():
+        data = doc.to_dict()
+        name = data.get('name')
+        if data.get('isFood') is True and name and name not in _UNKNOWN_NAMES:
+            titles.append(name)
+    return titles
+
+
+def target_timezones(utc_now):
+    """Timezones where it is currently the precompute hour on Sunday."""
+    targets = []
+    for tz_name in available_timezones():
+        try:
+            local_time = utc_now.astimezone(ZoneInfo(tz_name))
+        except Exception:
+            continue
+        if local_time.weekday() == PRECOMPUTE_WEEKDAY and local_time.hour == PRECOMPUTE_LOCAL_HOUR:
+            targets.append(tz_name)
+    return sorted(targets)
+
+
+def precompute_user_report(db, user_id):
+    """Returns 'generated', 'exists' or 'empty'."""
+    with instrumentation.span('firestore_stickers'):
+        titles = load_jar_titles(db, user_id)
+    if not titles:
+        return 'empty'
+    key = report_key(titles)
+    with instrumentation.span('firestore_get'):
+        stored = get_stored_report(db, user_id, key)
+    if stored is not None:
+        return 'exists'
+    report_text = generate_report_text(titles)
+    with instrumentation.span('firestore_set'):
+        store_report(db, user_id, key, report_text, titles, source='precomputed')
+    return 'generated'
+
+
+def _traced_user_report(trace, db, user_id):
+    # Runs on a pool thread, which does not inherit the run's trace.
+    with trace.activate(), trace.span('user_report'):
+        return precompute_user_report(db, user_id)
+
+
+def run_precompute(db, run_id, utc_now):
+    """
+    Generates reports for every user whose week ends now. Resumes from the
+    checkpoint stored under report_runs/{run_id}. Returns the run summary.
+    """
+    # Only the hourly job queries; on-demand reports load without google.cloud.firestore.
+    from google.cloud.firestore_v1.base_query import FieldFilter
+
+    trace = instrumentation.current()
+    run_ref = db.collection(RUNS_COLLECTION).document(run_id)
+    snapshot = run_ref.get()
+    state = snapshot.to_dict() if snapshot.exists else {}
+    if state.get('status') == 'done':
+        logging.info(f"Report run {run_id} already completed. Nothing to do.")
+        return state
+
+    timezones = state.get('timezones') or target_timezones(utc_now)
+    state = {
+        'status': 'running',
+        'timezones': timezones,
+        'chunk_index': state.get('chunk_index', 0),
+        'cursor': state.get('cursor'),
+        'generated': state.get('generated', 0),
+        'exists': state.get('exists', 0),
+        'empty': state.get('empty', 0),
+        'failed': state.get('failed', 0),
+    }
+    # Recorded before the first page, so a run that fails early is still found by resume_unfinished.
+    if not snapshot.exists:
+        run_ref.set({**state, 'updated_at': datetime.now(timezone.utc)})
+    logging.info(f"Report run {run_id}: {len(timezones)} timezones, resuming at chunk {state['chunk_index']}, cursor {state['cursor']}.")
+
+    with ThreadPoolExecutor(max_workers=REPORT_WORKERS) as executor:
+        while state['chunk_index'] * TIMEZONE_CHUNK_SIZE < len(timezones):
+            start = state['chunk_index'] * TIMEZONE_CHUNK_SIZE
+            chunk = timezones[start:start + TIMEZONE_CHUNK_SIZE]
+            query = (db.collection('users')
+                     .where(filter=FieldFilter('timezone', 'in', chunk))
+                     .order_by('__name__')
+                     .select([])
+                     .limit(PAGE_SIZE))
+            if state['cursor']:
+                query = query.start_after({'__name__': db.collection('users').document(state['cursor'])})
+            with trace.span('firestore_query'):
+                user_ids = [doc.id for doc in query.stream()]
+
+            if not user_ids:
+                state['chunk_index'] += 1
+                state['cursor'] = None
+            else:
+                futures = {executor.submit(_traced_user_report, trace, db, uid): uid for uid in user_ids}
+                for future, uid in futures.items():
+                    try:
+                        state[future.result()] += 1
+                    except Exception as e:
+                        state['failed'] += 1
+                        trace.debug("Report precompute failed.", user=uid, error=str(e))
+                state['cursor'] = user_ids[-1]
+
+            state['updated_at'] = datetime.now(timezone.utc)
+            with trace.span('firestore_checkpoint'):
+                run_ref.set(state)
+
+    state['status'] = 'done'
+    state['updated_at'] = datetime.now(timezone.utc)
+    run_ref.set(state)
+    trace.set(timezones=len(timezones), generated=state['generated'], exists=state['exists'],
+              empty=state['empty'], failed=state['failed'])
+    return state
+
+
+def resume_unfinished(db, run_id):
+    """
+    Resumes earlier runs from the last RESUME_WINDOW_HOURS that are not done.
+    Older runs are left alone; their users' Sunday has passed.
+    """
+    from google.cloud.firestore_v1.base_query import FieldFilter
+
+    trace = instrumentation.current()
+    cutoff = datetime.strptime(run_id, RUN_ID_FORMAT) - timedelta(hours=RESUME_WINDOW_HOURS)
+    cutoff_id = cutoff.strftime(RUN_ID_FORMAT)
+    with trace.span('firestore_query'):
+        unfinished = sorted(doc.id for doc in (db.collection(RUNS_COLLECTION)
+                                               .where(filter=FieldFilter('status', '==', 'running'))
+                                               .select([])
+                                               .stream()))
+    resumed = [earlier for earlier in unfinished if cutoff_id <= earlier < run_id]
+    for earlier in resumed:
+        utc_now = datetime.strptime(earlier, RUN_ID_FORMAT).replace(tzinfo=timezone.utc)
+        try:
+            with trace.span('resume_run'):
+                run_precompute(db, earlier, utc_now)
+        except Exception as e:
+            logging.error(f"Resuming report run {earlier} failed: {e}", exc_info=True)
+    trace.set(resumed_runs=resumed)
+    return resumed
@@ -1,126 +1,201 @@
+# First import: startup.import_ms is measured from here.
+import startup
+
 import firebase_admin
-from firebase_admin import firestore, messaging
 import functions_framework
-from datetime import datetime
-from zoneinfo import ZoneInfo, available_timezones
-from google.cloud.firestore_v1.base_query import FieldFilter
+from collections import Counter
+from datetime import datetime, timezone
+
+import instrumentation
+import notification_buckets
+import notification_shards
+import stagger
+from fcm_fanout import FanoutEngine, notification_message
+from token_pruning import TokenPruner
+from token_stream import stream_tokens
+from notification_buckets import HOURS_FIELD, OFFSET_FIELD
 
 # Initialize Firebase Admin SDK. This is done once per function instance.
 # Explicitly set the project ID to avoid any ambiguity.
 options = {'projectId': 'foodjar-462805'}
 firebase_admin.initialize_app(options=options)
-db = firestore.client()
 
-TARGET_HOURS = [7, 11, 13, 14, 15, 16,17, 18, 19, 20, 21, 22, 23]  # 7am, 11am, 5pm
+
+def get_db():
+    """
+    The Firestore client, created on first use rather than at load: resolving
+    credentials and opening the channel is the slowest part of a cold start,
+    and the Admin SDK caches the client for the rest of the instance's life.
+    Importing google.cloud.firestore here keeps it off the load path too.
+    """
+    from firebase_admin import firestore
+    return firestore.client()
+
+
+def _bucket_query(hour):
+    from google.cloud.firestore_v1.base_query import FieldFilter
+    return get_db().collection('users').where(filter=FieldFilter(HOURS_FIELD, 'array_contains', hour))
+
+
+def _send_to_users(query, key_range=(0, notification_shards.KEYSPACE)):
+    """
+    Streams the tokens matched by `query` within the user-id `key_range`
+    straight into the fan-out: batches of up to 500 tokens, sent concurrently
+    with transient failures retried, each going out as soon as it has been
+    read. With a stagger window, each slot of the range is read and sent when
+    it is due (see stagger.py). Dead tokens are cleared from their users while
+    the rest of the send is in flight. Returns the summary.
+    """
+    db = get_db()
+    pruner = TokenPruner(db)
+    engine = FanoutEngine(notification_message(
+        title='Food Sticker Jar',
+        body='Don\'t forget to add your food today! 👑'
+    ), on_failures=pruner.on_failures)
+    read_stats = Counter()
+
+    def send_slot(start, end):
+        read_stats.update(stream_tokens(notification_shards.range_query(db, query, start, end), engine))
+        engine.flush()
+
+    stagger.run_schedule(stagger.schedule(key_range), send_slot)
+    result = engine.finish()
+    return {
+        'users': read_stats['users'],
+        'tokens': read_stats['tokens'],
+        'pages': read_stats['pages'],
+        'success': result.success_count,
+        'failure': result.failure_count,
+        'fanout': result.summary(),
+        'send_rate_curve': result.rate_curve(stagger.bucket_seconds()),
+        'pruning': pruner.finish(delivered=result.success_count),
+    }
+
+
+def _run_shard(payload):
+    """
+    Worker entry point shared by the HTTP worker and the in-process dispatcher.
+    Each shard emits its own trace record.
+    """
+    hour, count = int(payload['hour']), int(payload['shards'])
+    with instrumentation.start_trace('send_notification_shard', run_id=payload['run_id'],
+                                     shard=payload['shard'], shards=count) as trace:
+        result = notification_shards.run_shard(
+            get_db(), payload['run_id'], int(payload['shard']), count,
+            lambda index, count: _send_to_users(_bucket_query(hour), notification_shards.shard_range(index, count)),
+        )
+        trace.set(**{key: value for key, value in result.items() if key != 'status'})
+        trace.set(shard_status=result.get('status'), status=200)
+    return result
+
 
 @functions_framework.http
+@instrumentation.traced('send_daily_notification')
 def send_daily_notification(request):
     """
     An HTTP-triggered Cloud Function that sends push notifications to users
     based on their local time. It's designed to be run hourly.
+
+    Users are selected by their precomputed UTC-hour bucket (see
+    notification_buckets.py), so this is a single query regardless of how
+    many timezones are currently at a target hour. With NOTIFY_SHARDS > 1 the
+    hour is split into user-id ranges sent by parallel workers (see
+    notification_shards.py). Each run emits one structured trace record.
     """
-    print("--- [PROD_NOTIF] Execution started. ---")
+    trace = instrumentation.current()
     # 1. Determine the current hour in UTC.
-    utc_now = datetime.utcnow()
-    
-    # 2. Find all timezones where the current hour matches one of our target hours.
-    target_timezones = []
-    for tz_name in available_timezones():
-        try:
-            local_time = utc_now.astimezone(ZoneInfo(tz_name))
-            if local_time.hour in TARGET_HOURS:
-                target_timezones.append(tz_name)
-        except Exception as e:
-            # Some timezones in the list might be invalid or aliases, so we ignore them.
-            print(f"--- [PROD_NOTIF] Could not process timezone {tz_name}: {e}")
-            continue
-            
-    if not target_timezones:
-        print(f"--- [PROD_NOTIF] No timezones match the current UTC hour: {utc_now.hour}. No notifications will be sent.")
-        return "No target timezones for this hour.", 200
-
-    print(f"--- [PROD_NOTIF] Found {len(target_timezones)} timezones matching target hours.")
-    # DEBUG: Print the FULL list of timezones to verify calculation
-    print(f"--- [PROD_NOTIF] Full list of target timezones: {target_timezones}")
-
-    # 3. Fetch all users who are in one of the target timezones.
-    tokens = []
-    found_users_in_target_zones = 0
-    users_with_tokens = 0
-
-    for i in range(0, len(target_timezones), 30):
-        chunk = target_timezones[i:i + 30]
-        print(f"--- [PROD_NOTIF] Querying for timezones in chunk {i//30 + 1}...")
-        users_ref = db.collection('users').where(filter=FieldFilter('timezone', 'in', chunk))
-        docs = users_ref.stream()
-        
-        for doc in docs:
-            found_users_in_target_zones += 1
-            user_data = doc.to_dict()
-            user_id = doc.id
-            user_timezone = user_data.get('timezone', 'N/A')
-            has_token = 'fcmToken' in user_data and user_data['fcmToken']
-            
-            print(f"--- [PROD_NOTIF]   - User: {user_id}, DB Timezone: '{user_timezone}', Has Token: {has_token}")
-
-            if has_token:
-                token = user_data['fcmToken']
-                tokens.append(token)
-                users_with_tokens += 1
-                print(f"--- [PROD_NOTIF]     - Token Found, ending in ...{token[-10:]}. Added to send list.")
-    
-    # --- DEBUG SUMMARY ---
-    print("\n--- [PROD_NOTIF] --- QUERY SUMMARY ---")
-    print(f"--- [PROD_NOTIF] Total user documents returned by query: {found_users_in_target_zones}")
-    print(f"--- [PROD_NOTIF] Total users with a valid FCM token: {users_with_tokens}")
-    print("--- [PROD_NOTIF] -----------------------\n")
-            
-    if not tokens:
-        print("--- [PROD_NOTIF] No valid FCM tokens found for users in the target timezones. No notifications sent.")
-        return "No FCM tokens found for users in target timezones.", 200
-
-    print(f"--- [PROD_NOTIF] Found {len(tokens)} tokens to send notifications to.")
-
-    apns_payload = messaging.APNSPayload(aps=messaging.Aps(badge=1))
-    
-    message = messaging.MulticastMessage(
-        notification=messaging.Notification(
-            title='Food Sticker Jar',
-            body='Don\'t forget to add your food today! 👑'
-        ),
-        tokens=tokens,
-        apns=messaging.APNSConfig(payload=apns_payload)
-    )
-
-    try:
-        print("--- [PROD_NOTIF] Attempting to send notifications via MULTICAST...")
-        batch_response = messaging.send_multicast(message)
-        print(f"--- [PROD_NOTIF] Multicast sent. Success: {batch_response.success_count}, Failure: {batch_response.failure_count}")
-        return f"Notifications sent: {batch_response.success_count} successful, {batch_response.failure_count} failed.", 200
-        
-    except Exception as e:
-        print(f"--- [PROD_NOTIF] !!! MULTICAST FAILED: {e}. Falling back to one-by-one sending.")
-        
-        success_count = 0
-        failure_count = 0
-        errors = []
-
-        for token in tokens:
-            single_message = messaging.Message(
-                notification=messaging.Notification(title='Food Sticker Jar', body='Don\'t forget to add your food today! 👑'),
-                token=token,
-                apns=messaging.APNSConfig(payload=apns_payload)
-            )
-            try:
-                messaging.send(single_message)
-                success_count += 1
-            except Exception as single_e:
-                failure_count += 1
-                errors.append(str(single_e))
-        
-        print(f"--- [PROD_NOTIF] One-by-one sending complete. Success: {success_count}, Failure: {failure_count}")
-
-        if failure_count > 0:
-            return f"Multicast failed. One-by-one sending finished with {failure_count} failures. Errors: {errors}", 500
+    utc_now = datetime.now(timezone.utc)
+    trace.set(utc_hour=utc_now.hour)
+
+    # 2a. Coordinator mode: one worker invocation per shard.
+    if notification_shards.SHARD_COUNT > 1:
+        run_id = utc_now.strftime('%Y-%m-%dT%H')
+        if notification_shards.WORKER_URL:
+            dispatcher = notification_shards.HttpDispatcher(notification_shards.WORKER_URL)
         else:
-            return f"Multicast failed, but one-by-one sending succeeded for all {success_count} tokens.", 200 
\ No newline at end of file
+            dispatcher = notification_shards.LocalDispatcher(_run_shard)
+        summary, results = notification_shards.coordinate(get_db(), run_id, utc_now.hour, notification_shards.SHARD_COUNT, dispatcher)
+        for shard_result in results:
+            trace.debug("Shard result.", **shard_result)
+        totals = summary['totals']
+        trace.set(run_id=run_id, run_status=summary['status'], shards=summary['shards'],
+                  failed_shards=summary['failed_shards'], send_rate_curve=summary['send_rate_curve'], **totals)
+        status = 200 if not summary['failed_shards'] else 500
+        return f"Notifications sent: {totals['success']} successful, {totals['failure']} failed, over {summary['shards']} shards.", status
+
+    # 2b. Single-invocation mode.
+    summary = _send_to_users(_bucket_query(utc_now.hour))
+    trace.set(**summary)
+    if not summary['tokens']:
+        return "No FCM tokens found for users in this hour's bucket.", 200
+
+    if summary['failure'] and not summary['success']:
+        return f"Notifications failed for all {summary['failure']} tokens.", 500
+    return f"Notifications sent: {summary['success']} successful, {summary['failure']} failed.", 200
+
+
+@functions_framework.http
+def send_notification_shard(request):
+    """
+    Worker for one shard of an hourly run, invoked by the coordinator with
+    {"run_id", "hour", "shard", "shards"}. Deploy it with authentication
+    required so only callers holding an ID token for it can trigger sends.
+    """
+    payload = request.get_json(silent=True) or {}
+    if not all(key in payload for key in ('run_id', 'hour', 'shard', 'shards')):
+        return {'error': "Missing 'run_id', 'hour', 'shard' or 'shards'."}, 400
+    return _run_shard(payload), 200
+
+
+@functions_framework.http
+@instrumentation.traced('refresh_notification_buckets')
+def refresh_notification_buckets(request):
+    """
+    Keeps the notification hour buckets correct across DST transitions. Run it
+    hourly; it only rewrites users in zones whose UTC offset changed. Call it
+    with ?mode=backfill to recompute the buckets of every user.
+    """
+    mode = request.args.get('mode', 'dst')
+    if mode == 'backfill':
+        summary = notification_buckets.backfill(get_db())
+    else:
+        summary = notification_buckets.refresh_changed_zones(get_db())
+    instrumentation.current().set(mode=mode, **summary)
+    return summary, 200
+
+
+@functions_framework.cloud_event
+def on_user_written(cloud_event):
+    """
+    Firestore trigger on users/{userId}. Recomputes the user's notification
+    hour buckets when their timezone is set or changes. Writes only when the
+    stored buckets are out of date, so its own update does not loop.
+    """
+    # Imported here so the HTTP functions deployed from this source don't load the event types.
+    from google.events.cloud import firestore as firestoredata
+
+    payload = firestoredata.DocumentEventData()
+    payload._pb.ParseFromString(cloud_event.data)
+    if not payload.value.name:
+        return  # The document was deleted.
+
+    fields = payload.value.fields
+    tz_name = fields['timezone'].string_value if 'timezone' in fields else None
+    if not tz_name:
+        return
+    buckets = notification_buckets.bucket_fields(tz_name)
+    if buckets is None:
+        print(f"--- [PROD_NOTIF] Ignoring unknown timezone '{tz_name}' on {payload.value.name}.")
+        return
+
+    stored_hours = [int(v.integer_value) for v in fields[HOURS_FIELD].array_value.values] if HOURS_FIELD in fields else None
+    stored_offset = int(fields[OFFSET_FIELD].integer_value) if OFFSET_FIELD in fields else None
+    if stored_hours == buckets[HOURS_FIELD] and stored_offset == buckets[OFFSET_FIELD]:
+        return
+
+    user_id = payload.value.name.split('/documents/users/', 1)[1]
+    get_db().collection('users').document(user_id).update(buckets)
+
+
+startup.start_warmup(get_db)
+startup.mark_imported()
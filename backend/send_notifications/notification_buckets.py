@@ -0,0 +1,128 @@
+"""
+UTC-hour buckets for notification targeting.
+
+Each user document carries `notificationUtcHours`, the UTC hours at which it
+is one of TARGET_HOURS in the user's timezone, and `notificationUtcOffset`,
+the UTC offset (in minutes) those hours were computed with. The hourly job
+then needs a single `array_contains` query on the current UTC hour, instead of
+converting the time in every IANA timezone and querying them 30 at a time.
+
+The buckets are kept correct in three ways:
+  - `on_user_written` recomputes them whenever a user's timezone changes.
+  - `refresh_notification_buckets` runs hourly. It compares each timezone's
+    current offset with the offsets applied last time (stored in
+    notification_buckets/zones), and re-buckets only the users of zones that
+    changed, i.e. zones that just went through a DST transition.
+  - `refresh_notification_buckets?mode=backfill` recomputes every user; run it
+    once for existing users before switching the hourly job to buckets.
+"""
+import math
+from datetime import datetime, timezone
+from zoneinfo import ZoneInfo, available_timezones
+
+
+TARGET_HOURS = [7, 11, 13, 14, 15, 16,17, 18, 19, 20, 21, 22, 23]  # 7am, 11am, 5pm
+
+HOURS_FIELD = 'notificationUtcHours'
+OFFSET_FIELD = 'notificationUtcOffset'
+STATE_DOCUMENT = ('notification_buckets', 'zones')
+BATCH_LIMIT = 500  # Firestore's maximum writes per batch.
+
+
+def utc_offset_minutes(tz_name, at):
+    offset = at.astimezone(ZoneInfo(tz_name)).utcoffset()
+    return int(offset.total_seconds() // 60)
+
+
+def utc_hours_for_offset(offset_minutes):
+    """
+    The UTC hours H at which local time H:00 + offset falls in a target hour.
+    Half-hour zones land on the following UTC hour, matching a job that runs
+    at the top of every UTC hour.
+    """
+    return sorted({math.ceil((hour * 60 - offset_minutes) / 60) % 24 for hour in TARGET_HOURS})
+
+
+def bucket_fields(tz_name, at=None):
+    """The fields to store on a user document for `tz_name`, or None if it is invalid."""
+    at = at or datetime.now(timezone.utc)
+    try:
+        offset = utc_offset_minutes(tz_name, at)
+    except Exception:
+        return None
+    return {HOURS_FIELD: utc_hours_for_offset(offset), OFFSET_FIELD: offset}
+
+
+def current_zone_offsets(at=None):
+    at = at or datetime.now(timezone.utc)
+    offsets = {}
+    for tz_name in available_timezones():
+        try:
+            offsets[tz_name] = utc_offset_minutes(tz_name, at)
+        except Exception:
+            continue
+    return offsets
+
+
+class BatchWriter:
+    """Accumulates updates and commits them in batches of up to BATCH_LIMIT."""
+
+    def __init__(self, db):
+        self.db = db
+        self.batch = db.batch()
+        self.pending = 0
+        self.written = 0
+
+    def update(self, ref, fields):
+        self.batch.update(ref, fields)
+        self.pending += 1
+        if self.pending >= BATCH_LIMIT:
+            self.commit()
+
+    def commit(self):
+        if self.pending:
+            self.batch.commit()
+            self.written += self.pending
+            self.batch = self.db.batch()
+            self.pending = 0
+        return self.written
+
+
+def _rebucket(writer, docs, fields_by_zone):
+    for doc in docs:
+        tz_name = (doc.to_dict() or {}).get('timezone')
+        fields = fields_by_zone.get(tz_name)
+        if fields is None and tz_name:
+            fields = fields_by_zone.setdefault(tz_name, bucket_fields(tz_name))
+        if fields:
+            writer.update(doc.reference, fields)
+
+
+def backfill(db):
+    """Recomputes the buckets of every user that has a timezone."""
+    writer = BatchWriter(db)
+    docs = db.collection('users').select(['timezone']).stream()
+    _rebucket(writer, docs, {})
+    written = writer.commit()
+    db.collection(STATE_DOCUMENT[0]).document(STATE_DOCUMENT[1]).set({'offsets': current_zone_offsets()})
+    return {'updated_users': written}
+
+
+def refresh_changed_zones(db, at=None):
+    """Re-buckets only the users of zones whose UTC offset changed since the last refresh."""
+    at = at or datetime.now(timezone.utc)
+    state_ref = db.collection(STATE_DOCUMENT[0]).document(STATE_DOCUMENT[1])
+    snapshot = state_ref.get()
+    previous = (snapshot.to_dict() or {}).get('offsets', {}) if snapshot.exists else {}
+    offsets = current_zone_offsets(at)
+    changed = sorted(tz for tz, offset in offsets.items() if previous.get(tz, offset) != offset)
+
+    from google.cloud.firestore_v1.base_query import FieldFilter  # Off the load path; see main.get_db.
+    writer = BatchWriter(db)
+    fields_by_zone = {tz: {HOURS_FIELD: utc_hours_for_offset(offsets[tz]), OFFSET_FIELD: offsets[tz]} for tz in changed}
+    for tz_name in changed:
+        docs = db.collection('users').where(filter=FieldFilter('timezone', '==', tz_name)).select(['timezone']).stream()
+        _rebucket(writer, docs, fields_by_zone)
+    written = writer.commit()
+    state_ref.set({'offsets': offsets})
+    return {'changed_zones': changed, 'updated_users': written}
@@ -0,0 +1,150 @@
+"""
+Sharded execution of the hourly notification job.
+
+With NOTIFY_SHARDS > 1, send_daily_notification acts as a coordinator. It
+splits the hour's users into NOTIFY_SHARDS contiguous user-id ranges and
+dispatches each range to a worker invocation (send_notification_shard),
+then aggregates the per-shard results into notification_runs/{run_id}.
+
+Every shard is claimed by creating notification_runs/{run_id}/shards/{i}
+before anything is sent, so delivery is at most once per shard. A retried
+shard, a retried coordinator, or a duplicate worker delivery finds the claim
+and returns the stored result without sending again. A shard whose worker
+died mid-send stays 'running' and is not re-sent.
+
+Workers are reached over HTTP with a Google-signed ID token
+(HttpDispatcher, when NOTIFY_WORKER_URL is set) or run in-process on a
+thread pool (LocalDispatcher), which is also what tests use.
+"""
+import logging
+import os
+import string
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from google.api_core.exceptions import AlreadyExists
+
+# --- CONFIGURATION ---
+SHARD_COUNT = int(os.environ.get("NOTIFY_SHARDS", "1"))
+WORKER_URL = os.environ.get("NOTIFY_WORKER_URL")
+WORKER_TIMEOUT_SECONDS = int(os.environ.get("NOTIFY_WORKER_TIMEOUT_SECONDS", "540"))
+RUNS_COLLECTION = 'notification_runs'
+
+# Firebase Auth user ids are alphanumeric; this is their byte order. Ranges are
+# expressed over the two-character id prefixes, KEYSPACE of them in all.
+_ID_ALPHABET = string.digits + string.ascii_uppercase + string.ascii_lowercase
+KEYSPACE = len(_ID_ALPHABET) ** 2
+_TOTAL_KEYS = ('users', 'tokens', 'success', 'failure')
+
+
+def split_range(start, end, index, count):
+    """The `index`-th of `count` contiguous parts of the key range [start, end)."""
+    width = end - start
+    return start + width * index // count, start + width * (index + 1) // count
+
+
+def shard_range(index, count):
+    return split_range(0, KEYSPACE, index, count)
+
+
+def _prefix(key):
+    return _ID_ALPHABET[key // len(_ID_ALPHABET)] + _ID_ALPHABET[key % len(_ID_ALPHABET)]
+
+
+def range_query(db, query, start, end):
+    """Restricts `query` to user ids whose prefix falls in the key range [start, end)."""
+    from google.cloud.firestore_v1.base_query import FieldFilter  # Off the load path; see main.get_db.
+    users = db.collection('users')
+    if start > 0:
+        query = query.where(filter=FieldFilter('__name__', '>=', users.document(_prefix(start))))
+    if end < KEYSPACE:
+        query = query.where(filter=FieldFilter('__name__', '<', users.document(_prefix(end))))
+    return query
+
+
+def run_shard(db, run_id, index, count, send):
+    """
+    Claims shard `index` of run `run_id` and calls send(index, count), which
+    returns the shard's result dict. Returns the stored result on replays.
+    """
+    ref = db.collection(RUNS_COLLECTION).document(run_id).collection('shards').document(str(index))
+    try:
+        ref.create({'status': 'running', 'started_at': datetime.now(timezone.utc)})
+    except AlreadyExists:
+        data = ref.get().to_dict() or {}
+        logging.info(f"Shard {index} of run {run_id} already claimed ({data.get('status')}); not sending again.")
+        return {**data.get('result', {}), 'shard': index, 'status': data.get('status'), 'replayed': True}
+
+    try:
+        result = send(index, count)
+    except Exception as e:
+        ref.update({'status': 'failed', 'error': str(e), 'finished_at': datetime.now(timezone.utc)})
+        raise
+    ref.update({'status': 'done', 'result': result, 'finished_at': datetime.now(timezone.utc)})
+    return {**result, 'shard': index, 'status': 'done'}
+
+
+class LocalDispatcher:
+    """Runs every shard in-process; `handler(payload)` is the worker entry point."""
+
+    def __init__(self, handler, workers=None):
+        self.handler = handler
+        self.workers = workers
+
+    def dispatch_all(self, payloads):
+        with ThreadPoolExecutor(max_workers=self.workers or len(payloads)) as executor:
+            return list(executor.map(lambda payload: _call(self.handler, payload), payloads))
+
+
+class HttpDispatcher:
+    """POSTs each shard to the worker function, authenticated with an ID token."""
+
+    def __init__(self, url, timeout=WORKER_TIMEOUT_SECONDS):
+        self.url = url
+        self.timeout = timeout
+
+    def _post(self, payload):
+        # Imported here so in-process runs do not need the HTTP transport.
+        import requests
+        import google.auth.transport.requests
+        from google.oauth2 import id_token
+
+        token = id_token.fetch_id_token(google.auth.transport.requests.Request(), self.url)
+        response = requests.post(self.url, json=payload, timeout=self.timeout,
+                                 headers={'Authorization': f'Bearer {token}'})
+        response.raise_for_status()
+        return response.json()
+
+    def dispatch_all(self, payloads):
+        with ThreadPoolExecutor(max_workers=len(payloads)) as executor:
+            return list(executor.map(lambda payload: _call(self._post, payload), payloads))
+
+
+def _call(handler, payload):
+    try:
+        return handler(payload)
+    except Exception as e:
+        logging.error(f"Shard {payload['shard']} of run {payload['run_id']} failed: {e}")
+        return {'shard': payload['shard'], 'status': 'error', 'error': str(e)}
+
+
+def coordinate(db, run_id, hour, count, dispatcher):
+    """Dispatches every shard of the run and records the aggregated result."""
+    payloads = [{'run_id': run_id, 'hour': hour, 'shard': index, 'shards': count} for index in range(count)]
+    results = dispatcher.dispatch_all(payloads)
+    totals = {key: sum(result.get(key, 0) for result in results) for key in _TOTAL_KEYS}
+    curves = [result.get('send_rate_curve') or [] for result in results]
+    send_rate_curve = [round(sum(curve[i] for curve in curves if i < len(curve)), 1)
+                       for i in range(max(map(len, curves), default=0))]
+    failed_shards = [result['shard'] for result in results if result.get('status') not in ('done', 'running')]
+    summary = {
+        'status': 'done' if not failed_shards else 'partial',
+        'hour': hour,
+        'shards': count,
+        'failed_shards': failed_shards,
+        'totals': totals,
+        'send_rate_curve': send_rate_curve,
+        'updated_at': datetime.now(timezone.utc),
+    }
+    db.collection(RUNS_COLLECTION).document(run_id).set(summary)
+    return summary, results
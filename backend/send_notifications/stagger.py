@@ -0,0 +1,49 @@
+"""
+Staggered notification delivery.
+
+Notifying everyone in the same second makes analyze_food and Firestore
+traffic spike right after every run. With NOTIFY_STAGGER_MINUTES set, a run's
+users are split into NOTIFY_STAGGER_SLOTS slots (one per minute by default)
+spread evenly over the window. Slot j covers the j-th contiguous user-id
+range and is read and sent at window_start + j * window / slots. Firebase
+user ids are random, so the slots are evenly sized, and a user is always in
+the same slot, i.e. notified at the same offset every time.
+
+Each slot is its own range query issued when the slot is due, so nothing is
+buffered between slots. The function timeout (and NOTIFY_WORKER_TIMEOUT_SECONDS
+when sharded) must cover the window plus the time to send the last slot.
+"""
+import os
+import time
+
+from notification_shards import KEYSPACE, split_range
+
+# --- CONFIGURATION ---
+STAGGER_MINUTES = float(os.environ.get("NOTIFY_STAGGER_MINUTES", "0"))
+STAGGER_SLOTS = int(os.environ.get("NOTIFY_STAGGER_SLOTS", "0")) or max(1, round(STAGGER_MINUTES))
+
+
+def schedule(key_range=(0, KEYSPACE), minutes=STAGGER_MINUTES, slots=STAGGER_SLOTS):
+    """[(offset_seconds, (start, end))] for each slot of `key_range`."""
+    if minutes <= 0 or slots <= 1:
+        return [(0.0, key_range)]
+    start, end = key_range
+    slot_seconds = minutes * 60 / slots
+    return [(index * slot_seconds, split_range(start, end, index, slots)) for index in range(slots)]
+
+
+def run_schedule(slot_schedule, send_slot, clock=time.monotonic, sleep=time.sleep):
+    """Calls send_slot(start, end) for every slot once it is due."""
+    started = clock()
+    for offset, (start, end) in slot_schedule:
+        delay = started + offset - clock()
+        if delay > 0:
+            sleep(delay)
+        send_slot(start, end)
+
+
+def bucket_seconds(minutes=STAGGER_MINUTES, slots=STAGGER_SLOTS):
+    """Resolution of the reported send-rate curve: one point per slot, or per second."""
+    if minutes <= 0 or slots <= 1:
+        return 1
+    return max(1, round(minutes * 60 / slots))
@@ -0,0 +1,84 @@
+"""
+Cold-start bookkeeping.
+
+main.py imports this module first and calls `mark_imported()` at the end of
+its own import, so `import_ms` covers the whole module load. The first
+request's trace record (see instrumentation.py) carries a `startup` block
+with import_ms, warmup_ms and the time the instance waited for its first
+request, measured up to the moment that request's trace started. That
+record's duration_ms is the first-request time, so startup
+regressions show up in the logs whenever a dependency changes.
+
+With WARMUP_ON_START=1, `start_warmup(warm)` runs the function's warm-up
+(SDK imports, client and model construction) on a background thread during
+instance startup instead of inside the first request. This pays off when
+the platform gives CPU to starting instances (startup CPU boost, min
+instances).
+
+Each function directory is deployed as its own source bundle, so this file is
+vendored into all four function directories. Keep the copies identical.
+"""
+import logging
+import os
+import threading
+import time
+
+_LOAD_STARTED = time.perf_counter()
+
+WARMUP_ON_START = os.environ.get("WARMUP_ON_START", "0") == "1"
+
+_state = {'import_ms': None, 'imported_at': None, 'first_request_at': None, 'warmup_ms': None, 'reported': False}
+_lock = threading.Lock()
+
+
+def _ms(seconds):
+    return round(seconds * 1000, 1)
+
+
+def mark_imported():
+    now = time.perf_counter()
+    _state['import_ms'] = _ms(now - _LOAD_STARTED)
+    _state['imported_at'] = now
+
+
+def mark_request_started():
+    """Called as each trace starts; only the first call is kept."""
+    if _state['first_request_at'] is None:
+        with _lock:
+            if _state['first_request_at'] is None:
+                _state['first_request_at'] = time.perf_counter()
+
+
+def start_warmup(warm):
+    """Runs `warm()` once on a background thread when WARMUP_ON_START is set."""
+    if not WARMUP_ON_START:
+        return None
+
+    def run():
+        started = time.perf_counter()
+        try:
+            warm()
+        except Exception as e:
+            logging.warning(f"Warm-up failed; the first request will initialize instead: {e}")
+            return
+        _state['warmup_ms'] = _ms(time.perf_counter() - started)
+
+    thread = threading.Thread(target=run, name='warmup', daemon=True)
+    thread.start()
+    return thread
+
+
+def take_report():
+    """The startup report, returned once per instance (for its first request)."""
+    with _lock:
+        if _state['reported']:
+            return None
+        _state['reported'] = True
+    imported_at, first_request_at = _state['imported_at'], _state['first_request_at']
+    return {
+        'cold_start': True,
+        'import_ms': _state['import_ms'],
+        'warmup_ms': _state['warmup_ms'],
+        'idle_before_first_request_ms': (_ms(first_request_at - imported_at)
+                                         if imported_at and first_request_at else None),
+    }
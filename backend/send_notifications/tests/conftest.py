@@ -0,0 +1,20 @@
+"""
+Tests run from this function's directory: `python -m pytest -q`. The modules
+under test are top-level modules of the deployed source, and Firestore is
+replaced by the in-memory fake the benchmarks use.
+"""
+import os
+import sys
+
+import pytest
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, os.path.join(HERE, '..', '..', 'benchmarks'))
+
+from fake_firestore import FakeFirestore  # noqa: E402
+
+
+@pytest.fixture
+def db():
+    return FakeFirestore()
@@ -0,0 +1,96 @@
+import threading
+
+import pytest
+from firebase_admin import exceptions, messaging
+
+from fcm_fanout import FakeMessaging, FanoutEngine, notification_message
+
+build = notification_message(title='t', body='b')
+
+
+def no_sleep(seconds):
+    pass
+
+
+def test_fake_messaging_fails_dead_tokens_as_unregistered():
+    backend = FakeMessaging(dead_tokens={'gone'})
+    response = backend.send_each_for_multicast(build(['ok', 'gone', 'dead-1']))
+    assert [r.success for r in response.responses] == [True, False, False]
+    assert all(isinstance(r.exception, messaging.UnregisteredError) for r in response.responses[1:])
+    assert (response.success_count, response.failure_count) == (1, 2)
+    assert (backend.calls, backend.delivered) == (1, 1)
+
+
+def test_fake_messaging_rejects_oversized_batches():
+    with pytest.raises(ValueError):
+        FakeMessaging().send_each_for_multicast(build([f'tok-{i}' for i in range(501)]))
+
+
+def test_fake_messaging_transient_failures_are_seeded():
+    def failures(seed):
+        response = FakeMessaging(transient_rate=0.5, seed=seed).send_each_for_multicast(build(['a'] * 100))
+        return [r.success for r in response.responses]
+
+    assert failures(1) == failures(1)
+    outcome = failures(1)
+    assert 0 < outcome.count(False) < 100
+
+
+def test_tokens_go_out_in_batches_of_the_configured_size():
+    backend = FakeMessaging()
+    result = FanoutEngine(build, backend=backend, batch_size=500).send([f'tok-{i}' for i in range(1234)])
+    assert (result.success_count, result.failure_count, result.batches) == (1234, 0, 3)
+    assert backend.calls == 3
+
+
+def test_submit_sends_full_batches_before_finish():
+    backend = FakeMessaging()
+    engine = FanoutEngine(build, backend=backend, batch_size=10)
+    engine.submit([f'tok-{i}' for i in range(5)])
+    assert engine.result.first_batch_at is None
+    engine.submit([f'tok-{i}' for i in range(5, 25)])
+    assert engine.result.first_batch_at is not None
+    result = engine.finish()
+    assert (result.success_count, result.batches, backend.calls) == (25, 3, 3)
+
+
+def test_permanent_failures_reach_the_callback_once_per_batch():
+    seen = []
+    lock = threading.Lock()
+
+    def on_failures(failures, batch_size):
+        with lock:
+            seen.append((sorted(failures), batch_size))
+
+    tokens = ['tok-1', 'dead-1', 'tok-2', 'tok-3', 'dead-2']
+    result = FanoutEngine(build, backend=FakeMessaging(), batch_size=3, on_failures=on_failures).send(tokens)
+    assert result.failure_count == 2
+    assert set(result.failures) == {'dead-1', 'dead-2'}
+    assert sorted(seen) == [(['dead-1'], 3), (['dead-2'], 2)]
+
+
+def test_transient_failures_are_retried_until_they_succeed():
+    backend = FakeMessaging(transient_rate=0.3, seed=7)
+    result = FanoutEngine(build, backend=backend, max_retries=50, sleep=no_sleep).send(
+        [f'tok-{i}' for i in range(200)])
+    assert (result.success_count, result.failure_count) == (200, 0)
+    assert result.retries > 0
+    assert backend.delivered == 200
+
+
+def test_transient_failures_fail_once_retries_run_out():
+    result = FanoutEngine(build, backend=FakeMessaging(transient_rate=1.0), max_retries=2, sleep=no_sleep).send(['a', 'b'])
+    assert (result.success_count, result.failure_count, result.retries) == (0, 2, 2)
+    assert all(isinstance(e, exceptions.UnavailableError) for e in result.failures.values())
+
+
+def test_a_failing_batch_request_is_retried_when_transient():
+    class FlakyBackend(FakeMessaging):
+        def send_each_for_multicast(self, message, dry_run=False):
+            if self.calls == 0:
+                self.calls += 1
+                raise exceptions.UnavailableError("down")
+            return super().send_each_for_multicast(message, dry_run)
+
+    result = FanoutEngine(build, backend=FlakyBackend(), sleep=no_sleep).send(['a', 'b'])
+    assert (result.success_count, result.retries) == (2, 1)
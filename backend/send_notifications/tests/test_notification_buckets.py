@@ -0,0 +1,75 @@
+from datetime import datetime, timezone
+
+import pytest
+
+import notification_buckets
+from notification_buckets import HOURS_FIELD, OFFSET_FIELD, TARGET_HOURS, bucket_fields, utc_hours_for_offset
+
+WINTER = datetime(2025, 1, 15, 12, tzinfo=timezone.utc)
+SUMMER = datetime(2025, 7, 15, 12, tzinfo=timezone.utc)
+
+
+@pytest.mark.parametrize('offset', [0, 60, -300, -480, 330, 345, 570, 780, -570, 840, -720])
+def test_every_bucket_hour_is_a_target_hour_locally(offset):
+    hours = utc_hours_for_offset(offset)
+    assert hours == sorted(set(hours))
+    assert all(0 <= hour < 24 for hour in hours)
+    # The job runs at H:00 UTC; local time then must fall in a target hour.
+    assert sorted(((hour * 60 + offset) // 60) % 24 for hour in hours) == sorted(TARGET_HOURS)
+
+
+def test_utc_offset_maps_hours_directly():
+    assert utc_hours_for_offset(0) == sorted(TARGET_HOURS)
+
+
+def test_whole_hour_offsets_shift_and_wrap():
+    # Los Angeles in winter: 7:00 local is 15:00 UTC, 23:00 local is 07:00 UTC.
+    hours = utc_hours_for_offset(-480)
+    assert 15 in hours and 7 in hours
+    # Tokyo: 7:00 local is 22:00 UTC the day before.
+    assert 22 in utc_hours_for_offset(540)
+
+
+def test_half_hour_zones_land_on_the_following_utc_hour():
+    # India (+5:30): 7:00 local is 01:30 UTC, so the 02:00 UTC run sends at 7:30 local.
+    hours = utc_hours_for_offset(330)
+    assert 2 in hours and 1 not in hours
+
+
+def test_bucket_fields_follow_daylight_saving():
+    winter = bucket_fields('America/Los_Angeles', WINTER)
+    summer = bucket_fields('America/Los_Angeles', SUMMER)
+    assert winter == {HOURS_FIELD: utc_hours_for_offset(-480), OFFSET_FIELD: -480}
+    assert summer == {HOURS_FIELD: utc_hours_for_offset(-420), OFFSET_FIELD: -420}
+
+
+def test_bucket_fields_for_an_unknown_zone_is_none():
+    assert bucket_fields('Mars/Olympus_Mons', WINTER) is None
+
+
+def test_refresh_rebuckets_only_zones_whose_offset_changed(db):
+    users = db.collection('users')
+    users.document('la').set({'timezone': 'America/Los_Angeles', **bucket_fields('America/Los_Angeles', WINTER)})
+    users.document('tokyo').set({'timezone': 'Asia/Tokyo', **bucket_fields('Asia/Tokyo', WINTER)})
+    db.collection('notification_buckets').document('zones').set(
+        {'offsets': notification_buckets.current_zone_offsets(WINTER)})
+
+    result = notification_buckets.refresh_changed_zones(db, at=SUMMER)
+
+    assert 'America/Los_Angeles' in result['changed_zones']
+    assert 'Asia/Tokyo' not in result['changed_zones']
+    assert result['updated_users'] == 1
+    assert users.document('la').get().to_dict()[OFFSET_FIELD] == -420
+    assert users.document('tokyo').get().to_dict()[OFFSET_FIELD] == 540
+    assert notification_buckets.refresh_changed_zones(db, at=SUMMER) == {'changed_zones': [], 'updated_users': 0}
+
+
+def test_backfill_buckets_every_user_with_a_timezone(db):
+    users = db.collection('users')
+    users.document('a').set({'timezone': 'Europe/Berlin'})
+    users.document('b').set({'timezone': 'Not/AZone'})
+    users.document('c').set({'fcmToken': 'tok'})
+
+    assert notification_buckets.backfill(db) == {'updated_users': 1}
+    assert HOURS_FIELD in users.document('a').get().to_dict()
+    assert HOURS_FIELD not in users.document('b').get().to_dict()
@@ -0,0 +1,112 @@
+import threading
+
+import pytest
+
+import notification_shards
+from notification_shards import KEYSPACE, LocalDispatcher, coordinate, range_query, run_shard, shard_range, split_range
+
+# Ids spread over the whole prefix space, including its first and last prefix.
+USER_IDS = ['00first', '0zz', '9abc', 'A1', 'Mid', 'Zed', 'a0', 'mmm', 'zy', 'zzlast']
+
+
+@pytest.mark.parametrize('count', [1, 2, 3, 7, 64])
+def test_shard_ranges_cover_the_keyspace_without_gaps(count):
+    ranges = [shard_range(index, count) for index in range(count)]
+    assert ranges[0][0] == 0 and ranges[-1][1] == KEYSPACE
+    assert all(previous[1] == current[0] for previous, current in zip(ranges, ranges[1:]))
+    widths = [end - start for start, end in ranges]
+    assert max(widths) - min(widths) <= 1
+
+
+def test_split_range_subdivides_a_shard():
+    start, end = shard_range(1, 4)
+    parts = [split_range(start, end, index, 3) for index in range(3)]
+    assert parts[0][0] == start and parts[-1][1] == end
+    assert all(a[1] == b[0] for a, b in zip(parts, parts[1:]))
+
+
+@pytest.mark.parametrize('count', [1, 2, 5])
+def test_range_queries_partition_the_users(db, count):
+    users = db.collection('users')
+    for user_id in USER_IDS:
+        users.document(user_id).set({'fcmToken': f'tok-{user_id}'})
+
+    seen = []
+    for index in range(count):
+        start, end = shard_range(index, count)
+        seen.append([doc.id for doc in range_query(db, users, start, end).stream()])
+    assert sorted(user_id for shard in seen for user_id in shard) == sorted(USER_IDS)
+    assert sum(map(len, seen)) == len(USER_IDS)
+
+
+def _counting_send(calls, result=None):
+    lock = threading.Lock()
+
+    def send(index, count):
+        with lock:
+            calls.append(index)
+        return result or {'users': 10, 'tokens': 9, 'success': 8, 'failure': 1, 'send_rate_curve': [4.0, 4.0]}
+    return send
+
+
+def test_a_shard_is_sent_once_and_replayed_from_its_claim(db):
+    calls = []
+    first = run_shard(db, 'run-1', 0, 2, _counting_send(calls))
+    again = run_shard(db, 'run-1', 0, 2, _counting_send(calls))
+
+    assert calls == [0]
+    assert first['status'] == 'done' and 'replayed' not in first
+    assert again['replayed'] is True and again['status'] == 'done'
+    assert again['success'] == first['success']
+
+
+def test_a_failed_shard_is_recorded_and_not_resent(db):
+    def broken(index, count):
+        raise RuntimeError("FCM down")
+
+    with pytest.raises(RuntimeError):
+        run_shard(db, 'run-1', 1, 2, broken)
+    stored = db.collection('notification_runs').document('run-1').collection('shards').document('1').get().to_dict()
+    assert stored['status'] == 'failed' and stored['error'] == 'FCM down'
+
+    calls = []
+    replay = run_shard(db, 'run-1', 1, 2, _counting_send(calls))
+    assert calls == [] and replay['status'] == 'failed' and replay['replayed'] is True
+
+
+def test_coordinate_aggregates_shards_and_a_rerun_sends_nothing(db):
+    calls = []
+    send = _counting_send(calls)
+
+    def handler(payload):
+        return run_shard(db, payload['run_id'], payload['shard'], payload['shards'], send)
+
+    summary, results = coordinate(db, 'run-2', 7, 4, LocalDispatcher(handler))
+    assert sorted(calls) == [0, 1, 2, 3]
+    assert summary['status'] == 'done' and summary['failed_shards'] == []
+    assert summary['totals'] == {'users': 40, 'tokens': 36, 'success': 32, 'failure': 4}
+    assert summary['send_rate_curve'] == [16.0, 16.0]
+    assert db.collection('notification_runs').document('run-2').get().to_dict()['totals'] == summary['totals']
+
+    rerun, rerun_results = coordinate(db, 'run-2', 7, 4, LocalDispatcher(handler))
+    assert sorted(calls) == [0, 1, 2, 3]
+    assert all(result['replayed'] for result in rerun_results)
+    assert rerun['totals'] == summary['totals']
+
+
+def test_coordinate_reports_failed_shards_as_partial(db):
+    def handler(payload):
+        if payload['shard'] == 1:
+            raise RuntimeError("worker crashed")
+        return {'shard': payload['shard'], 'status': 'done', 'users': 1}
+
+    summary, results = coordinate(db, 'run-3', 7, 3, LocalDispatcher(handler))
+    assert summary['status'] == 'partial'
+    assert summary['failed_shards'] == [1]
+    assert summary['totals']['users'] == 2
+    assert results[1] == {'shard': 1, 'status': 'error', 'error': 'worker crashed'}
+
+
+def test_prefixes_follow_firestore_id_order():
+    prefixes = [notification_shards._prefix(key) for key in range(KEYSPACE)]
+    assert prefixes == sorted(prefixes)
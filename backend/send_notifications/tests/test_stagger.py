@@ -0,0 +1,54 @@
+import stagger
+from notification_shards import KEYSPACE
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 100.0
+        self.sleeps = []
+
+    def __call__(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(round(seconds, 6))
+        self.now += seconds
+
+
+def test_no_window_sends_everything_at_once():
+    assert stagger.schedule((0, KEYSPACE), minutes=0, slots=10) == [(0.0, (0, KEYSPACE))]
+    assert stagger.schedule((5, 9), minutes=10, slots=1) == [(0.0, (5, 9))]
+
+
+def test_slots_are_evenly_spaced_and_cover_the_range():
+    slots = stagger.schedule((100, 1100), minutes=10, slots=5)
+    assert [offset for offset, _ in slots] == [0.0, 120.0, 240.0, 360.0, 480.0]
+    ranges = [key_range for _, key_range in slots]
+    assert ranges[0][0] == 100 and ranges[-1][1] == 1100
+    assert all(a[1] == b[0] for a, b in zip(ranges, ranges[1:]))
+    assert {end - start for start, end in ranges} == {200}
+
+
+def test_run_schedule_waits_for_each_slot_in_order():
+    clock, sent = FakeClock(), []
+    slots = stagger.schedule((0, 30), minutes=1, slots=3)
+    stagger.run_schedule(slots, lambda start, end: sent.append((clock.now, start, end)),
+                         clock=clock, sleep=clock.sleep)
+    assert sent == [(100.0, 0, 10), (120.0, 10, 20), (140.0, 20, 30)]
+    assert clock.sleeps == [20.0, 20.0]
+
+
+def test_run_schedule_does_not_sleep_for_slots_already_due():
+    clock = FakeClock()
+
+    def slow_send(start, end):
+        clock.now += 50  # Longer than the 20s between slots.
+
+    stagger.run_schedule(stagger.schedule((0, 30), minutes=1, slots=3), slow_send, clock=clock, sleep=clock.sleep)
+    assert clock.sleeps == []
+
+
+def test_rate_curve_resolution_is_one_point_per_slot():
+    assert stagger.bucket_seconds(minutes=0, slots=0) == 1
+    assert stagger.bucket_seconds(minutes=10, slots=10) == 60
+    assert stagger.bucket_seconds(minutes=1, slots=120) == 1
@@ -0,0 +1,50 @@
+from firebase_admin import exceptions, messaging
+
+from token_pruning import TokenPruner, classify
+
+
+def _users(db, tokens):
+    users = db.collection('users')
+    for index, token in enumerate(tokens):
+        users.document(f'user-{index}').set({'fcmToken': token})
+    return users
+
+
+def _tokens_left(users):
+    return sorted(doc.to_dict().get('fcmToken') for doc in users.stream() if 'fcmToken' in doc.to_dict())
+
+
+def test_classify_separates_dead_tokens_from_transient_errors():
+    assert classify(messaging.UnregisteredError('gone')) == 'unregistered'
+    assert classify(messaging.SenderIdMismatchError('other')) == 'sender_mismatch'
+    assert classify(exceptions.InvalidArgumentError('bad')) == 'invalid_argument'
+    assert classify(exceptions.UnavailableError('later')) is None
+
+
+def test_unregistered_tokens_are_cleared(db):
+    users = _users(db, ['a', 'b', 'c'])
+    pruner = TokenPruner(db)
+    pruner.on_failures({'b': messaging.UnregisteredError('gone'), 'c': exceptions.UnavailableError('later')}, 3)
+    report = pruner.finish(delivered=1)
+    assert _tokens_left(users) == ['a', 'c']
+    assert report['by_reason'] == {'unregistered': 1} and report['cleared_users'] == 1
+
+
+def test_invalid_argument_tokens_are_kept_when_nothing_was_delivered(db):
+    # A one-token send, as from test_send_notification with a bad title.
+    users = _users(db, ['a'])
+    pruner = TokenPruner(db)
+    pruner.on_failures({'a': exceptions.InvalidArgumentError('bad message')}, 1)
+    report = pruner.finish(delivered=0)
+    assert _tokens_left(users) == ['a']
+    assert report['kept_invalid'] == 1 and report['dead_tokens'] == 0
+
+
+def test_invalid_argument_tokens_are_pruned_when_the_message_was_delivered(db):
+    users = _users(db, ['a', 'b', 'c'])
+    pruner = TokenPruner(db)
+    pruner.on_failures({'a': exceptions.InvalidArgumentError('bad token')}, 1)
+    pruner.on_failures({'b': exceptions.InvalidArgumentError('bad token')}, 2)
+    report = pruner.finish(delivered=1)
+    assert _tokens_left(users) == ['c']
+    assert report['by_reason'] == {'invalid_argument': 2} and report['kept_invalid'] == 0
@@ -0,0 +1,270 @@
+"""
+Chunked, concurrent FCM fan-out.
+
+Tokens are split into batches of at most MAX_BATCH_SIZE (FCM's multicast
+limit) and sent with send_each_for_multicast on a bounded thread pool.
+Transient failures (unavailable, internal, quota, deadline) are retried
+with exponential backoff and jitter, either for the whole batch or for just
+the tokens that failed. Results are aggregated per token.
+
+Tokens can be submitted incrementally (`submit`) and full batches go out as
+soon as they fill up; `finish` flushes the rest and returns the FanoutResult.
+An optional `on_failures(failures, batch_size)` callback receives each
+batch's permanent failures as soon as that batch completes. At most
+`max_in_flight` batches are queued or sending at once; `submit` blocks beyond
+that, which keeps a streaming producer's memory bounded.
+
+The engine talks to FCM through a messaging backend: the firebase_admin
+`messaging` module by default, or FakeMessaging when FCM_BACKEND=fake, which
+never leaves the process and can simulate latency, dead tokens and transient
+errors.
+
+Each function directory is deployed as its own source bundle, so this file is
+vendored into `send_notifications/` and `test_send_notification/`. Keep the
+copies identical.
+"""
+import os
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from firebase_admin import exceptions, messaging
+
+import instrumentation
+
+# --- CONFIGURATION ---
+MAX_BATCH_SIZE = 500  # FCM's limit per multicast request.
+FANOUT_WORKERS = int(os.environ.get("FCM_FANOUT_WORKERS", "8"))
+MAX_RETRIES = int(os.environ.get("FCM_MAX_RETRIES", "4"))
+BACKOFF_BASE_SECONDS = float(os.environ.get("FCM_BACKOFF_BASE_SECONDS", "0.5"))
+BACKOFF_MAX_SECONDS = float(os.environ.get("FCM_BACKOFF_MAX_SECONDS", "16"))
+
+TRANSIENT_ERRORS = (
+    exceptions.UnavailableError,
+    exceptions.InternalError,
+    exceptions.DeadlineExceededError,
+    exceptions.ResourceExhaustedError,  # includes messaging.QuotaExceededError
+)
+
+
+def is_transient(error):
+    return isinstance(error, TRANSIENT_ERRORS)
+
+
+def notification_message(title, body, badge=1):
+    """Returns a builder for the multicast message sent to each batch of tokens."""
+    apns = messaging.APNSConfig(payload=messaging.APNSPayload(aps=messaging.Aps(badge=badge)))
+
+    def build(tokens):
+        return messaging.MulticastMessage(
+            notification=messaging.Notification(title=title, body=body),
+            tokens=tokens,
+            apns=apns,
+        )
+    return build
+
+
+class FakeSendResponse:
+    def __init__(self, exception=None):
+        self.exception = exception
+        self.success = exception is None
+        self.message_id = None if exception else f"fake-{random.getrandbits(48):012x}"
+
+
+class FakeBatchResponse:
+    def __init__(self, responses):
+        self.responses = responses
+        self.success_count = sum(1 for r in responses if r.success)
+        self.failure_count = len(responses) - self.success_count
+
+
+class FakeMessaging:
+    """
+    An in-process stand-in for firebase_admin.messaging. Tokens in
+    `dead_tokens` (or starting with "dead-") fail as unregistered, and each
+    token fails transiently with probability `transient_rate`.
+    """
+
+    def __init__(self, latency_seconds=0.0, dead_tokens=(), transient_rate=0.0, seed=None):
+        self.latency_seconds = latency_seconds
+        self.dead_tokens = set(dead_tokens)
+        self.transient_rate = transient_rate
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.delivered = 0
+
+    def _error_for(self, token):
+        if token in self.dead_tokens or token.startswith("dead-"):
+            return messaging.UnregisteredError("Requested entity was not found.")
+        with self._lock:
+            transient = self.random.random() < self.transient_rate
+        if transient:
+            return exceptions.UnavailableError("The service is currently unavailable.")
+        return None
+
+    def send_each_for_multicast(self, message, dry_run=False):
+        if len(message.tokens) > MAX_BATCH_SIZE:
+            raise ValueError(f"tokens must not contain more than {MAX_BATCH_SIZE} items.")
+        if self.latency_seconds:
+            time.sleep(self.latency_seconds)
+        responses = [FakeSendResponse(self._error_for(token)) for token in message.tokens]
+        with self._lock:
+            self.calls += 1
+            self.delivered += sum(1 for r in responses if r.success)
+        return FakeBatchResponse(responses)
+
+
+def default_backend():
+    if os.environ.get("FCM_BACKEND", "firebase").lower() == "fake":
+        return FakeMessaging()
+    return messaging
+
+
+class FanoutResult:
+    def __init__(self):
+        self.success_count = 0
+        self.failure_count = 0
+        self.batches = 0
+        self.retries = 0
+        self.failures = {}  # token -> exception
+        self.completed_per_second = Counter()  # whole seconds since start -> messages completed
+        self.started_at = time.monotonic()
+        self.first_batch_at = None
+        self.finished_at = None
+
+    @property
+    def total(self):
+        return self.success_count + self.failure_count
+
+    @property
+    def duration_seconds(self):
+        end = self.finished_at if self.finished_at is not None else time.monotonic()
+        return end - self.started_at
+
+    @property
+    def messages_per_second(self):
+        duration = self.duration_seconds
+        return self.total / duration if duration > 0 else 0.0
+
+    def rate_curve(self, bucket_seconds=1):
+        """Messages per second in consecutive `bucket_seconds` windows since the start."""
+        if not self.completed_per_second:
+            return []
+        buckets = Counter()
+        for second, count in self.completed_per_second.items():
+            buckets[second // bucket_seconds] += count
+        return [round(buckets[index] / bucket_seconds, 1) for index in range(max(buckets) + 1)]
+
+    def summary(self):
+        return {
+            "sent": self.total,
+            "success": self.success_count,
+            "failure": self.failure_count,
+            "batches": self.batches,
+            "retries": self.retries,
+            "duration_seconds": round(self.duration_seconds, 3),
+            "first_batch_seconds": round(self.first_batch_at - self.started_at, 3) if self.first_batch_at else None,
+            "messages_per_second": round(self.messages_per_second, 1),
+        }
+
+
+class FanoutEngine:
+    def __init__(self, build_message, backend=None, batch_size=MAX_BATCH_SIZE, workers=FANOUT_WORKERS,
+                 max_retries=MAX_RETRIES, sleep=time.sleep, on_failures=None, max_in_flight=None):
+        self.build_message = build_message
+        self.on_failures = on_failures
+        # Batches are sent from pool threads, which do not inherit the request's trace.
+        self.trace = instrumentation.current()
+        self.backend = backend or default_backend()
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self.max_retries = max_retries
+        self.sleep = sleep
+        self.result = FanoutResult()
+        self._pending = []
+        self._futures = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_in_flight or workers * 2)
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def submit(self, tokens):
+        """Queues tokens; every full batch is dispatched immediately."""
+        self._pending.extend(tokens)
+        while len(self._pending) >= self.batch_size:
+            batch, self._pending = self._pending[:self.batch_size], self._pending[self.batch_size:]
+            self._dispatch(batch)
+
+    def flush(self):
+        """Dispatches the partial batch, if any."""
+        if self._pending:
+            batch, self._pending = self._pending, []
+            self._dispatch(batch)
+
+    def finish(self):
+        """Sends whatever is left, waits for all batches and returns the FanoutResult."""
+        self.flush()
+        for future in self._futures:
+            future.result()
+        self._executor.shutdown(wait=True)
+        self.result.finished_at = time.monotonic()
+        return self.result
+
+    def send(self, tokens):
+        self.submit(tokens)
+        return self.finish()
+
+    def _dispatch(self, batch):
+        self._slots.acquire()
+        if self.result.first_batch_at is None:
+            self.result.first_batch_at = time.monotonic()
+        future = self._executor.submit(self._send_batch, batch)
+        future.add_done_callback(lambda _: self._slots.release())
+        self._futures.append(future)
+
+    def _backoff(self, attempt):
+        delay = min(BACKOFF_MAX_SECONDS, BACKOFF_BASE_SECONDS * (2 ** attempt))
+        self.sleep(random.uniform(0, delay))
+
+    def _record(self, succeeded, failed, batches=0, retries=0):
+        with self._lock:
+            self.result.success_count += succeeded
+            self.result.failure_count += len(failed)
+            self.result.failures.update(failed)
+            self.result.batches += batches
+            self.result.retries += retries
+            self.result.completed_per_second[int(time.monotonic() - self.result.started_at)] += succeeded + len(failed)
+
+    def _send_batch(self, tokens):
+        batch_size = len(tokens)
+        succeeded = 0
+        failed = {}
+        attempt = 0
+        while tokens:
+            try:
+                with self.trace.span('fcm_batch'):
+                    response = self.backend.send_each_for_multicast(self.build_message(tokens))
+            except Exception as e:
+                if is_transient(e) and attempt < self.max_retries:
+                    self._backoff(attempt)
+                    attempt += 1
+                    continue
+                failed.update((token, e) for token in tokens)
+                break
+
+            retry = []
+            for token, send_response in zip(tokens, response.responses):
+                if send_response.success:
+                    succeeded += 1
+                elif is_transient(send_response.exception) and attempt < self.max_retries:
+                    retry.append(token)
+                else:
+                    failed[token] = send_response.exception
+            tokens = retry
+            if tokens:
+                self._backoff(attempt)
+                attempt += 1
+        self._record(succeeded, failed, batches=1, retries=attempt)
+        if failed and self.on_failures:
+            self.on_failures(failed, batch_size)
@@ -0,0 +1,151 @@
+"""
+Pruning of dead FCM tokens.
+
+Sends that fail because the token is unregistered (app uninstalled), invalid,
+or registered to another sender will never succeed, so the token is cleared
+from every user document that still holds it. The pruner is fed by the
+fan-out engine as batches complete and works on a background thread while
+the rest of the send is still in flight. Users are looked up by token value
+(`in` queries of up to 30 tokens) and updated in write batches of up to 500.
+
+INVALID_ARGUMENT is ambiguous: it can mean a malformed token or a malformed
+message. Those tokens are held until the send finishes and pruned only if
+the same message was delivered to at least one other token. If nothing was
+delivered, the message is the likely cause and they are all kept. The call is
+made for the whole send, however small its batches are.
+
+Each function directory is deployed as its own source bundle, so this file is
+vendored into `send_notifications/` and `test_send_notification/`. Keep the
+copies identical.
+"""
+import logging
+import queue
+import threading
+from collections import Counter
+
+from firebase_admin import exceptions, messaging
+
+import instrumentation
+
+IN_QUERY_LIMIT = 30  # Firestore 'in' queries accept at most 30 values.
+BATCH_LIMIT = 500  # Firestore's maximum writes per batch.
+IDLE_FLUSH_SECONDS = 1.0
+
+
+def classify(error):
+    """Returns why a token is permanently dead, or None if it may still work."""
+    if isinstance(error, messaging.UnregisteredError):
+        return 'unregistered'
+    if isinstance(error, messaging.SenderIdMismatchError):
+        return 'sender_mismatch'
+    if isinstance(error, exceptions.InvalidArgumentError):
+        return 'invalid_argument'
+    return None
+
+
+class TokenPruner:
+    def __init__(self, db):
+        self.db = db
+        # Prunes run on a background thread, which does not inherit the request's trace.
+        self.trace = instrumentation.current()
+        self.reasons = Counter()
+        self.cleared_users = 0
+        self.kept_invalid = 0
+        self.errors = 0
+        self._queue = queue.Queue()
+        self._held_invalid = []
+        self._held_lock = threading.Lock()
+        self._pending = []
+        self._batch = db.batch()
+        self._batch_size = 0
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def on_failures(self, failures, batch_size):
+        """Fan-out callback: `failures` maps token -> exception for one batch."""
+        dead = {token: classify(error) for token, error in failures.items()}
+        for token, reason in dead.items():
+            if reason == 'invalid_argument':
+                with self._held_lock:
+                    self._held_invalid.append(token)
+            elif reason:
+                self._queue.put((token, reason))
+
+    def finish(self, delivered):
+        """
+        Waits for pending prunes and returns what was removed. `delivered` is
+        how many tokens the send reached; it decides whether the tokens held
+        for INVALID_ARGUMENT are pruned or the message was at fault.
+        """
+        with self._held_lock:
+            held, self._held_invalid = self._held_invalid, []
+        if held and delivered:
+            for token in held:
+                self._queue.put((token, 'invalid_argument'))
+        elif held:
+            self.kept_invalid += len(held)
+            logging.warning(f"{len(held)} tokens failed with INVALID_ARGUMENT and none were delivered; "
+                            f"the message is the likely cause, so they are kept.")
+        self._queue.put(None)
+        self._thread.join()
+        return self.report()
+
+    def report(self):
+        return {
+            'dead_tokens': sum(self.reasons.values()),
+            'by_reason': dict(self.reasons),
+            'cleared_users': self.cleared_users,
+            'kept_invalid': self.kept_invalid,
+            'errors': self.errors,
+        }
+
+    def _run(self):
+        while True:
+            try:
+                item = self._queue.get(timeout=IDLE_FLUSH_SECONDS)
+            except queue.Empty:
+                self._prune_pending()
+                self._commit()
+                continue
+            if item is None:
+                break
+            self._pending.append(item)
+            if len(self._pending) >= IN_QUERY_LIMIT:
+                self._prune_pending()
+        self._prune_pending()
+        self._commit()
+
+    def _prune_pending(self):
+        if not self._pending:
+            return
+        items, self._pending = self._pending, []
+        tokens = [token for token, _ in items]
+        # Imported here so that loading the function does not import google.cloud.firestore.
+        from firebase_admin import firestore
+        from google.cloud.firestore_v1.base_query import FieldFilter
+        try:
+            with self.trace.span('prune_query'):
+                docs = list(self.db.collection('users').where(filter=FieldFilter('fcmToken', 'in', tokens)).select([]).stream())
+            for doc in docs:
+                self._batch.update(doc.reference, {'fcmToken': firestore.DELETE_FIELD})
+                self._batch_size += 1
+                if self._batch_size >= BATCH_LIMIT:
+                    self._commit()
+        except Exception as e:
+            self.errors += 1
+            logging.error(f"Token pruning query failed for {len(tokens)} tokens: {e}")
+            return
+        self.reasons.update(reason for _, reason in items)
+
+    def _commit(self):
+        if not self._batch_size:
+            return
+        try:
+            with self.trace.span('prune_commit'):
+                self._batch.commit()
+            self.cleared_users += self._batch_size
+        except Exception as e:
+            self.errors += 1
+            logging.error(f"Token pruning commit of {self._batch_size} users failed: {e}")
+        self._batch = self.db.batch()
+        self._batch_size = 0
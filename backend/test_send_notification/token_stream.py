@@ -0,0 +1,78 @@
+"""
+Streams FCM tokens from a Firestore query into the fan-out engine.
+
+Only `fcmToken` is fetched (field projection), in pages of PAGE_SIZE ordered
+by document id and resumed with a cursor. A reader thread puts each page's
+tokens on a bounded queue and the caller's thread submits them to the
+engine, so reading the next page overlaps sending the previous one. Memory
+is bounded by the queue (QUEUE_PAGES pages) plus the engine's in-flight
+batches, whatever the number of matching users, and the first batch goes out
+as soon as the first page has been read.
+
+Each function directory is deployed as its own source bundle, so this file is
+vendored into `send_notifications/` and `test_send_notification/`. Keep the
+copies identical.
+"""
+import os
+import queue
+import threading
+
+import instrumentation
+
+# --- CONFIGURATION ---
+PAGE_SIZE = int(os.environ.get("NOTIFY_PAGE_SIZE", "500"))
+QUEUE_PAGES = int(os.environ.get("NOTIFY_QUEUE_PAGES", "4"))
+
+_DONE = object()
+
+
+def iter_token_pages(query, page_size=PAGE_SIZE, trace=None):
+    """Yields (documents_read, tokens) for each page of the query."""
+    trace = trace or instrumentation.current()
+    query = query.order_by('__name__').select(['fcmToken']).limit(page_size)
+    last = None
+    while True:
+        page = query.start_after(last) if last is not None else query
+        with trace.span('firestore_page'):
+            docs = list(page.stream())
+        if not docs:
+            return
+        tokens = [token for token in ((doc.to_dict() or {}).get('fcmToken') for doc in docs) if token]
+        yield len(docs), tokens
+        if len(docs) < page_size:
+            return
+        last = docs[-1]
+
+
+def stream_tokens(query, engine, page_size=PAGE_SIZE, queue_pages=QUEUE_PAGES):
+    """
+    Submits every token matched by `query` to `engine` and returns read stats.
+    The caller still calls engine.finish() to flush and wait for the sends.
+    """
+    pages = queue.Queue(maxsize=queue_pages)
+    stats = {'users': 0, 'tokens': 0, 'pages': 0}
+    trace = instrumentation.current()
+
+    def read():
+        try:
+            for item in iter_token_pages(query, page_size, trace):
+                pages.put(item)
+            pages.put(_DONE)
+        except Exception as e:
+            pages.put(e)
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    while True:
+        item = pages.get()
+        if item is _DONE:
+            break
+        if isinstance(item, Exception):
+            raise item
+        documents_read, tokens = item
+        stats['users'] += documents_read
+        stats['tokens'] += len(tokens)
+        stats['pages'] += 1
+        engine.submit(tokens)
+    reader.join()
+    return stats